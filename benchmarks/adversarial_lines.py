@@ -0,0 +1,78 @@
+"""
+Benchmark scanning Markdown documents made of adversarial lines.
+
+Each case is a line built to make a backtracking regex take time quadratic
+in the length of the line: long runs of '#' characters or spaces, stray
+carriage returns, unterminated link labels, minified HTML, and so on.  Each
+case is scanned at two line lengths, one ten times the other; if scanning
+is linear, the scan time should grow about tenfold too.
+
+Exits with a non-zero status if any case grows much faster than that.
+"""
+
+import sys
+import time
+
+from mark_toc import mdfile
+
+SHORT_LENGTH = 20000
+LONG_LENGTH = 10 * SHORT_LENGTH
+LINES_PER_DOCUMENT = 10
+REPEATS = 3
+
+# Allow plenty of headroom over the expected growth of 10, for timer noise
+# and cache effects; quadratic growth would be around 100.
+MAX_GROWTH = 30
+
+CASES = {
+    "heading-only-hashes": lambda n: "#" * n,
+    "heading-hashes-then-space": lambda n: "#" * n + " ",
+    "heading-hashes-then-text-and-space": lambda n: "#" * n + "x ",
+    "heading-trailing-spaces": lambda n: "# x" + " " * n,
+    "heading-alternating-hash-space": lambda n: "# x" + " #" * (n // 2) + " ",
+    "heading-words-trailing-space": lambda n: "# " + "x " * (n // 2),
+    "heading-embedded-cr": lambda n: "#" * n + "\rx",
+    "fence-long-backticks": lambda n: "`" * n,
+    "fence-long-tildes": lambda n: "~" * n,
+    "html-comment-long-open": lambda n: "<!--" + "-" * n,
+    "html-comment-repeated-close": lambda n: "<!--" + "->" * (n // 2),
+    "comment-unterminated-label": lambda n: "[" + "x" * n,
+    "comment-long-label": lambda n: "[" + "x" * n + "]: #",
+    "comment-long-ref": lambda n: "[toc]: #" + "-" * n + "!",
+    "comment-trailing-spaces": lambda n: "[toc]: #" + " " * n + "x",
+    "comment-repeated-open-parens": lambda n: "[toc]: #" + " (" * (n // 2),
+    "comment-unclosed-comment": lambda n: "[endtoc]: # (" + "x" * n,
+    "comment-text-after-close": lambda n: "[endtoc]: # (x)" + " )" * (n // 2),
+    "minified-html": lambda n: "<div><a href='#x'>[x]</a></div>" * (n // 32),
+}
+
+
+def _time_scan(line):
+    document = ((line + "\n") * LINES_PER_DOCUMENT).encode("utf-8")
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        mdfile.scan_markdown(document)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    """Run the benchmark and report the results."""
+    status = 0
+    print("{:<40} {:>12} {:>12} {:>8}".format("case", "short (ms)", "long (ms)", "growth"))
+    for name, make_line in CASES.items():
+        short_time = _time_scan(make_line(SHORT_LENGTH))
+        long_time = _time_scan(make_line(LONG_LENGTH))
+        growth = long_time / max(short_time, 1e-6)
+        flag = ""
+        if growth > MAX_GROWTH:
+            flag = "  <-- superlinear"
+            status = 1
+        print("{:<40} {:>12.3f} {:>12.3f} {:>8.1f}{}".format(name, short_time * 1000, long_time * 1000, growth, flag))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+Benchmark the parser backends against each other on a shared corpus.
+
+For each available backend, report the throughput of scanning every
+document in the corpus, and how often its headings and tables of contents
+agree with those found by the default (regex) backend.  Documents where
+backends disagree are listed, so the differences can be inspected.
+
+The corpus is made of the Markdown files given on the command line (files,
+or directories to search for ``*.md`` files); if none are given, a synthetic
+corpus is generated, mixing plain documents with ones using constructs the
+backends treat differently ("setext" headings, tilde fences, indented code,
+HTML blocks).
+"""
+
+import os
+import sys
+import time
+
+from mark_toc import parsers
+
+REPEATS = 3
+SYNTHETIC_DOCUMENTS = 200
+SECTIONS_PER_DOCUMENT = 50
+MAX_DISAGREEMENTS_SHOWN = 10
+
+PLAIN_SECTION = """
+## Section {n}
+
+Some text with a [link](#section-{n}) and `code`.
+
+```python
+# not a heading
+print({n})
+```
+
+### Subsection {n}
+
+- item
+- item
+"""
+
+TRICKY_SECTION = """
+Section {n}
+-----------
+
+~~~
+# not a heading either
+~~~
+
+<!--
+# hidden heading
+-->
+
+    # indented code
+"""
+
+
+def _make_document(n):
+    parts = ["# Document {}\n\n[toc]: #\n".format(n)]
+    for i in range(SECTIONS_PER_DOCUMENT):
+        template = TRICKY_SECTION if (n % 4 == 0 and i % 10 == 0) else PLAIN_SECTION
+        parts.append(template.format(n=i))
+    return "".join(parts).encode("utf-8")
+
+
+def _load_corpus(paths):
+    if not paths:
+        return [("synthetic-{}.md".format(n), _make_document(n)) for n in range(SYNTHETIC_DOCUMENTS)]
+    corpus = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, _, filenames in os.walk(path):
+                corpus.extend(
+                    (os.path.join(dir_path, filename), None)
+                    for filename in sorted(filenames)
+                    if filename.endswith(".md")
+                )
+        else:
+            corpus.append((path, None))
+    loaded = []
+    for path, _ in corpus:
+        with open(path, "rb") as f:
+            loaded.append((path, f.read()))
+    return loaded
+
+
+def _summarize(scan):
+    headings = [(heading.level, heading.text, heading.line_number) for heading in scan.headings]
+    return (headings, len(scan.toc_spans))
+
+
+def _scan_corpus(parser, corpus):
+    """Scan every document; return the best time and a summary of each scan (or the error)."""
+    best = None
+    summaries = None
+    for _ in range(REPEATS):
+        results = []
+        start = time.perf_counter()
+        for path, content in corpus:
+            try:
+                results.append(parser.scan(content, filename=path))
+            except ValueError as e:
+                results.append(e)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        summaries = [result if isinstance(result, Exception) else _summarize(result) for result in results]
+    return (best, summaries)
+
+
+def main(argv):
+    """Run the benchmark and report the results."""
+    corpus = _load_corpus(argv[1:])
+    total_bytes = sum(len(content) for (_, content) in corpus)
+    print("corpus: {} documents, {:.1f} MB".format(len(corpus), total_bytes / 1e6))
+    print("{:<12} {:>10} {:>10} {:>10}".format("parser", "time (s)", "MB/s", "agreement"))
+
+    baseline = None
+    disagreements = {}
+    for name in sorted(parsers.PARSERS, key=lambda name: name != parsers.DEFAULT_PARSER):
+        if not parsers.is_available(name):
+            print("{:<12} {:>10}".format(name, "(not installed)"))
+            continue
+        (elapsed, summaries) = _scan_corpus(parsers.get_parser(name), corpus)
+        if baseline is None:
+            baseline = summaries
+        differing = [path for ((path, _), summary, expected) in zip(corpus, summaries, baseline) if summary != expected]
+        disagreements[name] = differing
+        agreement = 1.0 - len(differing) / max(len(corpus), 1)
+        print(
+            "{:<12} {:>10.3f} {:>10.1f} {:>9.1f}%".format(
+                name, elapsed, total_bytes / 1e6 / max(elapsed, 1e-9), agreement * 100
+            )
+        )
+
+    for name, differing in disagreements.items():
+        if differing:
+            print()
+            print("{} disagrees with {} on {} documents, e.g.:".format(name, parsers.DEFAULT_PARSER, len(differing)))
+            for path in differing[:MAX_DISAGREEMENTS_SHOWN]:
+                print("  {}".format(path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
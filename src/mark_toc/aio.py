@@ -0,0 +1,406 @@
+"""Update tables of contents from asyncio code, without blocking the event loop."""
+
+import asyncio
+import copy
+import io
+import time
+
+from . import headingindex, hooks, iofile, mdfile, options, parsers, report, sitetoc
+
+####################
+
+DEFAULT_CONCURRENCY = 8
+
+####################
+
+
+class TocOptions(object):
+    """
+    Hold the options for updating a table of contents, as given on the command line.
+
+    Options are given as keyword arguments; any not given keep their
+    defaults.  Options objects are passed to executors, so they must stay
+    picklable.
+
+    :Args:
+        heading_text, heading_level, skip_level, max_level
+            (optional) As for `mdfile.Toc`:py:class:
+
+        numbered, alt_list_char, add_trailing_heading_chars
+            (optional) Formatting options, as for `mdfile.Toc.format()`:py:meth:
+
+        comment
+            (optional) The comment for the "end table of contents token"
+            (default: generated afresh for each file, with a datestamp, as
+            on the command line; see `options.generate_comment()`:py:func:)
+
+        command
+            (optional) The command named in a generated comment
+
+        keep_comment
+            (optional) Whether to leave a table of contents alone if only
+            its comment differs (see '--keep-comment')
+
+        newline
+            (optional) The newline convention for output, as for
+            `mdfile.MarkdownFile`:py:class: (default: keep each file's own)
+
+        encoding
+            (optional) The encoding of files (default: see
+            `iofile.get_default_encoding()`:py:func:)
+
+        parser
+            (optional) The name of the parser backend to scan with (see
+            `parsers.get_parser()`:py:func:)
+
+        sync
+            (optional) One of `iofile.SYNC_MODES`, for writing updated files
+
+        conflict_retries
+            (optional) How many times to start again on a file which is
+            changed by something else while it is being updated
+    """
+
+    heading_text = options.DEFAULT_HEADING_TEXT
+    heading_level = options.DEFAULT_HEADING_LEVEL
+    skip_level = options.DEFAULT_SKIP_LEVEL
+    max_level = options.DEFAULT_MAX_LEVEL
+    numbered = options.DEFAULT_NUMBERED
+    alt_list_char = options.DEFAULT_ALT_LIST_CHAR
+    add_trailing_heading_chars = options.DEFAULT_ADD_TRAILING_HEADING_CHARS
+    comment = None
+    command = options.DEFAULT_COMMAND
+    keep_comment = False
+    newline = options.NEWLINE_VALUES[options.DEFAULT_NEWLINES]
+    encoding = None
+    parser = options.DEFAULT_PARSER
+    sync = options.DEFAULT_SYNC
+    conflict_retries = options.DEFAULT_CONFLICT_RETRIES
+
+    def __init__(self, **toc_options):
+        self._set_options(toc_options)
+
+    def _set_options(self, toc_options):
+        for name, value in toc_options.items():
+            if name.startswith("_") or callable(getattr(TocOptions, name, None)) or not hasattr(TocOptions, name):
+                raise TypeError("{name}: unrecognized option".format(name=name))
+            setattr(self, name, value)
+        if self.conflict_retries < 0:
+            raise ValueError("conflict_retries: must not be negative")
+        if self.encoding is None:
+            self.encoding = iofile.get_default_encoding()
+
+    def replace(self, **toc_options):
+        """Get a copy of these options, with the given options changed."""
+        new_options = copy.copy(self)
+        new_options._set_options(toc_options)
+        return new_options
+
+    def get_comment(self):
+        """Get the comment for the "end table of contents" token, generating one if needed."""
+        if self.comment is not None:
+            return self.comment
+        return options.generate_comment(self.command, with_datestamp=True)
+
+
+def _notify_render_done(md, path, options, comment, file_hooks):
+    """Format the new tables of contents, just to tell `file_hooks` how long it takes."""
+    start_time = time.perf_counter()
+    size = 0
+    for _, _, toc_text, _ in md.iter_tocs(
+        numbered=options.numbered,
+        toc_comment=comment,
+        alt_list_char=options.alt_list_char,
+        add_trailing_heading_chars=options.add_trailing_heading_chars,
+    ):
+        size += len(toc_text)
+    file_hooks.render_done(path, size, time.perf_counter() - start_time)
+
+
+def update_toc_content(
+    path,
+    content,
+    options,
+    heading_index=None,
+    build_index=False,
+    heading_cache=None,
+    file_hooks=hooks.NO_HOOKS,
+    check=False,
+):
+    """
+    Update the tables of contents in the contents of a Markdown file, without any file I/O.
+
+    This is the CPU-bound part of `update_toc_file()`:py:func:, run in its
+    executor.  Directory tables of contents do read the files they cover.
+
+    :Args:
+        path
+            The path the content was read from, for error messages and
+            directory tables of contents
+
+        content
+            The content of the file, as `bytes`
+
+        options
+            A `TocOptions`:py:class:
+
+        heading_index
+            (optional) A `headingindex.HeadingIndex`:py:class: for
+            `content`, to use instead of scanning it
+
+        build_index
+            (optional) Whether to build a new heading index for `content`,
+            if `heading_index` cannot be used
+
+        heading_cache
+            (optional) A `headingindex.HeadingIndexCache`:py:class: for the
+            files covered by directory tables of contents (only when running
+            in the same process as its owner)
+
+        file_hooks
+            (optional) A `hooks.Hooks`:py:class: to notify when the content
+            has been parsed and its tables of contents formatted
+
+        check
+            (optional) Whether the content is only being checked, as with
+            '--check': a generated comment (which contains the current
+            date) is then ignored when comparing tables of contents
+
+    :Returns:
+        A tuple of (`outcome`, `new_content`, `new_heading_index`), where
+        `outcome` is one of `report.OUTCOMES`, `new_content` is `None`
+        unless the content has changed, and `new_heading_index` is `None`
+        unless one was built
+
+    :Raises:
+        `ValueError`:py:exc: if the table of contents syntax is invalid
+    """
+    start_time = time.perf_counter()
+    binary = iofile.is_bytes_compatible_encoding(options.encoding)
+    infile = io.BytesIO(content) if binary else io.StringIO(content.decode(options.encoding), newline="")
+    md = mdfile.MarkdownFile(
+        infile=infile,
+        infilename=path,
+        encoding=options.encoding,
+        newline=options.newline,
+        parser=parsers.get_parser(options.parser),
+    )
+    md.read()
+    new_heading_index = None
+    if heading_index is not None and md.is_bytes and not md.newlines_converted:
+        # Byte offsets in the index are only valid for the text as read
+        md.set_scan(heading_index.to_scan())
+    elif build_index:
+        new_heading_index = headingindex.build_heading_index(md)
+    md.parse(
+        heading_text=options.heading_text,
+        heading_level=options.heading_level,
+        skip_level=options.skip_level,
+        max_level=options.max_level,
+    )
+    if md.scan().dir_toc_spans:
+        md.set_dir_tocs(
+            sitetoc.build_dir_tocs(
+                md,
+                path,
+                skip_level=options.skip_level,
+                max_level=options.max_level,
+                binary=md.is_bytes,
+                heading_cache=heading_cache,
+            )
+        )
+    file_hooks.parse_done(path, len(md.scan().headings), time.perf_counter() - start_time)
+    if not md.scan().has_tocs():
+        return (report.OUTCOME_SKIPPED, None, new_heading_index)
+    comment = options.get_comment()
+    if file_hooks is not hooks.NO_HOOKS:
+        _notify_render_done(md, path, options, comment, file_hooks)
+    if not md.newlines_converted and md.check(
+        numbered=options.numbered,
+        toc_comment=comment,
+        alt_list_char=options.alt_list_char,
+        add_trailing_heading_chars=options.add_trailing_heading_chars,
+        ignore_comment=options.keep_comment or (check and options.comment is None),
+    ):
+        return (report.OUTCOME_UNCHANGED, None, new_heading_index)
+    output_text = md.render(
+        numbered=options.numbered,
+        toc_comment=comment,
+        alt_list_char=options.alt_list_char,
+        add_trailing_heading_chars=options.add_trailing_heading_chars,
+        keep_comment=options.keep_comment,
+    )
+    new_content = output_text if md.is_bytes else output_text.encode(options.encoding)
+    return (report.OUTCOME_CHANGED, new_content, new_heading_index)
+
+
+def _update_toc_content_recorded(path, content, options, heading_index, build_index, record_hooks):
+    """
+    Call `update_toc_content()`:py:func: in an executor, recording any hook notifications.
+
+    :Returns:
+        A tuple of (`result`, `recorded_hooks`), where `result` is what
+        `update_toc_content()`:py:func: returned and `recorded_hooks` is a
+        `hooks.RecordingHooks`:py:class: to replay, or `None`
+    """
+    recorded_hooks = hooks.RecordingHooks() if record_hooks else None
+    file_hooks = hooks.NO_HOOKS if recorded_hooks is None else recorded_hooks
+    result = update_toc_content(path, content, options, heading_index, build_index, file_hooks=file_hooks)
+    return (result, recorded_hooks)
+
+
+async def _try_update_toc_file(path, options, executor, heading_cache, file_hooks):
+    loop = asyncio.get_running_loop()
+    start_time = time.perf_counter()
+    (content, fingerprint) = await loop.run_in_executor(None, headingindex.read_fingerprinted_file, path)
+    file_hooks.read_done(path, len(content), time.perf_counter() - start_time)
+    heading_index = None
+    if heading_cache is not None:
+        heading_index = heading_cache.get(path, fingerprint, encoding=options.encoding, parser=options.parser)
+    ((outcome, new_content, new_heading_index), recorded_hooks) = await loop.run_in_executor(
+        executor,
+        _update_toc_content_recorded,
+        path,
+        content,
+        options,
+        heading_index,
+        heading_cache is not None,
+        file_hooks is not hooks.NO_HOOKS,
+    )
+    if recorded_hooks is not None:
+        recorded_hooks.replay(file_hooks)
+    if new_heading_index is not None:
+        heading_cache.put(path, fingerprint, new_heading_index)
+    if new_content is not None:
+        if heading_cache is not None:
+            heading_cache.invalidate(path)
+        start_time = time.perf_counter()
+        # Once started, the write is finished even if we are cancelled meanwhile
+        await asyncio.shield(
+            loop.run_in_executor(None, iofile.write_file_atomically, path, new_content, options.sync, fingerprint)
+        )
+        file_hooks.write_done(path, len(new_content), time.perf_counter() - start_time)
+    return outcome
+
+
+async def _update_toc_file(path, options, executor, heading_cache, file_hooks):
+    start_time = time.perf_counter()
+    file_hooks.file_start(path)
+    try:
+        for attempt in range(options.conflict_retries + 1):
+            try:
+                outcome = await _try_update_toc_file(path, options, executor, heading_cache, file_hooks)
+                break
+            except iofile.IOFileConflictError:
+                if attempt == options.conflict_retries:
+                    raise
+    except Exception as e:
+        file_hooks.error(path, e)
+        file_hooks.file_end(path, report.OUTCOME_FAILED, time.perf_counter() - start_time)
+        raise
+    file_hooks.file_end(path, outcome, time.perf_counter() - start_time)
+    return outcome
+
+
+async def update_toc_file(
+    path, options=None, executor=None, semaphore=None, heading_cache=None, file_hooks=hooks.NO_HOOKS
+):
+    """
+    Update the tables of contents in a Markdown file in place, without blocking the event loop.
+
+    The file is read and written in the event loop's default executor, and
+    scanned and formatted in `executor`.  It is only written if its tables
+    of contents have changed, and only if nothing else has changed it
+    since it was read; if something has, it is read again, up to
+    `options.conflict_retries` times.
+
+    Cancelling the update before it starts writing leaves the file as it
+    was, and drops any work not yet started in the executors; once writing
+    has started, it finishes in the background (the file is replaced
+    atomically either way).
+
+    :Args:
+        path
+            The path of the Markdown file
+
+        options
+            (optional) A `TocOptions`:py:class: (default: the same defaults
+            as on the command line)
+
+        executor
+            (optional) A `concurrent.futures.Executor`:py:class: for the
+            CPU-bound work (see `update_toc_content()`:py:func:), e.g. a
+            `concurrent.futures.ProcessPoolExecutor`:py:class: shared by
+            the service (default: the event loop's default executor)
+
+        semaphore
+            (optional) An `asyncio.Semaphore`:py:class: to hold while
+            updating, to limit how many files are updated at once
+
+        heading_cache
+            (optional) A `headingindex.HeadingIndexCache`:py:class:, so that
+            a file which has not changed since the last update is not
+            scanned again; it is only used from the event loop, so any
+            `executor` will do
+
+        file_hooks
+            (optional) A `hooks.Hooks`:py:class: to notify as the file is
+            updated, as on the command line; it is only called from the
+            event loop
+
+    :Returns:
+        One of `report.OUTCOMES`, other than `report.OUTCOME_FAILED`
+
+    :Raises:
+        `ValueError`:py:exc: if the table of contents syntax is invalid
+
+        `OSError`:py:exc: if the file cannot be read or written
+
+        `iofile.IOFileConflictError`:py:exc: if the file kept changing
+    """
+    options = TocOptions() if options is None else options
+    if semaphore is None:
+        return await _update_toc_file(path, options, executor, heading_cache, file_hooks)
+    async with semaphore:
+        return await _update_toc_file(path, options, executor, heading_cache, file_hooks)
+
+
+async def update_toc_files(
+    paths,
+    options=None,
+    executor=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    return_exceptions=False,
+    heading_cache=None,
+    file_hooks=hooks.NO_HOOKS,
+):
+    """
+    Update the tables of contents in several Markdown files concurrently (see `update_toc_file()`:py:func:).
+
+    At most `concurrency` files are updated at once.  Cancelling the batch
+    cancels the updates of all the files.
+
+    :Args:
+        return_exceptions
+            (optional) If true, return the exception for a file that failed
+            in place of its outcome, rather than raising the first exception
+            (as for `asyncio.gather()`:py:func:)
+
+    :Returns:
+        A list of outcomes (or exceptions), in the same order as `paths`
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    return await asyncio.gather(
+        *(
+            update_toc_file(
+                path,
+                options,
+                executor=executor,
+                semaphore=semaphore,
+                heading_cache=heading_cache,
+                file_hooks=file_hooks,
+            )
+            for path in paths
+        ),
+        return_exceptions=return_exceptions,
+    )
@@ -0,0 +1,198 @@
+"""Serve table of contents requests as JSON Lines, for build systems which keep a worker process running."""
+
+import json
+import time
+
+from . import aio, headingindex, hooks, iofile, report
+
+####################
+
+CONTENT_PATH = "<content>"
+
+# The fields a request may have, besides "options"
+REQUEST_FIELDS = {"id", "path", "content", "inplace", "check", "options"}
+
+####################
+
+
+class BatchRequestError(Exception):
+    """Raise when a request is not valid."""
+
+
+def _get_request_options(request, base_options):
+    request_options = request.get("options", {})
+    if not isinstance(request_options, dict):
+        raise BatchRequestError("'options' must be an object")
+    try:
+        return base_options.replace(**request_options)
+    except TypeError as e:
+        raise BatchRequestError(str(e))
+
+
+def _check_request(request):
+    if not isinstance(request, dict):
+        raise BatchRequestError("request must be an object")
+    unknown_fields = sorted(set(request) - REQUEST_FIELDS)
+    if unknown_fields:
+        raise BatchRequestError("{}: unrecognized field".format(unknown_fields[0]))
+    if "path" not in request and "content" not in request:
+        raise BatchRequestError("request needs 'path' or 'content'")
+    if "content" in request and not isinstance(request["content"], str):
+        raise BatchRequestError("'content' must be a string")
+    if "path" in request and not isinstance(request["path"], str):
+        raise BatchRequestError("'path' must be a string")
+    if "content" in request and request.get("inplace"):
+        raise BatchRequestError("'inplace' does not make sense with 'content'")
+
+
+def _update_for_request(request, path, options, heading_cache, file_hooks, timings):
+    """Read, update and write (or not) the file for a request; return its outcome and any content to respond with."""
+    phase_start = time.perf_counter()
+    (fingerprint, heading_index) = (None, None)
+    if "content" in request:
+        content = request["content"].encode(options.encoding, errors="surrogateescape")
+    else:
+        (content, fingerprint) = headingindex.read_fingerprinted_file(path)
+        if heading_cache is not None:
+            heading_index = heading_cache.get(path, fingerprint, encoding=options.encoding, parser=options.parser)
+    timings["read"] = time.perf_counter() - phase_start
+    file_hooks.read_done(path, len(content), timings["read"])
+
+    phase_start = time.perf_counter()
+    (outcome, new_content, new_heading_index) = aio.update_toc_content(
+        path,
+        content,
+        options,
+        heading_index=heading_index,
+        build_index=fingerprint is not None and heading_cache is not None,
+        heading_cache=heading_cache,
+        file_hooks=file_hooks,
+        check=bool(request.get("check")),
+    )
+    timings["update"] = time.perf_counter() - phase_start
+    if new_heading_index is not None:
+        heading_cache.put(path, fingerprint, new_heading_index)
+
+    if new_content is None or request.get("check"):
+        return (outcome, None)
+    if not request.get("inplace"):
+        return (outcome, new_content.decode(options.encoding, errors="surrogateescape"))
+    phase_start = time.perf_counter()
+    if heading_cache is not None:
+        heading_cache.invalidate(path)
+    iofile.write_file_atomically(path, new_content, options.sync, fingerprint)
+    timings["write"] = time.perf_counter() - phase_start
+    file_hooks.write_done(path, len(new_content), timings["write"])
+    return (outcome, None)
+
+
+def handle_request(request, base_options, heading_cache=None, file_hooks=hooks.NO_HOOKS):
+    """
+    Update the tables of contents for one request, and describe the result.
+
+    A request is an object with these fields:
+
+    - ``id``: (optional) Anything, copied to the response
+    - ``path``: The path of a Markdown file to update
+    - ``content``: The content of a Markdown file, instead of reading
+      ``path`` (which, if also given, is used for error messages and
+      directory tables of contents)
+    - ``inplace``: (optional) If true, write the updated file in place
+      rather than returning its content; if something else changes the
+      file meanwhile, it is read again (see ``conflict_retries`` in
+      `aio.TocOptions`:py:class:)
+    - ``check``: (optional) If true, only report whether the file would
+      change
+    - ``options``: (optional) An object with any of the options of
+      `aio.TocOptions`:py:class:, overriding those given on the command
+      line (e.g. ``{"skip_level": 1}``)
+
+    :Args:
+        base_options
+            The `aio.TocOptions`:py:class: to start from
+
+        heading_cache
+            (optional) A `headingindex.HeadingIndexCache`:py:class: kept
+            between requests, so unchanged files are not scanned again
+
+        file_hooks
+            (optional) A `hooks.Hooks`:py:class: to notify
+
+    :Returns:
+        The response, as an object with the fields ``id``, ``outcome`` (one
+        of `report.OUTCOMES`), ``changed``, ``content`` (the updated
+        content, if it changed and was neither written nor only checked;
+        else ``null``), ``timings`` (seconds spent reading, updating and
+        writing) and ``error`` (a message, or ``null``)
+    """
+    response = {"id": request.get("id") if isinstance(request, dict) else None}
+    timings = {"read": 0.0, "update": 0.0, "write": 0.0}
+    path = request.get("path", CONTENT_PATH) if isinstance(request, dict) else CONTENT_PATH
+    start_time = time.perf_counter()
+    file_hooks.file_start(path)
+    try:
+        _check_request(request)
+        options = _get_request_options(request, base_options)
+
+        for attempt in range(options.conflict_retries + 1):
+            try:
+                (outcome, response_content) = _update_for_request(
+                    request, path, options, heading_cache, file_hooks, timings
+                )
+                break
+            except iofile.IOFileConflictError:
+                # Something else changed the file meanwhile; start again with its new content
+                if attempt == options.conflict_retries:
+                    raise
+    except (BatchRequestError, iofile.IOFileError, LookupError, OSError, RuntimeError, TypeError, ValueError) as e:
+        # e.g. a bad option value; report it, and carry on with the next request
+        file_hooks.error(path, e)
+        file_hooks.file_end(path, report.OUTCOME_FAILED, time.perf_counter() - start_time)
+        response.update(outcome=report.OUTCOME_FAILED, changed=False, content=None, timings=timings, error=str(e))
+        return response
+    file_hooks.file_end(path, outcome, time.perf_counter() - start_time)
+    response.update(
+        outcome=outcome,
+        changed=outcome == report.OUTCOME_CHANGED,
+        content=response_content,
+        timings=timings,
+        error=None,
+    )
+    return response
+
+
+def serve(infile, outfile, base_options, heading_cache=None, file_hooks=hooks.NO_HOOKS):
+    """
+    Read requests from `infile` and write responses to `outfile`, one JSON object per line, until end of file.
+
+    Each response is flushed as soon as it is written, and responses come
+    in the same order as requests.  A line which is not valid JSON gets a
+    response with only an ``error``; blank lines are ignored.
+
+    :Args:
+        infile
+            A binary file to read requests from (e.g. ``sys.stdin.buffer``)
+
+        outfile
+            A text file to write responses to; responses are pure ASCII
+
+        base_options, heading_cache, file_hooks
+            See `handle_request()`:py:func:
+
+    :Returns:
+        The number of requests handled
+    """
+    count = 0
+    for line in infile:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {"id": None, "error": "invalid request: {}".format(e)}
+        else:
+            response = handle_request(request, base_options, heading_cache=heading_cache, file_hooks=file_hooks)
+        outfile.write(json.dumps(response) + "\n")
+        outfile.flush()
+        count += 1
+    return count
@@ -2,14 +2,37 @@
 
 from __future__ import print_function
 
-import datetime
+import argparse
+import codecs
+import concurrent.futures
+import contextlib
 import difflib
 import os.path
 import sys
+import time
 
 import argcomplete
 
-from . import argparsing, completion, get_version, iofile, mdfile
+from . import (
+    aio,
+    argparsing,
+    batch,
+    completion,
+    get_version,
+    headingindex,
+    hooks,
+    iofile,
+    links,
+    mdfile,
+    options,
+    parsers,
+    patch,
+    progress,
+    renderers,
+    report,
+    sitetoc,
+    staged,
+)
 
 ####################
 
@@ -19,15 +42,12 @@ STATUS_CHANGED = 99
 
 DIFF_CONTEXT_LINES = 3
 
-NEWLINE_FORMAT_LINUX = "linux"
-NEWLINE_FORMAT_MICROSOFT = "microsoft"
-NEWLINE_FORMAT_NATIVE = "native"
+NEWLINE_FORMAT_LINUX = options.NEWLINE_FORMAT_LINUX
+NEWLINE_FORMAT_MICROSOFT = options.NEWLINE_FORMAT_MICROSOFT
+NEWLINE_FORMAT_NATIVE = options.NEWLINE_FORMAT_NATIVE
+NEWLINE_FORMAT_PRESERVE = options.NEWLINE_FORMAT_PRESERVE
 
-NEWLINE_FORMATS = [
-    NEWLINE_FORMAT_LINUX,
-    NEWLINE_FORMAT_MICROSOFT,
-    NEWLINE_FORMAT_NATIVE,
-]
+NEWLINE_FORMATS = options.NEWLINE_FORMATS
 
 NEWLINE_FORMAT_ALIAS_DOS = "dos"
 NEWLINE_FORMAT_ALIAS_MACOS = "macos"
@@ -43,39 +63,44 @@ NEWLINE_FORMAT_ALIASES = {
     NEWLINE_FORMAT_ALIAS_WINDOWS: NEWLINE_FORMAT_MICROSOFT,
 }
 
+SIZE_SUFFIXES = {
+    "k": 1024,
+    "m": 1024 * 1024,
+    "g": 1024 * 1024 * 1024,
+}
+
 ALL_NEWLINE_FORMATS = sorted(NEWLINE_FORMATS + list(NEWLINE_FORMAT_ALIASES.keys()))
 
-NEWLINE_VALUES = {
-    NEWLINE_FORMAT_LINUX: "\n",
-    NEWLINE_FORMAT_MICROSOFT: "\r\n",
-    NEWLINE_FORMAT_NATIVE: None,
-}
+NEWLINE_VALUES = options.NEWLINE_VALUES
 
-DEFAULT_NEWLINES = NEWLINE_FORMAT_NATIVE
-DEFAULT_HEADING_TEXT = "Contents"
-DEFAULT_HEADING_LEVEL = 1
-DEFAULT_ADD_TRAILING_HEADING_CHARS = False
-DEFAULT_ALT_LIST_CHAR = False
-DEFAULT_NUMBERED = False
-DEFAULT_SKIP_LEVEL = 0
-DEFAULT_MAX_LEVEL = 0
+DEFAULT_NEWLINES = options.DEFAULT_NEWLINES
+DEFAULT_SYNC = options.DEFAULT_SYNC
+DEFAULT_CONFLICT_RETRIES = options.DEFAULT_CONFLICT_RETRIES
+DEFAULT_JOBS = 1
+DEFAULT_PARALLEL_SCAN_SIZE = mdfile.DEFAULT_PARALLEL_SCAN_SIZE
+DEFAULT_HEADING_TEXT = options.DEFAULT_HEADING_TEXT
+DEFAULT_HEADING_LEVEL = options.DEFAULT_HEADING_LEVEL
+DEFAULT_ADD_TRAILING_HEADING_CHARS = options.DEFAULT_ADD_TRAILING_HEADING_CHARS
+DEFAULT_ALT_LIST_CHAR = options.DEFAULT_ALT_LIST_CHAR
+DEFAULT_NUMBERED = options.DEFAULT_NUMBERED
+DEFAULT_SKIP_LEVEL = options.DEFAULT_SKIP_LEVEL
+DEFAULT_MAX_LEVEL = options.DEFAULT_MAX_LEVEL
+DEFAULT_LIST_FORMAT = renderers.RENDERER_JSON
+DEFAULT_PARSER = options.DEFAULT_PARSER
 
 
 ####################
 
 
-def _generate_comment(prog, argv, suffix="", with_full_command=False, with_datestamp=False):
+def _get_command(prog, argv, with_full_command=False):
     if with_full_command:
-        command = "'" + " ".join(argv) + "'"
-    else:
-        command = os.path.basename(prog)
-    datestamp = "".join([datetime.datetime.utcnow().isoformat(), "Z"])
-    if with_datestamp:
-        template = "Generated by {command} on {datestamp}{suffix}"
-    else:
-        template = "Generated by {command}{suffix}"
-    comment_text = template.format(command=command, datestamp=datestamp, suffix=suffix)
-    return comment_text
+        return "'" + " ".join(argv) + "'"
+    return os.path.basename(prog)
+
+
+def _generate_comment(prog, argv, suffix="", with_full_command=False, with_datestamp=False):
+    command = _get_command(prog, argv, with_full_command=with_full_command)
+    return options.generate_comment(command, suffix=suffix, with_datestamp=with_datestamp)
 
 
 def _compute_diff(filename, input_text, output_text, context_lines=DIFF_CONTEXT_LINES):
@@ -121,6 +146,160 @@ def _add_file_arguments(parser):
         action="store_true",
         help="write changes to input file in place",
     )
+    parser.add_argument(
+        "--output-dir",
+        action="store",
+        dest="output_dir",
+        default=None,
+        metavar="OUTPUTDIR",
+        help=(
+            "write each input file to the same relative path under OUTPUTDIR, creating directories as needed; "
+            "files without tables of contents are copied as they are (conflicts with '--inplace' and '--output')"
+        ),
+    )
+    parser.add_argument(
+        "--link-unchanged",
+        action="store_true",
+        default=False,
+        help="when used with '--output-dir', hard-link files without tables of contents instead of copying them",
+    )
+    parser.add_argument(
+        "--staged",
+        action="store_true",
+        default=False,
+        help=(
+            "read input files as staged in the git index (default: all staged Markdown files); "
+            "use with '--check', '--patch', or '--inplace' to stage the updated files"
+        ),
+    )
+    parser.add_argument(
+        "--sync",
+        action="store",
+        choices=iofile.SYNC_MODES,
+        default=DEFAULT_SYNC,
+        help=(
+            "when used with '--inplace', how to flush updated files to disk: "
+            "'{none}' leaves it to the OS, '{file}' syncs each file as it is replaced, "
+            "'{batch}' syncs once after all files are written (default: {default})"
+        ).format(
+            none=iofile.SYNC_NONE,
+            file=iofile.SYNC_FILE,
+            batch=iofile.SYNC_BATCH,
+            default=DEFAULT_SYNC,
+        ),
+    )
+    parser.add_argument(
+        "--conflict-retries",
+        action="store",
+        type=int,
+        default=DEFAULT_CONFLICT_RETRIES,
+        metavar="N",
+        help=(
+            "when used with '--inplace', how many times to start again on a file which is changed "
+            "by something else while it is being updated, before reporting a conflict and "
+            "leaving it alone (default: {default})"
+        ).format(default=DEFAULT_CONFLICT_RETRIES),
+    )
+
+
+def _parse_size(value):
+    """Parse a size in bytes, with an optional 'k', 'm' or 'g' suffix (for use as an argparse type)."""
+    multiplier = SIZE_SUFFIXES.get(value[-1:].lower(), 1)
+    digits = value[:-1] if multiplier > 1 else value
+    try:
+        size = int(digits) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: '{}'".format(value)) from None
+    if size < 0:
+        raise argparse.ArgumentTypeError("invalid size: '{}'".format(value))
+    return size
+
+
+def _add_performance_arguments(parser):
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        default=DEFAULT_JOBS,
+        metavar="N",
+        help="number of worker processes to use, or 0 for one per CPU (default: {default})".format(
+            default=DEFAULT_JOBS
+        ),
+    )
+    parser.add_argument(
+        "--parallel-scan-size",
+        action="store",
+        type=_parse_size,
+        default=DEFAULT_PARALLEL_SCAN_SIZE,
+        metavar="SIZE",
+        help=(
+            "with '--jobs', scan a single file in parallel chunks if it is at least SIZE bytes "
+            "(suffixes 'k', 'm', 'g' allowed; default: {default})"
+        ).format(default=DEFAULT_PARALLEL_SCAN_SIZE),
+    )
+    parser.add_argument(
+        "--index-cache",
+        action="store",
+        default=None,
+        metavar="CACHEDIR",
+        help=(
+            "save an index of each file's headings, tables of contents and code fences in CACHEDIR, "
+            "keyed by content hash, and reuse it instead of scanning unchanged files"
+        ),
+    )
+    parser.add_argument(
+        "--parser",
+        action="store",
+        choices=sorted(parsers.PARSERS),
+        default=DEFAULT_PARSER,
+        help=(
+            "how to find headings and code blocks: '{regex}' is fast, '{commonmark}' follows the CommonMark spec "
+            "(e.g. 'setext' headings, '~~~' fences, HTML blocks) but is slower and needs the '{package}' package "
+            "(default: {default})"
+        ).format(
+            regex=parsers.PARSER_REGEX,
+            commonmark=parsers.PARSER_COMMONMARK,
+            package=parsers.COMMONMARK_PACKAGE,
+            default=DEFAULT_PARSER,
+        ),
+    )
+
+
+def _add_report_arguments(parser):
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        default=False,
+        help="show progress, throughput and ETA on stderr while running (only if it is a terminal)",
+    )
+    parser.add_argument(
+        "--report",
+        action="store",
+        default=None,
+        metavar="REPORTFILE",
+        help="write statistics for the run to REPORTFILE, or '-' for stdout",
+    )
+    parser.add_argument(
+        "--report-format",
+        action="store",
+        choices=report.REPORT_FORMATS,
+        default=None,
+        help=(
+            "format for '--report': '{json}' or JSON Lines ('{jsonl}') "
+            "(default: '{jsonl}' if REPORTFILE ends in '.jsonl', else '{json}')"
+        ).format(json=report.REPORT_FORMAT_JSON, jsonl=report.REPORT_FORMAT_JSON_LINES),
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store",
+        default=None,
+        metavar="METRICSFILE",
+        help=(
+            "write counters and histograms for the run to METRICSFILE in Prometheus text format "
+            "(e.g. for the node exporter's textfile collector)"
+        ),
+    )
 
 
 def _add_diff_arguments(parser):
@@ -143,6 +322,74 @@ def _add_diff_arguments(parser):
         default=False,
         help="when used with '--inplace', show differences when a file has changed",
     )
+    diff_mutex_group.add_argument(
+        "--check",
+        action="store_true",
+        default=False,
+        help=(
+            "check whether tables of contents are up to date without writing anything; "
+            "exit with status {changed} if any are not (conflicts with '--inplace' and '--output')"
+        ).format(changed=STATUS_CHANGED),
+    )
+    diff_mutex_group.add_argument(
+        "--patch",
+        action="store",
+        nargs="?",
+        const="-",
+        default=None,
+        metavar="PATCHFILE",
+        help=(
+            "without changing any input files, write a patch for 'git apply' with the changes "
+            "to PATCHFILE, or '-' for stdout (default: stdout); "
+            "exit with status {changed} if there are any (conflicts with '--inplace' and '--output')"
+        ).format(changed=STATUS_CHANGED),
+    )
+    diff_mutex_group.add_argument(
+        "--check-links",
+        action="store_true",
+        default=False,
+        help=(
+            "without writing anything, check that every link to a heading in the input files "
+            "(including tables of contents, and links like 'file.md#anchor') refers to a heading that exists; "
+            "list dangling links and exit with status {failure} if there are any "
+            "(conflicts with '--inplace' and '--output')"
+        ).format(failure=STATUS_FAILURE),
+    )
+    diff_mutex_group.add_argument(
+        "--list-headings",
+        action="store_true",
+        default=False,
+        help=(
+            "without changing any input files, write the headings which would be in each table of contents "
+            "to OUTPUTFILE (default: stdout) in the format given by '--list-format' (conflicts with '--inplace')"
+        ),
+    )
+    diff_mutex_group.add_argument(
+        "--batch-stdio",
+        action="store_true",
+        default=False,
+        help=(
+            "keep running as a worker: read JSON requests from stdin, one per line, each with a 'path' "
+            "or 'content' and any 'options' overriding those given here, and write a JSON response for each "
+            "to stdout (conflicts with input files, '--inplace' and '--output')"
+        ),
+    )
+    parser.add_argument(
+        "--list-format",
+        action="store",
+        choices=sorted(renderers.RENDERERS),
+        default=DEFAULT_LIST_FORMAT,
+        help="format for '--list-headings' (default: {default})".format(default=DEFAULT_LIST_FORMAT),
+    )
+    parser.add_argument(
+        "--ignore-comment",
+        action="store_true",
+        default=False,
+        help=(
+            "when used with '--check', ignore the end-of-toc comment "
+            "(always ignored when it is the default comment with a datestamp)"
+        ),
+    )
 
 
 def _add_newline_arguments(parser):
@@ -179,6 +426,14 @@ def _add_newline_arguments(parser):
         const=NEWLINE_FORMAT_NATIVE,
         help="same as '--newlines {}'".format(NEWLINE_FORMAT_NATIVE),
     )
+    newlines_mutex_group.add_argument(
+        "-P",
+        "--preserve",
+        dest="newlines",
+        action="store_const",
+        const=NEWLINE_FORMAT_PRESERVE,
+        help="same as '--newlines {}' (keep each file's own newline format)".format(NEWLINE_FORMAT_PRESERVE),
+    )
 
 
 def _add_heading_arguments(parser):
@@ -264,6 +519,16 @@ def _add_comment_arguments(parser):
         const="",
         help="Do not add any comment to Markdown source",
     )
+    parser.add_argument(
+        "-K",
+        "--keep-comment",
+        action="store_true",
+        default=False,
+        help=(
+            "Keep an existing comment unless the table of contents has changed, "
+            "so a datestamp in it changes only when the headings do"
+        ),
+    )
     return comment_arg_group
 
 
@@ -302,6 +567,8 @@ def _setup_args(argv):
     _add_option_arguments(parser)
     _add_comment_arguments(parser)
     _add_pre_commit_arguments(parser)
+    _add_performance_arguments(parser)
+    _add_report_arguments(parser)
     _add_completion_arguments(parser)
     parser.add_argument("-V", "--version", action="version", version=get_version(prog))
 
@@ -323,11 +590,107 @@ def _normalize_path(path):
     return path
 
 
+def _check_staged_args(cli_args):
+    if not cli_args.staged:
+        return
+    if not (cli_args.check or cli_args.patch is not None or cli_args.inplace):
+        raise RuntimeError("'--staged' needs one of '--check', '--patch', or '--inplace'")
+    if "-" in cli_args.input_filenames:
+        raise RuntimeError("reading from stdin does not make sense with '--staged'")
+
+
+def _check_read_only_args(cli_args):
+    """
+    Check args for the modes which do not change input files (e.g. '--check').
+
+    :Returns:
+        `True` if one of these modes was requested, else `False`
+    """
+    if cli_args.list_headings:
+        if cli_args.inplace:
+            raise RuntimeError("'--list-headings' does not make sense with '--inplace'")
+        if cli_args.output_filename is None:
+            cli_args.output_filename = "-"  # default to stdout
+        return True
+    if not (cli_args.check or cli_args.patch is not None or cli_args.check_links):
+        return False
+    option = "--check" if cli_args.check else "--patch" if cli_args.patch is not None else "--check-links"
+    if cli_args.inplace:
+        raise RuntimeError("'{option}' does not make sense with '--inplace'".format(option=option))
+    if cli_args.output_filename is not None:
+        raise RuntimeError("output files do not make sense with '{option}'".format(option=option))
+    if option != "--check" and "-" in cli_args.input_filenames:
+        raise RuntimeError("reading from stdin does not make sense with '{option}'".format(option=option))
+    return True
+
+
+def _check_batch_args(cli_args):
+    """
+    Check args for '--batch-stdio'.
+
+    :Returns:
+        `True` if '--batch-stdio' was requested, else `False`
+    """
+    if not cli_args.batch_stdio:
+        return False
+    if cli_args.input_filenames or cli_args.staged:
+        raise RuntimeError("input files do not make sense with '--batch-stdio'; send requests on stdin")
+    if cli_args.inplace or cli_args.output_filename is not None:
+        raise RuntimeError("'--inplace' and '--output' do not make sense with '--batch-stdio'")
+    return True
+
+
+def _get_output_dir_conflicts(cli_args):
+    return [
+        ("--inplace", cli_args.inplace),
+        ("--output", cli_args.output_filename is not None),
+        ("--staged", cli_args.staged),
+        ("--check", cli_args.check),
+        ("--patch", cli_args.patch is not None),
+        ("--check-links", cli_args.check_links),
+        ("--list-headings", cli_args.list_headings),
+        ("--batch-stdio", cli_args.batch_stdio),
+    ]
+
+
+def _check_output_dir_args(cli_args):
+    """
+    Check args for '--output-dir'.
+
+    :Returns:
+        `True` if '--output-dir' was requested, else `False`
+    """
+    if cli_args.output_dir is None:
+        if cli_args.link_unchanged:
+            raise RuntimeError("'--link-unchanged' only makes sense with '--output-dir'")
+        return False
+    for option, requested in _get_output_dir_conflicts(cli_args):
+        if requested:
+            raise RuntimeError("'{option}' does not make sense with '--output-dir'".format(option=option))
+    if not cli_args.input_filenames or "-" in cli_args.input_filenames:
+        raise RuntimeError("'--output-dir' needs input files; reading from stdin does not make sense with it")
+    if os.path.realpath(cli_args.output_dir) == os.path.realpath(os.curdir):
+        raise RuntimeError("output directory is the current directory; use '--inplace' to modify files in place")
+    for input_filename in cli_args.input_filenames:
+        relative_path = os.path.relpath(input_filename)
+        if relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+            raise RuntimeError(
+                "{}: not within the current directory, so it has no place in the output directory".format(
+                    input_filename
+                )
+            )
+    return True
+
+
 def _check_input_and_output_filenames(cli_args):
     """Check args found by `argparse.ArgumentParser`:py:class: and regularize."""
-    if len(cli_args.input_filenames) == 0:
+    if _check_batch_args(cli_args) or _check_output_dir_args(cli_args):
+        return
+    if len(cli_args.input_filenames) == 0 and not cli_args.staged:
         cli_args.input_filenames.append("-")  # default to stdin
 
+    if _check_read_only_args(cli_args):
+        return
     if not cli_args.inplace:
         if cli_args.output_filename is None:
             cli_args.output_filename = "-"  # default to stdout
@@ -365,6 +728,29 @@ def _check_pre_commit_args(cli_args):
         cli_args.show_changed = True
 
 
+def _check_sync_args(cli_args):
+    if cli_args.sync != iofile.SYNC_NONE and not cli_args.inplace:
+        raise RuntimeError("'--sync' only makes sense with '--inplace'")
+
+
+def _check_conflict_args(cli_args):
+    if cli_args.conflict_retries < 0:
+        raise RuntimeError("'--conflict-retries' must not be negative")
+    if cli_args.conflict_retries != DEFAULT_CONFLICT_RETRIES and not (cli_args.inplace or cli_args.batch_stdio):
+        raise RuntimeError("'--conflict-retries' only makes sense with '--inplace' or '--batch-stdio'")
+
+
+def _check_jobs_args(cli_args):
+    if cli_args.jobs < 0:
+        raise RuntimeError("'-j/--jobs' must not be negative")
+    if cli_args.jobs == 0:
+        cli_args.jobs = os.cpu_count() or 1
+
+
+def _check_parser_args(cli_args):
+    parsers.get_parser(cli_args.parser)  # raises `RuntimeError` if not installed
+
+
 def _check_diff_args(cli_args):
     if cli_args.show_changed and not cli_args.inplace:
         raise RuntimeError("'-C/--show-changed' only makes sense with '--inplace'")
@@ -372,8 +758,29 @@ def _check_diff_args(cli_args):
         raise RuntimeError("'-D/--show-diff' only makes sense with '--inplace'")
 
 
+def _check_ignore_comment_args(cli_args):
+    if cli_args.ignore_comment and not cli_args.check:
+        raise RuntimeError("'--ignore-comment' only makes sense with '--check'")
+    if cli_args.check and cli_args.comment is None and not cli_args.pre_commit:
+        cli_args.ignore_comment = True  # default comment has a datestamp
+
+
+def _can_splice(input_iofile, output_iofile, md):
+    """Check whether unchanged input can be copied byte-for-byte to the output."""
+    if "-" in {input_iofile.path, output_iofile.path}:
+        return False
+    return md.can_splice()
+
+
+def _decode_for_display(text, encoding):
+    if isinstance(text, bytes):
+        return text.decode(encoding, errors="replace")
+    return text
+
+
 def _set_default_comment(cli_args, prog, argv):
-    if cli_args.comment is not None:
+    if cli_args.comment is not None or cli_args.batch_stdio:
+        # With '--batch-stdio', the comment is generated for each request (see `_serve_batch()`:py:func:)
         return
     cli_args.comment = (
         _generate_comment(prog, argv, suffix=" pre-commit hook")
@@ -382,87 +789,814 @@ def _set_default_comment(cli_args, prog, argv):
     )
 
 
-def main(*argv):
-    """Do the thing."""
-    (prog, args) = _setup_args(argv)
+def _combine_status(overall_status, file_status):
+    """Combine a file's status into the overall status; failure beats change beats success."""
+    if STATUS_FAILURE in {overall_status, file_status}:
+        return STATUS_FAILURE
+    if STATUS_CHANGED in {overall_status, file_status}:
+        return STATUS_CHANGED
+    return STATUS_SUCCESS
 
-    if _check_completion_args(args):
-        _do_completion(args, prog)
-        return STATUS_SUCCESS
 
-    _check_pre_commit_args(args)
-    _check_diff_args(args)
-    _check_newlines(args)
-    _check_input_and_output_filenames(args)
-    _set_default_comment(args, prog, argv)
+def _load_heading_index(cli_args, md):
+    """
+    Reuse a saved heading index for a file, if there is one (see '--index-cache').
+
+    :Returns:
+        The file's content hash if a new index should be saved, else `None`
+    """
+    if cli_args.index_cache is None:
+        return None
+    content_hash = headingindex.get_content_hash(md.input_text, md.encoding)
+    heading_index = headingindex.load_heading_index(
+        cli_args.index_cache, content_hash, encoding=md.encoding, parser=md.parser_name
+    )
+    if heading_index is None:
+        return content_hash
+    if md.is_bytes and not md.newlines_converted:
+        # Byte offsets in the index are only valid for the text as read
+        md.set_scan(heading_index.to_scan())
+    return None
+
+
+def _build_dir_tocs(cli_args, md, path, jobs=None):
+    """Fill in the directory tables of contents in a file (see `sitetoc.build_dir_tocs()`:py:func:)."""
+    md.set_dir_tocs(
+        sitetoc.build_dir_tocs(
+            md,
+            path,
+            skip_level=cli_args.skip_level,
+            max_level=cli_args.max_level,
+            binary=md.is_bytes,
+            cache_dir=cli_args.index_cache,
+            jobs=cli_args.jobs if jobs is None else jobs,
+        )
+    )
 
-    overall_status = STATUS_SUCCESS
 
-    for input_filename in args.input_filenames:
-        file_status = STATUS_SUCCESS
+def _read_markdown(cli_args, input_iofile, encoding, file_hooks, jobs=None):
+    """Read and parse an input file; return the `MarkdownFile` and any syntax error."""
+    input_iofile.open_for_input()
+    md = mdfile.MarkdownFile(
+        infile=input_iofile.file,
+        infilename=input_iofile.printable_name,
+        encoding=encoding,
+        newline=NEWLINE_VALUES[cli_args.newlines],
+        jobs=cli_args.jobs if jobs is None else jobs,
+        parallel_scan_size=cli_args.parallel_scan_size,
+        parser=parsers.get_parser(cli_args.parser),
+    )
+
+    error = None
+    try:
+        start_time = time.perf_counter()
+        md.read()
+        file_hooks.read_done(input_iofile.path, len(md.input_text), time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        content_hash = _load_heading_index(cli_args, md)
+        md.parse(
+            heading_text=cli_args.heading_text,
+            heading_level=cli_args.heading_level,
+            skip_level=cli_args.skip_level,
+            max_level=cli_args.max_level,
+        )
+        if content_hash is not None:
+            headingindex.save_heading_index(cli_args.index_cache, headingindex.build_heading_index(md, content_hash))
+        if md.scan().dir_toc_spans:
+            _build_dir_tocs(cli_args, md, input_iofile.path, jobs)
+        file_hooks.parse_done(input_iofile.path, len(md.scan().headings), time.perf_counter() - start_time)
+    except (TypeError, ValueError) as e:
+        error = e
+
+    input_iofile.close()
+    return (md, error)
+
+
+def _render_toc(cli_args, md, path, file_hooks):
+    """Format the new tables of contents, if the file has any (see `mdfile.MarkdownFile.iter_tocs()`:py:meth:)."""
+    if not md.scan().has_tocs():
+        return
+    start_time = time.perf_counter()
+    size = 0
+    for _, _, toc_text, _ in md.iter_tocs(
+        numbered=cli_args.numbered,
+        toc_comment=cli_args.comment,
+        alt_list_char=cli_args.alt_list_char,
+        add_trailing_heading_chars=cli_args.add_trailing_heading_chars,
+    ):
+        size += len(toc_text)
+    file_hooks.render_done(path, size, time.perf_counter() - start_time)
+
+
+def _get_outcome(md, changed):
+    if not md.scan().has_tocs():
+        return report.OUTCOME_SKIPPED
+    return report.OUTCOME_CHANGED if changed else report.OUTCOME_UNCHANGED
+
+
+def _check_markdown(cli_args, md):
+    """Check whether the tables of contents in a file are up to date (see '--check')."""
+    if not md.newlines_converted and md.check(
+        numbered=cli_args.numbered,
+        toc_comment=cli_args.comment,
+        alt_list_char=cli_args.alt_list_char,
+        add_trailing_heading_chars=cli_args.add_trailing_heading_chars,
+        ignore_comment=cli_args.ignore_comment,
+    ):
+        return STATUS_SUCCESS
+    print("Out of date: {}".format(md.filename), file=sys.stderr)
+    return STATUS_CHANGED
+
+
+def _is_unchanged(cli_args, md):
+    """Check whether updating a file would leave it exactly as it is."""
+    return not md.newlines_converted and md.check(
+        numbered=cli_args.numbered,
+        toc_comment=cli_args.comment,
+        alt_list_char=cli_args.alt_list_char,
+        add_trailing_heading_chars=cli_args.add_trailing_heading_chars,
+        ignore_comment=cli_args.keep_comment,
+    )
+
+
+def _write_markdown(cli_args, md, input_iofile, output_iofile):
+    """Write a file with its updated table of contents; return the size written."""
+    output_iofile.open_for_output()
+
+    try:
+        if _can_splice(input_iofile, output_iofile, md):
+            with open(input_iofile.path, "rb") as source:
+                size = md.splice(
+                    src_fd=source.fileno(),
+                    dst_fd=output_iofile.file.fileno(),
+                    numbered=cli_args.numbered,
+                    toc_comment=cli_args.comment,
+                    alt_list_char=cli_args.alt_list_char,
+                    add_trailing_heading_chars=cli_args.add_trailing_heading_chars,
+                    keep_comment=cli_args.keep_comment,
+                )
+        else:
+            size = md.write(
+                numbered=cli_args.numbered,
+                toc_comment=cli_args.comment,
+                alt_list_char=cli_args.alt_list_char,
+                add_trailing_heading_chars=cli_args.add_trailing_heading_chars,
+                outfile=output_iofile.file,
+                keep_comment=cli_args.keep_comment,
+            )
+    except BaseException:
+        output_iofile.discard()
+        raise
+
+    output_iofile.close()
+    return size
+
+
+def _show_changes(cli_args, md, output_iofile, encoding):
+    """Report whether an updated file has changed (see '--show-changed' and '--show-diff')."""
+    file_status = STATUS_SUCCESS
+    output_iofile.open_for_input()
+    output_text = output_iofile.file.read()
+    if md.input_text != output_text:
+        file_status = STATUS_CHANGED
+        print(
+            "Updated {}".format(output_iofile.file.name),
+            file=sys.stderr,
+        )
+        if cli_args.show_diff:
+            for line in _compute_diff(
+                output_iofile.file.name,
+                _decode_for_display(md.input_text, encoding),
+                _decode_for_display(output_text, encoding),
+            ):
+                print(line)
+    output_iofile.close()
+    return file_status
+
+
+def _stage_markdown(cli_args, md, staged_file, staged_index, encoding):
+    """Stage a file with its updated table of contents (see '--staged'); return the status and size written."""
+    output_text = md.render(
+        numbered=cli_args.numbered,
+        toc_comment=cli_args.comment,
+        alt_list_char=cli_args.alt_list_char,
+        add_trailing_heading_chars=cli_args.add_trailing_heading_chars,
+        keep_comment=cli_args.keep_comment,
+    )
+    output_data = output_text if md.is_bytes else output_text.encode(encoding)
+    if output_data == staged_file.data:
+        return (STATUS_SUCCESS, len(output_text))
+    if not staged_index.stage(staged_file, output_data):
+        print(
+            "Staged {}; working tree copy has unstaged changes and was left alone".format(staged_file.path),
+            file=sys.stderr,
+        )
+    if not (cli_args.show_changed or cli_args.show_diff):
+        return (STATUS_SUCCESS, len(output_text))
+    print("Updated {}".format(staged_file.path), file=sys.stderr)
+    if cli_args.show_diff:
+        for line in _compute_diff(
+            staged_file.path,
+            _decode_for_display(md.input_text, encoding),
+            _decode_for_display(output_text, encoding),
+        ):
+            print(line)
+    return (STATUS_CHANGED, len(output_text))
+
+
+def _update_file(cli_args, input_filename, encoding, binary, file_hooks, input_iofile=None, staged_index=None):
+    """
+    Update, or check, one input file.
+
+    :Args:
+        input_iofile
+            (optional) The input to read, if not `input_filename` itself
+            (e.g. a `staged.StagedFile`:py:class:)
+
+        staged_index
+            (optional) A `staged.StagedIndex`:py:class: to stage the
+            updated file in, instead of writing it
+
+    :Returns:
+        A tuple of (`file_status`, `outcome`, `written`), where `written` is
+        true if the file was replaced in place
+    """
+    if input_iofile is None:
         input_iofile = iofile.TextIOFile(
             input_filename,
             input_newline="",
-            output_newline=NEWLINE_VALUES[args.newlines],
+            output_newline="",
+            atomic=cli_args.inplace,
+            sync=cli_args.sync,
+            encoding=encoding,
+            binary=binary,
         )
-        output_iofile = (
-            input_iofile
-            if args.inplace
-            else iofile.TextIOFile(
-                args.output_filename,
-                input_newline="",
-                output_newline=NEWLINE_VALUES[args.newlines],
-            )
+
+    (md, error) = _read_markdown(cli_args, input_iofile, encoding, file_hooks)
+    if error is not None:
+        file_hooks.error(input_filename, error)
+        if not (cli_args.inplace or cli_args.check):
+            raise SystemExit(error)
+        print(error, file=sys.stderr)
+        return (STATUS_FAILURE, report.OUTCOME_FAILED, False)
+
+    _render_toc(cli_args, md, input_filename, file_hooks)
+
+    if cli_args.check:
+        file_status = _check_markdown(cli_args, md)
+        return (file_status, _get_outcome(md, file_status == STATUS_CHANGED), False)
+
+    # Only compare when something needs to know
+    changed = not _is_unchanged(cli_args, md) if (cli_args.keep_comment or file_hooks is not hooks.NO_HOOKS) else True
+    if cli_args.inplace and cli_args.keep_comment and not changed:
+        # Leave the file (and its timestamps) alone
+        return (STATUS_SUCCESS, _get_outcome(md, changed), False)
+
+    if staged_index is not None:
+        start_time = time.perf_counter()
+        (file_status, size) = _stage_markdown(cli_args, md, input_iofile, staged_index, encoding)
+        file_hooks.write_done(input_filename, size, time.perf_counter() - start_time)
+        return (file_status, _get_outcome(md, changed), False)
+
+    output_iofile = (
+        input_iofile
+        if cli_args.inplace
+        else iofile.TextIOFile(
+            cli_args.output_filename,
+            input_newline="",
+            output_newline="",
+            encoding=encoding,
+            binary=binary,
         )
+    )
+    start_time = time.perf_counter()
+    size = _write_markdown(cli_args, md, input_iofile, output_iofile)
+    file_hooks.write_done(input_filename, size, time.perf_counter() - start_time)
+    file_status = STATUS_SUCCESS
+    if cli_args.inplace and (cli_args.show_changed or cli_args.show_diff):
+        file_status = _show_changes(cli_args, md, output_iofile, encoding)
+    return (file_status, _get_outcome(md, changed), cli_args.inplace)
+
+
+def _update_file_with_retries(cli_args, input_filename, encoding, binary, file_hooks, **kwargs):
+    """
+    Update one input file, starting again if it changes before it can be replaced (see '--conflict-retries').
+
+    :Returns:
+        As for `_update_file()`:py:func:; if the file kept changing, the
+        conflict is reported and the file is left alone
+    """
+    for attempt in range(cli_args.conflict_retries + 1):
+        try:
+            return _update_file(cli_args, input_filename, encoding, binary, file_hooks, **kwargs)
+        except iofile.IOFileConflictError as e:
+            if attempt < cli_args.conflict_retries:
+                continue
+            file_hooks.error(input_filename, e)
+            print(e, file=sys.stderr)
+    return (STATUS_FAILURE, report.OUTCOME_FAILED, False)
 
-        input_iofile.open_for_input()
-        md = mdfile.MarkdownFile(infile=input_iofile.file, infilename=input_iofile.printable_name)
 
-        try:
-            input_text = md.read()
-            md.parse(
-                heading_text=args.heading_text,
-                heading_level=args.heading_level,
-                skip_level=args.skip_level,
-                max_level=args.max_level,
+def _process_file(cli_args, input_filename, encoding, binary, file_hooks=hooks.NO_HOOKS, **kwargs):
+    """
+    Update, or check, one input file, notifying `file_hooks` (see `hooks.Hooks`:py:class:).
+
+    Any other keyword arguments are passed on to `_update_file()`:py:func:.
+    A file changed by something else while it is being updated is read
+    again (see `_update_file_with_retries()`:py:func:).
+
+    :Returns:
+        A tuple of (`file_status`, `written`) (see `_update_file()`:py:func:)
+    """
+    start_time = time.perf_counter()
+    file_hooks.file_start(input_filename)
+    try:
+        (file_status, outcome, written) = _update_file_with_retries(
+            cli_args, input_filename, encoding, binary, file_hooks, **kwargs
+        )
+    except Exception as e:
+        file_hooks.error(input_filename, e)
+        file_hooks.file_end(input_filename, report.OUTCOME_FAILED, time.perf_counter() - start_time)
+        raise
+    except BaseException:
+        # e.g. `SystemExit` for a syntax error, already notified
+        file_hooks.file_end(input_filename, report.OUTCOME_FAILED, time.perf_counter() - start_time)
+        raise
+    file_hooks.file_end(input_filename, outcome, time.perf_counter() - start_time)
+    return (file_status, written)
+
+
+def _make_file_patch(cli_args, input_filename, encoding, binary, record_hooks=False, input_iofile=None):
+    """
+    Make a patch for updating one input file, without writing anything.
+
+    This runs in worker processes with '--jobs'; any message is returned
+    rather than printed, and hook notifications are recorded rather than
+    made, so that both stay in input order.
+
+    :Returns:
+        A tuple of (`file_status`, `patch_text`, `message`, `recorded_hooks`),
+        where `recorded_hooks` is a `hooks.RecordingHooks`:py:class: if
+        `record_hooks` is true, else `None`
+    """
+    recorded_hooks = hooks.RecordingHooks() if record_hooks else None
+    file_hooks = hooks.NO_HOOKS if recorded_hooks is None else recorded_hooks
+    start_time = time.perf_counter()
+    file_hooks.file_start(input_filename)
+
+    if input_iofile is None:
+        input_iofile = iofile.TextIOFile(input_filename, input_newline="", encoding=encoding, binary=binary)
+    (md, error) = _read_markdown(cli_args, input_iofile, encoding, file_hooks, jobs=1)
+    if error is not None:
+        file_hooks.error(input_filename, error)
+        file_hooks.file_end(input_filename, report.OUTCOME_FAILED, time.perf_counter() - start_time)
+        return (STATUS_FAILURE, "", str(error), recorded_hooks)
+
+    _render_toc(cli_args, md, input_filename, file_hooks)
+    output_text = md.render(
+        numbered=cli_args.numbered,
+        toc_comment=cli_args.comment,
+        alt_list_char=cli_args.alt_list_char,
+        add_trailing_heading_chars=cli_args.add_trailing_heading_chars,
+        keep_comment=cli_args.keep_comment,
+    )
+    patch_text = patch.make_patch(
+        input_filename,
+        _decode_for_patch(md.input_text, encoding),
+        _decode_for_patch(output_text, encoding),
+    )
+    file_hooks.file_end(input_filename, _get_outcome(md, bool(patch_text)), time.perf_counter() - start_time)
+    return (STATUS_CHANGED if patch_text else STATUS_SUCCESS, patch_text, None, recorded_hooks)
+
+
+def _may_have_tocs(path, encoding, binary):
+    """Check quickly whether a file may have tables of contents (see `mdfile.may_have_tocs()`:py:func:)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    return mdfile.may_have_tocs(data if binary else data.decode(encoding, errors="surrogateescape"))
+
+
+def _get_mirror_path(cli_args, input_filename):
+    """Get the path under the output directory for an input file (see '--output-dir')."""
+    return os.path.join(cli_args.output_dir, os.path.relpath(input_filename))
+
+
+def _mirror_file(cli_args, input_filename, encoding, binary, record_hooks=False):
+    """
+    Write one input file, with its tables of contents updated, to its place under the output directory.
+
+    Files without tables of contents are copied (or hard-linked, with
+    '--link-unchanged') without being scanned.  Output files are always
+    replaced, never overwritten, in case they are hard links to input files.
+
+    Like `_make_file_patch()`:py:func:, this runs in worker processes with
+    '--jobs'.
+
+    :Returns:
+        A tuple of (`file_status`, `message`, `recorded_hooks`) (see
+        `_make_file_patch()`:py:func:)
+    """
+    recorded_hooks = hooks.RecordingHooks() if record_hooks else None
+    file_hooks = hooks.NO_HOOKS if recorded_hooks is None else recorded_hooks
+    start_time = time.perf_counter()
+    file_hooks.file_start(input_filename)
+
+    output_filename = _get_mirror_path(cli_args, input_filename)
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    if not _may_have_tocs(input_filename, encoding, binary):
+        write_start_time = time.perf_counter()
+        iofile.copy_file_atomically(input_filename, output_filename, link=cli_args.link_unchanged)
+        file_hooks.write_done(input_filename, os.path.getsize(output_filename), time.perf_counter() - write_start_time)
+        file_hooks.file_end(input_filename, report.OUTCOME_SKIPPED, time.perf_counter() - start_time)
+        return (STATUS_SUCCESS, None, recorded_hooks)
+
+    input_iofile = iofile.TextIOFile(input_filename, input_newline="", encoding=encoding, binary=binary)
+    (md, error) = _read_markdown(cli_args, input_iofile, encoding, file_hooks, jobs=1)
+    if error is not None:
+        file_hooks.error(input_filename, error)
+        file_hooks.file_end(input_filename, report.OUTCOME_FAILED, time.perf_counter() - start_time)
+        return (STATUS_FAILURE, str(error), recorded_hooks)
+
+    _render_toc(cli_args, md, input_filename, file_hooks)
+    changed = not _is_unchanged(cli_args, md) if record_hooks else True
+    output_iofile = iofile.TextIOFile(
+        output_filename,
+        input_newline="",
+        output_newline="",
+        atomic=True,
+        encoding=encoding,
+        binary=binary,
+    )
+    write_start_time = time.perf_counter()
+    size = _write_markdown(cli_args, md, input_iofile, output_iofile)
+    file_hooks.write_done(input_filename, size, time.perf_counter() - write_start_time)
+    file_hooks.file_end(input_filename, _get_outcome(md, changed), time.perf_counter() - start_time)
+    return (STATUS_SUCCESS, None, recorded_hooks)
+
+
+def _mirror_files(cli_args, encoding, binary, file_hooks=hooks.NO_HOOKS):
+    """Write all input files to the output directory (see '--output-dir' and `_mirror_file()`:py:func:)."""
+    overall_status = STATUS_SUCCESS
+    file_results = _iter_file_results(cli_args, _mirror_file, encoding, binary, file_hooks is not hooks.NO_HOOKS)
+    for file_status, message, recorded_hooks in file_results:
+        if recorded_hooks is not None:
+            recorded_hooks.replay(file_hooks)
+        if message is not None:
+            print(message, file=sys.stderr)
+        overall_status = _combine_status(overall_status, file_status)
+    return overall_status
+
+
+def _decode_for_patch(text, encoding):
+    if isinstance(text, bytes):
+        return text.decode(encoding, errors="surrogateescape")
+    return text
+
+
+def _iter_file_results(cli_args, func, *func_args):
+    """
+    Call ``func(cli_args, input_filename, *func_args)`` for each input file and generate the results in order.
+
+    With '--jobs', files are processed in parallel worker processes, but
+    results are still generated in input order, as each becomes available.
+    """
+    input_filenames = cli_args.input_filenames
+    if cli_args.jobs <= 1 or len(input_filenames) <= 1:
+        for input_filename in input_filenames:
+            yield func(cli_args, input_filename, *func_args)
+        return
+    repeat_args = [[arg] * len(input_filenames) for arg in func_args]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=cli_args.jobs) as executor:
+        yield from executor.map(func, [cli_args] * len(input_filenames), input_filenames, *repeat_args)
+
+
+def _iter_patch_results(cli_args, encoding, binary, record_hooks):
+    """Make a patch for each input file (see `_make_file_patch()`:py:func:) and generate the results in order."""
+    if not cli_args.staged:
+        yield from _iter_file_results(cli_args, _make_file_patch, encoding, binary, record_hooks)
+        return
+    with staged.StagedIndex() as staged_index:
+        for staged_file in staged_index.iter_files(cli_args.input_filenames, encoding, binary):
+            yield _make_file_patch(cli_args, staged_file.path, encoding, binary, record_hooks, input_iofile=staged_file)
+
+
+def _write_patch(cli_args, encoding, binary, file_hooks=hooks.NO_HOOKS):
+    """Write a combined patch for all input files (see '--patch')."""
+    overall_status = STATUS_SUCCESS
+    patch_iofile = iofile.TextIOFile(cli_args.patch, encoding=encoding, binary=True)
+    patch_iofile.open_for_output()
+    encoder = codecs.getincrementalencoder(encoding)(errors="surrogateescape")
+    try:
+        file_results = _iter_patch_results(cli_args, encoding, binary, file_hooks is not hooks.NO_HOOKS)
+        for file_status, patch_text, message, recorded_hooks in file_results:
+            if recorded_hooks is not None:
+                recorded_hooks.replay(file_hooks)
+            if message is not None:
+                print(message, file=sys.stderr)
+            if patch_text:
+                patch_iofile.file.write(encoder.encode(patch_text))
+                patch_iofile.file.flush()
+            overall_status = _combine_status(overall_status, file_status)
+        patch_iofile.file.write(encoder.encode("", final=True))
+    except BaseException:
+        patch_iofile.discard()
+        raise
+    patch_iofile.close()
+    return overall_status
+
+
+def _extract_file_links(cli_args, input_filename, encoding, binary, record_hooks=False):
+    """
+    Find the heading anchors in one input file, and the links to headings in it, without writing anything.
+
+    This runs in worker processes with '--jobs' (see `_make_file_patch()`:py:func:).
+
+    :Returns:
+        A tuple of (`anchors`, `file_links`, `message`, `recorded_hooks`),
+        where `anchors` is `None` if the file could not be read or parsed
+    """
+    recorded_hooks = hooks.RecordingHooks() if record_hooks else None
+    file_hooks = hooks.NO_HOOKS if recorded_hooks is None else recorded_hooks
+    start_time = time.perf_counter()
+    file_hooks.file_start(input_filename)
+
+    input_iofile = iofile.TextIOFile(input_filename, input_newline="", encoding=encoding, binary=binary)
+    try:
+        (md, error) = _read_markdown(cli_args, input_iofile, encoding, file_hooks, jobs=1)
+    except OSError as e:
+        error = e
+    if error is not None:
+        file_hooks.error(input_filename, error)
+        file_hooks.file_end(input_filename, report.OUTCOME_FAILED, time.perf_counter() - start_time)
+        return (None, [], str(error), recorded_hooks)
+
+    scan = md.scan()
+    anchors = links.get_anchors(heading.text for heading in scan.headings)
+    file_links = list(links.iter_links(input_filename, md.text, scan, encoding=encoding))
+    file_hooks.file_end(input_filename, report.OUTCOME_UNCHANGED, time.perf_counter() - start_time)
+    return (anchors, file_links, None, recorded_hooks)
+
+
+def _list_file_headings(cli_args, input_filename, encoding, binary, record_hooks=False):
+    """
+    Get the headings in one input file, without writing anything.
+
+    This runs in worker processes with '--jobs' (see `_make_file_patch()`:py:func:).
+
+    :Returns:
+        A tuple of (`headings`, `message`, `recorded_hooks`), where
+        `headings` is a list of `mdfile.Heading`:py:class:, or `None` if the
+        file could not be read or parsed
+    """
+    recorded_hooks = hooks.RecordingHooks() if record_hooks else None
+    file_hooks = hooks.NO_HOOKS if recorded_hooks is None else recorded_hooks
+    start_time = time.perf_counter()
+    file_hooks.file_start(input_filename)
+
+    input_iofile = iofile.TextIOFile(input_filename, input_newline="", encoding=encoding, binary=binary)
+    (md, error) = _read_markdown(cli_args, input_iofile, encoding, file_hooks, jobs=1)
+    if error is not None:
+        file_hooks.error(input_filename, error)
+        file_hooks.file_end(input_filename, report.OUTCOME_FAILED, time.perf_counter() - start_time)
+        return (None, str(error), recorded_hooks)
+    file_hooks.file_end(input_filename, report.OUTCOME_UNCHANGED, time.perf_counter() - start_time)
+    return (md.scan().headings, None, recorded_hooks)
+
+
+def _list_headings(cli_args, encoding, binary, file_hooks=hooks.NO_HOOKS):
+    """Write the headings of all input files in the requested format (see '--list-headings')."""
+    overall_status = STATUS_SUCCESS
+    output_iofile = iofile.TextIOFile(cli_args.output_filename, output_newline="\n", atomic=True, encoding=encoding)
+    output_iofile.open_for_output()
+    renderer = renderers.get_renderer(
+        cli_args.list_format,
+        output_iofile.file,
+        skip_level=cli_args.skip_level,
+        link_paths=len(cli_args.input_filenames) > 1,
+        numbered=cli_args.numbered,
+        alt_list_char=cli_args.alt_list_char,
+    )
+    try:
+        renderer.start()
+        file_results = _iter_file_results(
+            cli_args, _list_file_headings, encoding, binary, file_hooks is not hooks.NO_HOOKS
+        )
+        for input_filename, (headings, message, recorded_hooks) in zip(cli_args.input_filenames, file_results):
+            if recorded_hooks is not None:
+                recorded_hooks.replay(file_hooks)
+            if message is not None:
+                print(message, file=sys.stderr)
+                overall_status = STATUS_FAILURE
+                continue
+            nodes = renderers.build_heading_tree(headings, cli_args.skip_level, cli_args.max_level)
+            renderer.render_file(patch.get_patch_path(input_filename), nodes)
+        renderer.finish()
+    except BaseException:
+        output_iofile.discard()
+        raise
+    output_iofile.close()
+    return overall_status
+
+
+def _check_links(cli_args, encoding, binary, file_hooks=hooks.NO_HOOKS):
+    """
+    Check links to headings across all input files in one pass (see '--check-links').
+
+    Anchors are extracted from all input files first (in parallel with
+    '--jobs'); Markdown files which are linked to but are not input files
+    are read once each, as needed.
+    """
+    overall_status = STATUS_SUCCESS
+    anchor_index = links.AnchorIndex()
+    all_links = []
+    file_results = _iter_file_results(cli_args, _extract_file_links, encoding, binary, file_hooks is not hooks.NO_HOOKS)
+    for input_filename, (anchors, file_links, message, recorded_hooks) in zip(cli_args.input_filenames, file_results):
+        if recorded_hooks is not None:
+            recorded_hooks.replay(file_hooks)
+        if message is not None:
+            print(message, file=sys.stderr)
+            overall_status = STATUS_FAILURE
+            continue
+        anchor_index.add(input_filename, anchors)
+        all_links.extend(file_links)
+
+    for link in all_links:
+        if link.target_path not in anchor_index and os.path.isfile(link.target_path):
+            (anchors, _, message, _) = _extract_file_links(cli_args, link.target_path, encoding, binary)
+            if message is not None:
+                print(message, file=sys.stderr)
+                overall_status = STATUS_FAILURE
+            # Failures are indexed too, so each file is only read (and reported) once
+            anchor_index.add(link.target_path, anchors)
+        problem = anchor_index.check(link)
+        if problem is not None:
+            print(
+                "{path}:{line_number}: dangling link '{target}': {problem}".format(
+                    path=link.path, line_number=link.line_number, target=link.target, problem=problem
+                )
             )
-        except (TypeError, ValueError) as e:
-            if not args.inplace:
-                raise SystemExit(e)
             overall_status = STATUS_FAILURE
-            file_status = STATUS_FAILURE
-            print(e, file=sys.stderr)
+    return overall_status
+
 
-        input_iofile.close()
+def _get_toc_options(cli_args, encoding, command):
+    """Get the options for updating tables of contents as an `aio.TocOptions`:py:class:."""
+    return aio.TocOptions(
+        heading_text=cli_args.heading_text,
+        heading_level=cli_args.heading_level,
+        skip_level=cli_args.skip_level,
+        max_level=cli_args.max_level,
+        numbered=cli_args.numbered,
+        alt_list_char=cli_args.alt_list_char,
+        add_trailing_heading_chars=cli_args.add_trailing_heading_chars,
+        comment=cli_args.comment,
+        command=command,
+        keep_comment=cli_args.keep_comment,
+        newline=NEWLINE_VALUES[cli_args.newlines],
+        encoding=encoding,
+        parser=cli_args.parser,
+        sync=cli_args.sync,
+        conflict_retries=cli_args.conflict_retries,
+    )
 
-        if file_status != STATUS_FAILURE:
-            output_iofile.open_for_output()
 
-            md.write(
-                numbered=args.numbered,
-                toc_comment=args.comment,
-                alt_list_char=args.alt_list_char,
-                add_trailing_heading_chars=args.add_trailing_heading_chars,
-                outfile=output_iofile.file,
+def _serve_batch(cli_args, encoding, command, file_hooks=hooks.NO_HOOKS):
+    """
+    Handle requests on stdin until it is closed (see '--batch-stdio' and `batch.serve()`:py:func:).
+
+    Unless '--comment' is given, each request gets a comment generated when
+    it is handled, naming `command`; requests which only check a file
+    ignore it, as '--check' does.
+    """
+    batch.serve(
+        sys.stdin.buffer,
+        sys.stdout,
+        _get_toc_options(cli_args, encoding, command),
+        heading_cache=headingindex.HeadingIndexCache(),
+        file_hooks=file_hooks,
+    )
+    return STATUS_SUCCESS
+
+
+def _process_staged_files(cli_args, encoding, binary, file_hooks):
+    """Update, or check, all input files as staged in the git index (see '--staged')."""
+    overall_status = STATUS_SUCCESS
+    with staged.StagedIndex() as staged_index:
+        for staged_file in staged_index.iter_files(cli_args.input_filenames, encoding, binary):
+            (file_status, _) = _process_file(
+                cli_args,
+                staged_file.path,
+                encoding,
+                binary,
+                file_hooks,
+                input_iofile=staged_file,
+                staged_index=staged_index if cli_args.inplace else None,
             )
+            overall_status = _combine_status(overall_status, file_status)
+        staged_index.commit()
+    return overall_status
+
 
-            output_iofile.close()
-
-            if args.inplace and (args.show_changed or args.show_diff):
-                output_iofile.open_for_input()
-                output_text = output_iofile.file.read()
-                if input_text != output_text:
-                    file_status = STATUS_CHANGED
-                    if overall_status != STATUS_FAILURE:
-                        overall_status = file_status
-                    print(
-                        "Updated {}".format(output_iofile.file.name),
-                        file=sys.stderr,
-                    )
-                    if args.show_diff:
-                        for line in _compute_diff(output_iofile.file.name, input_text, output_text):
-                            print(line)
-                output_iofile.close()
+def _process_files(cli_args, encoding, binary, file_hooks):
+    """Update, or check, all input files in turn."""
+    if cli_args.staged:
+        return _process_staged_files(cli_args, encoding, binary, file_hooks)
+    overall_status = STATUS_SUCCESS
+    written_paths = []
+    for input_filename in cli_args.input_filenames:
+        (file_status, written) = _process_file(cli_args, input_filename, encoding, binary, file_hooks)
+        if written and cli_args.sync == iofile.SYNC_BATCH:
+            written_paths.append(input_filename)
+        overall_status = _combine_status(overall_status, file_status)
+    try:
+        iofile.sync_paths(written_paths)
+    except OSError as e:
+        print("error syncing updated files: {}".format(e), file=sys.stderr)
+        overall_status = STATUS_FAILURE
+    return overall_status
+
+
+def _write_reports(cli_args, run_report):
+    """Write the run report and metrics requested (see '--report' and '--metrics')."""
+    if cli_args.report is not None:
+        report_format = cli_args.report_format
+        if report_format is None:
+            report_format = (
+                report.REPORT_FORMAT_JSON_LINES if cli_args.report.endswith(".jsonl") else report.REPORT_FORMAT_JSON
+            )
+        report_iofile = iofile.TextIOFile(cli_args.report, output_newline="\n", atomic=True, encoding="utf-8")
+        report_iofile.open_for_output()
+        run_report.write(report_iofile.file, report_format=report_format)
+        report_iofile.close()
+    if cli_args.metrics is not None:
+        metrics_iofile = iofile.TextIOFile(cli_args.metrics, output_newline="\n", atomic=True, encoding="utf-8")
+        metrics_iofile.open_for_output()
+        run_report.write_prometheus(metrics_iofile.file)
+        metrics_iofile.close()
+
+
+def main(*argv, file_hooks=None):
+    """
+    Do the thing.
+
+    :Args:
+        argv
+            (optional) The command line, including the program name
+
+        file_hooks
+            (optional) A `hooks.Hooks`:py:class: to notify as each file is
+            processed, e.g. for tracing when embedding
+    """
+    (prog, args) = _setup_args(argv)
+
+    if _check_completion_args(args):
+        _do_completion(args, prog)
+        return STATUS_SUCCESS
+
+    _check_pre_commit_args(args)
+    _check_diff_args(args)
+    _check_sync_args(args)
+    _check_conflict_args(args)
+    _check_jobs_args(args)
+    _check_parser_args(args)
+    _check_newlines(args)
+    _check_staged_args(args)
+    _check_input_and_output_filenames(args)
+    _check_ignore_comment_args(args)
+    _set_default_comment(args, prog, argv)
+
+    encoding = iofile.get_default_encoding()
+    binary = iofile.is_bytes_compatible_encoding(encoding)
+
+    run_report = None if args.report is None and args.metrics is None else report.RunReport()
+    progress_display = (
+        progress.ProgressDisplay(len(args.input_filenames) or None) if args.progress and sys.stderr.isatty() else None
+    )
+    all_hooks = hooks.combine_hooks(file_hooks, run_report, progress_display)
+
+    with contextlib.ExitStack() as exit_stack:
+        if progress_display is not None:
+            exit_stack.enter_context(contextlib.redirect_stderr(progress_display.wrap(sys.stderr)))
+            if sys.stdout.isatty():
+                exit_stack.enter_context(contextlib.redirect_stdout(progress_display.wrap(sys.stdout)))
+        if args.patch is not None:
+            overall_status = _write_patch(args, encoding, binary, all_hooks)
+        elif args.check_links:
+            overall_status = _check_links(args, encoding, binary, all_hooks)
+        elif args.list_headings:
+            overall_status = _list_headings(args, encoding, binary, all_hooks)
+        elif args.batch_stdio:
+            overall_status = _serve_batch(args, encoding, _get_command(prog, argv, with_full_command=True), all_hooks)
+        elif args.output_dir is not None:
+            overall_status = _mirror_files(args, encoding, binary, all_hooks)
+        else:
+            overall_status = _process_files(args, encoding, binary, all_hooks)
+        if progress_display is not None:
+            progress_display.finish()
+
+    if run_report is not None:
+        run_report.finish()
+        _write_reports(args, run_report)
 
     return overall_status
 
@@ -0,0 +1,376 @@
+"""Provide a persistent index of the headings in Markdown files, keyed by content hash."""
+
+import codecs
+import collections
+import hashlib
+import json
+import os
+import threading
+
+from . import iofile, mdfile
+
+####################
+
+INDEX_FORMAT_VERSION = 1
+
+# Rough sizes, in bytes, of an index as saved, for `HeadingIndex.estimate_size()`
+INDEX_BASE_SIZE_ESTIMATE = 256
+INDEX_ITEM_SIZE_ESTIMATE = 24
+
+INDEX_FILE_SUFFIX = ".json"
+
+DEFAULT_MEMORY_CACHE_ENTRIES = 1024
+DEFAULT_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+
+####################
+
+
+def get_content_hash(content, encoding="utf-8"):
+    """Get the hash that identifies `content` (as `str` or `bytes`) in a heading index cache."""
+    if not isinstance(content, bytes):
+        content = content.encode(encoding)
+    return hashlib.sha256(content).hexdigest()
+
+
+def get_index_path(cache_dir, content_hash):
+    """Get the path of the heading index for the content with `content_hash` in `cache_dir`."""
+    return os.path.join(cache_dir, content_hash[:2], content_hash + INDEX_FILE_SUFFIX)
+
+
+class IndexedHeading(object):
+    """Model a heading in a `HeadingIndex`:py:class:."""
+
+    def __init__(self, level, text, anchor, line_number, offset):
+        self.level = level
+        self.text = text
+        self.anchor = anchor
+        self.line_number = line_number
+        self.offset = offset
+
+    def __repr__(self):
+        """Print a human-readable representation of this heading."""
+        return (
+            "IndexedHeading(level={level}, text={text}, anchor={anchor}, line_number={line_number}, offset={offset})"
+        ).format(
+            level=self.level,
+            text=repr(self.text),
+            anchor=repr(self.anchor),
+            line_number=self.line_number,
+            offset=self.offset,
+        )
+
+
+class HeadingIndex(object):
+    """
+    Record the headings, tables of contents and code fences in a Markdown file.
+
+    All offsets are byte offsets into the file as stored, so the index is
+    usable without decoding or re-scanning the file.
+
+    :Attributes:
+        content_hash
+            The hash of the file's contents (see `get_content_hash()`:py:func:)
+
+        encoding
+            The encoding heading text was decoded with
+
+        parser
+            The name of the parser backend the file was scanned with (see
+            `parsers.get_parser()`:py:func:)
+
+        size
+            The size of the file, in bytes
+
+        headings
+            A list of `IndexedHeading`:py:class:, in document order
+
+        toc_spans, code_fence_spans, opaque_spans, dir_toc_spans, section_toc_spans
+            Lists of ``(start, stop)`` byte offsets (see
+            `mdfile.MarkdownScan`:py:class:)
+    """
+
+    def __init__(self, content_hash, encoding, size, parser=mdfile.DEFAULT_PARSER_NAME):
+        self.content_hash = content_hash
+        self.encoding = encoding
+        self.size = size
+        self.parser = parser
+        self.headings = []
+        self.toc_spans = []
+        self.code_fence_spans = []
+        self.opaque_spans = []
+        self.dir_toc_spans = []
+        self.section_toc_spans = []
+
+    def to_scan(self):
+        """Get an `mdfile.MarkdownScan`:py:class: from this index (offsets are byte offsets)."""
+        scan = mdfile.MarkdownScan()
+        scan.headings = [
+            mdfile.Heading(heading.level, heading.text, heading.line_number, heading.offset)
+            for heading in self.headings
+        ]
+        scan.toc_spans = list(self.toc_spans)
+        scan.code_fence_spans = list(self.code_fence_spans)
+        scan.opaque_spans = list(self.opaque_spans)
+        scan.dir_toc_spans = list(self.dir_toc_spans)
+        scan.section_toc_spans = list(self.section_toc_spans)
+        return scan
+
+    def estimate_size(self):
+        """Estimate the size of this index as saved, in bytes, without serializing it."""
+        spans = [self.toc_spans, self.code_fence_spans, self.opaque_spans, self.dir_toc_spans, self.section_toc_spans]
+        size = INDEX_BASE_SIZE_ESTIMATE + INDEX_ITEM_SIZE_ESTIMATE * sum(len(span_list) for span_list in spans)
+        for heading in self.headings:
+            size += INDEX_ITEM_SIZE_ESTIMATE + len(heading.text) + len(heading.anchor)
+        return size
+
+    def to_dict(self):
+        """Get this index as a compact dictionary suitable for JSON."""
+        return {
+            "version": INDEX_FORMAT_VERSION,
+            "content_hash": self.content_hash,
+            "encoding": self.encoding,
+            "size": self.size,
+            "parser": self.parser,
+            "headings": [
+                [heading.level, heading.text, heading.anchor, heading.line_number, heading.offset]
+                for heading in self.headings
+            ],
+            "toc_spans": [list(span) for span in self.toc_spans],
+            "code_fence_spans": [list(span) for span in self.code_fence_spans],
+            "opaque_spans": [list(span) for span in self.opaque_spans],
+            "dir_toc_spans": [list(span) for span in self.dir_toc_spans],
+            "section_toc_spans": [list(span) for span in self.section_toc_spans],
+        }
+
+
+def _heading_index_from_dict(index_dict):
+    heading_index = HeadingIndex(
+        index_dict["content_hash"], index_dict["encoding"], index_dict["size"], parser=index_dict["parser"]
+    )
+    heading_index.headings = [IndexedHeading(*fields) for fields in index_dict["headings"]]
+    heading_index.toc_spans = [tuple(span) for span in index_dict["toc_spans"]]
+    heading_index.code_fence_spans = [tuple(span) for span in index_dict["code_fence_spans"]]
+    heading_index.opaque_spans = [tuple(span) for span in index_dict["opaque_spans"]]
+    heading_index.dir_toc_spans = [tuple(span) for span in index_dict["dir_toc_spans"]]
+    heading_index.section_toc_spans = [tuple(span) for span in index_dict["section_toc_spans"]]
+    return heading_index
+
+
+def _get_byte_offsets(text, offsets, encoding):
+    """Map character offsets into `text` to byte offsets in its encoded form."""
+    encoder = codecs.getincrementalencoder(encoding)()
+    byte_offsets = {}
+    (last_offset, byte_offset) = (0, 0)
+    for offset in sorted(set(offsets)):
+        byte_offset += len(encoder.encode(text[last_offset:offset]))
+        byte_offsets[offset] = byte_offset
+        last_offset = offset
+    return byte_offsets
+
+
+def build_heading_index(md, content_hash=None):
+    """
+    Build the heading index for a `mdfile.MarkdownFile`:py:class: which has been read.
+
+    :Raises:
+        `ValueError`:py:exc: if the table of contents syntax is invalid
+    """
+    if md.newlines_converted:
+        # Offsets must refer to the file as stored, not the converted text
+        scan = md.scan_text(md.input_text)
+    else:
+        scan = md.scan()
+    content = md.input_text if md.is_bytes else md.input_text.encode(md.encoding)
+    if content_hash is None:
+        content_hash = get_content_hash(content)
+
+    spans = scan.toc_spans + scan.code_fence_spans + scan.opaque_spans + scan.dir_toc_spans + scan.section_toc_spans
+    if md.is_bytes:
+        byte_offsets = None
+    else:
+        offsets = [heading.offset for heading in scan.headings] + [offset for span in spans for offset in span]
+        byte_offsets = _get_byte_offsets(md.input_text, offsets, md.encoding)
+
+    def get_byte_offset(offset):
+        return offset if byte_offsets is None else byte_offsets[offset]
+
+    heading_index = HeadingIndex(content_hash, md.encoding, len(content), parser=md.parser_name)
+    heading_index.headings = [
+        IndexedHeading(
+            heading.level,
+            heading.text,
+            mdfile.get_anchor_name(heading.text),
+            heading.line_number,
+            get_byte_offset(heading.offset),
+        )
+        for heading in scan.headings
+    ]
+    heading_index.toc_spans = [tuple(map(get_byte_offset, span)) for span in scan.toc_spans]
+    heading_index.code_fence_spans = [tuple(map(get_byte_offset, span)) for span in scan.code_fence_spans]
+    heading_index.opaque_spans = [tuple(map(get_byte_offset, span)) for span in scan.opaque_spans]
+    heading_index.dir_toc_spans = [tuple(map(get_byte_offset, span)) for span in scan.dir_toc_spans]
+    heading_index.section_toc_spans = [tuple(map(get_byte_offset, span)) for span in scan.section_toc_spans]
+    return heading_index
+
+
+def load_heading_index(cache_dir, content_hash, encoding=None, parser=mdfile.DEFAULT_PARSER_NAME):
+    """
+    Load a heading index from `cache_dir`, without reading or scanning the Markdown file itself.
+
+    :Args:
+        encoding
+            (optional) If supplied, only accept an index made with this encoding
+
+        parser
+            (optional) Only accept an index made with this parser backend
+
+    :Returns:
+        A `HeadingIndex`:py:class:, or `None` if there is no usable index
+    """
+    try:
+        with open(get_index_path(cache_dir, content_hash), encoding="utf-8") as f:
+            index_dict = json.load(f)
+        if index_dict.get("version") != INDEX_FORMAT_VERSION or index_dict.get("content_hash") != content_hash:
+            return None
+        heading_index = _heading_index_from_dict(index_dict)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return heading_index if _is_usable(heading_index, encoding, parser) else None
+
+
+def _is_usable(heading_index, encoding, parser):
+    """Check whether a heading index was made with `encoding` (if not `None`) and `parser`."""
+    if encoding is not None and codecs.lookup(heading_index.encoding).name != codecs.lookup(encoding).name:
+        return False
+    return heading_index.parser == parser
+
+
+def save_heading_index(cache_dir, heading_index):
+    """Save a heading index to `cache_dir`, atomically; return its path."""
+    path = get_index_path(cache_dir, heading_index.content_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    index_iofile = iofile.TextIOFile(path, output_newline="\n", atomic=True, encoding="utf-8")
+    index_iofile.open_for_output()
+    try:
+        json.dump(heading_index.to_dict(), index_iofile.file, separators=(",", ":"), ensure_ascii=False)
+    except BaseException:
+        index_iofile.discard()
+        raise
+    index_iofile.close()
+    return path
+
+
+def read_fingerprinted_file(path):
+    """Read a file as `bytes`; return its content and its fingerprint from just before it was read."""
+    with open(path, "rb") as f:
+        fingerprint = iofile.get_file_fingerprint(f.fileno())
+        return (f.read(), fingerprint)
+
+
+class HeadingIndexCache(object):
+    """
+    Keep heading indexes in memory, for hosts which process the same files again and again.
+
+    Each index is kept under the path of its file, with the file's
+    fingerprint (see `iofile.get_file_fingerprint()`:py:func:); an index is only
+    returned while the file's fingerprint still matches.  The least recently
+    used indexes are evicted to stay within the bounds.  The cache may be
+    shared between threads, but not between processes.
+
+    :Args:
+        max_entries
+            (optional) The most indexes to keep
+
+        max_bytes
+            (optional) The most bytes of indexes to keep, roughly as saved
+            (see `HeadingIndex.estimate_size()`:py:meth:)
+
+    :Attributes:
+        hits, misses, evictions
+            Counts of lookups which found a usable index, lookups which did
+            not, and indexes evicted to stay within the bounds
+    """
+
+    def __init__(self, max_entries=DEFAULT_MEMORY_CACHE_ENTRIES, max_bytes=DEFAULT_MEMORY_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Get the number of indexes in the cache."""
+        return len(self._entries)
+
+    def get_stats(self):
+        """Get the counters and current size of the cache, as a dictionary suitable for instrumentation."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+            }
+
+    def get(self, path, fingerprint=None, encoding=None, parser=mdfile.DEFAULT_PARSER_NAME):
+        """
+        Get the heading index for the file at `path`, if it has not changed since it was cached.
+
+        :Args:
+            fingerprint
+                (optional) The file's current fingerprint, if already known
+                (default: taken now)
+
+            encoding, parser
+                (optional) As for `load_heading_index()`:py:func:
+
+        :Returns:
+            A `HeadingIndex`:py:class:, or `None` if there is no usable index
+        """
+        if fingerprint is None:
+            try:
+                fingerprint = iofile.get_file_fingerprint(path)
+            except OSError:
+                fingerprint = None
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] != fingerprint:
+                self._remove(path)
+                entry = None
+            if entry is None or not _is_usable(entry[1], encoding, parser):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, path, fingerprint, heading_index):
+        """Cache the heading index for the file at `path`, with the fingerprint it had when it was read."""
+        size = heading_index.estimate_size()
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+            if size > self.max_bytes:
+                return
+            self._entries[path] = (fingerprint, heading_index, size)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, path=None):
+        """Forget the index for the file at `path`, or all indexes if `path` is `None`."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self.total_bytes = 0
+            elif path in self._entries:
+                self._remove(path)
+
+    def _remove(self, path):
+        (_, _, size) = self._entries.pop(path)
+        self.total_bytes -= size
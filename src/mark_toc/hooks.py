@@ -0,0 +1,114 @@
+"""Provide instrumentation hooks for the table of contents pipeline."""
+
+
+class Hooks(object):
+    """
+    Receive notifications as each file passes through the pipeline.
+
+    Subclass this and override the methods of interest; the default
+    implementations do nothing.  Durations are in seconds, as measured by
+    `time.perf_counter()`:py:func:; sizes are in bytes (or characters, for
+    encodings that are not handled as raw bytes).
+
+    For any one file, the calls come in the order `file_start()`:py:meth:,
+    `read_done()`:py:meth:, `parse_done()`:py:meth:, `render_done()`:py:meth:,
+    `write_done()`:py:meth: and `file_end()`:py:meth:, with phases that do
+    not happen left out and `error()`:py:meth: called instead of any phases
+    after an error.  `file_end()`:py:meth: is always called.
+    """
+
+    def file_start(self, path):
+        """Processing of the file at `path` has started."""
+
+    def read_done(self, path, size, duration):
+        """The file has been read."""
+
+    def parse_done(self, path, headings, duration):
+        """The file has been scanned and parsed, and `headings` headings were found."""
+
+    def render_done(self, path, size, duration):
+        """The new table of contents has been formatted."""
+
+    def write_done(self, path, size, duration):
+        """The updated file has been written."""
+
+    def error(self, path, error):
+        """Processing of the file has failed with `error`."""
+
+    def file_end(self, path, outcome, duration):
+        """Processing of the file has finished with `outcome` (one of `report.OUTCOMES`)."""
+
+
+NO_HOOKS = Hooks()
+
+
+class MultiHooks(Hooks):
+    """Pass each notification on to several hooks, in order."""
+
+    def __init__(self, hooks_list):
+        self.hooks_list = list(hooks_list)
+
+    def _call(self, name, *args):
+        for hooks in self.hooks_list:
+            getattr(hooks, name)(*args)
+
+    def file_start(self, path):
+        """See `Hooks.file_start()`:py:meth:."""
+        self._call("file_start", path)
+
+    def read_done(self, path, size, duration):
+        """See `Hooks.read_done()`:py:meth:."""
+        self._call("read_done", path, size, duration)
+
+    def parse_done(self, path, headings, duration):
+        """See `Hooks.parse_done()`:py:meth:."""
+        self._call("parse_done", path, headings, duration)
+
+    def render_done(self, path, size, duration):
+        """See `Hooks.render_done()`:py:meth:."""
+        self._call("render_done", path, size, duration)
+
+    def write_done(self, path, size, duration):
+        """See `Hooks.write_done()`:py:meth:."""
+        self._call("write_done", path, size, duration)
+
+    def error(self, path, error):
+        """See `Hooks.error()`:py:meth:."""
+        self._call("error", path, error)
+
+    def file_end(self, path, outcome, duration):
+        """See `Hooks.file_end()`:py:meth:."""
+        self._call("file_end", path, outcome, duration)
+
+
+class RecordingHooks(MultiHooks):
+    """
+    Record notifications so they can be replayed later, e.g. in another process.
+
+    Errors are recorded as their string representation, so that the
+    recording can be pickled.
+    """
+
+    def __init__(self):
+        super(RecordingHooks, self).__init__([])
+        self.calls = []
+
+    def _call(self, name, *args):
+        if name == "error":
+            args = (args[0], str(args[1]))
+        self.calls.append((name, args))
+
+    def replay(self, hooks):
+        """Send the recorded notifications to `hooks`, in order."""
+        for name, args in self.calls:
+            getattr(hooks, name)(*args)
+
+
+def combine_hooks(*hooks_list):
+    """Combine hooks into one, leaving out any which are `None`."""
+    hooks_list = [hooks for hooks in hooks_list if hooks is not None]
+    if not hooks_list:
+        return NO_HOOKS
+    if len(hooks_list) == 1:
+        return hooks_list[0]
+    return MultiHooks(hooks_list)
@@ -2,8 +2,59 @@
 Provide IOFile class and related exceptions.
 """
 
+import codecs
+import errno
 import io
+import locale
+import os
+import secrets
+import stat
 import sys
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SYNC_NONE = "none"
+SYNC_FILE = "file"
+SYNC_BATCH = "batch"
+
+SYNC_MODES = [
+    SYNC_NONE,
+    SYNC_FILE,
+    SYNC_BATCH,
+]
+
+NEWLINE_PRESERVE = "preserve"
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Errors meaning a kernel-side copy is unsupported for this pair of files, as
+# opposed to errors (like running out of space) that should be reported.
+_UNSUPPORTED_COPY_ERRNOS = frozenset(
+    [
+        errno.EBADF,
+        errno.EINVAL,
+        errno.ENOSYS,
+        errno.ENOTSUP,
+        errno.EOPNOTSUPP,
+        errno.EXDEV,
+    ]
+)
+
+# Errors meaning a hard link cannot be made between this pair of paths, so
+# that the file should be copied instead.
+_UNSUPPORTED_LINK_ERRNOS = frozenset(
+    [
+        errno.EMLINK,
+        errno.ENOTSUP,
+        errno.EOPNOTSUPP,
+        errno.EPERM,
+        errno.EXDEV,
+    ]
+)
 
 
 class IOFileError(Exception):
@@ -46,6 +97,280 @@ class IOFileOpenError(IOFileError):
         super(IOFileOpenError, self).__init__(path, message)
 
 
+class IOFileConflictError(IOFileError):
+    """
+    Provide exception raised when a file changes between being read and being replaced.
+
+    :Args:
+        path
+            The path to the file that changed
+    """
+
+    def __init__(self, path):
+        super(IOFileConflictError, self).__init__(path, "changed since it was read; left alone")
+
+
+def get_default_encoding():
+    """Get the encoding `open()`:py:func: uses for text files by default."""
+    return locale.getpreferredencoding(False)
+
+
+def is_bytes_compatible_encoding(encoding):
+    """
+    Check whether text in an encoding can be scanned as raw bytes.
+
+    This is true of encodings in which ASCII characters (including newlines
+    and Markdown punctuation) are always encoded as themselves and never
+    appear as part of a multibyte character.
+    """
+    name = codecs.lookup(encoding).name
+    return name in {"ascii", "utf-8"} or name.startswith(("iso8859-", "cp125"))
+
+
+def _get_newline_strings(text):
+    return (b"\n", b"\r\n") if isinstance(text, bytes) else ("\n", "\r\n")
+
+
+def count_newlines(text):
+    """
+    Count the newlines in `text`, a `str` or `bytes` object.
+
+    :Returns:
+        A tuple of (`lf_count`, `crlf_count`), where `lf_count` counts only
+        bare ``\\n`` newlines
+    """
+    (lf, crlf) = _get_newline_strings(text)
+    crlf_count = text.count(crlf)
+    return (text.count(lf) - crlf_count, crlf_count)
+
+
+def normalize_newlines(text, newline):
+    """
+    Give `text`, a `str` or `bytes` object, a single newline convention.
+
+    Conversion is done in bulk, and only when `text` has newlines that do
+    not already match the requested convention.
+
+    :Args:
+        text
+            The text to convert
+
+        newline
+            The newline convention to use: ``"\\n"``, ``"\\r\\n"``, or
+            `NEWLINE_PRESERVE` to leave `text` as it is
+
+    :Returns:
+        A tuple of (`text`, `newline`), where `text` is the converted text
+        (or `text` itself, if unchanged), and `newline` is the convention to
+        use for new lines of output; for `NEWLINE_PRESERVE`, this is the
+        dominant convention in `text`, or `os.linesep`:py:data: if it has no
+        newlines
+    """
+    (lf, crlf) = _get_newline_strings(text)
+    (lf_count, crlf_count) = count_newlines(text)
+    if newline == NEWLINE_PRESERVE:
+        if lf_count == crlf_count == 0:
+            return (text, os.linesep)
+        return (text, "\r\n" if crlf_count > lf_count else "\n")
+    if newline == "\n":
+        if crlf_count > 0:
+            text = text.replace(crlf, lf)
+    elif newline == "\r\n":
+        if lf_count > 0:
+            text = text.replace(crlf, lf).replace(lf, crlf)
+    else:
+        raise ValueError("{newline}: unrecognized newline convention".format(newline=repr(newline)))
+    return (text, newline)
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset_src=offset)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _get_kernel_copy_functions():
+    functions = []
+    if hasattr(os, "copy_file_range"):
+        functions.append(_copy_file_range)
+    if hasattr(os, "sendfile"):
+        functions.append(_sendfile)
+    return functions
+
+
+_KERNEL_COPY_FUNCTIONS = _get_kernel_copy_functions()
+
+
+def _copy_range_in_kernel(copy_function, src_fd, dst_fd, offset, end):
+    """Copy using `copy_function`; return the new offset, or `None` if unsupported."""
+    start = offset
+    while offset < end:
+        try:
+            copied = copy_function(src_fd, dst_fd, offset, end - offset)
+        except OSError as e:
+            if offset == start and e.errno in _UNSUPPORTED_COPY_ERRNOS:
+                return None
+            raise
+        if copied == 0:
+            break
+        offset += copied
+    return offset
+
+
+def _copy_range_with_buffer(src_fd, dst_fd, offset, end):
+    while offset < end:
+        data = os.pread(src_fd, min(COPY_BUFFER_SIZE, end - offset), offset)
+        if not data:
+            break
+        write_all(dst_fd, data)
+        offset += len(data)
+    return offset
+
+
+def write_all(fd, data):
+    """
+    Write all of `data` to a file descriptor, retrying short writes.
+
+    :Args:
+        fd
+            The file descriptor to write to
+
+        data
+            A bytes-like object to write
+    """
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def copy_range(src_fd, dst_fd, offset, count):
+    """
+    Copy a range of bytes from one file descriptor to another.
+
+    The copy is done in the kernel using `os.copy_file_range()`:py:func: or
+    `os.sendfile()`:py:func: where the platform and the files involved
+    support it, falling back to large buffered reads and writes.
+
+    :Args:
+        src_fd
+            The file descriptor to copy from; its file position is not used
+            or changed
+
+        dst_fd
+            The file descriptor to copy to, at its current file position
+
+        offset
+            The offset in `src_fd` at which to start copying
+
+        count
+            The number of bytes to copy
+
+    :Raises:
+        `OSError`:py:exc: if `src_fd` ends before `count` bytes are copied
+    """
+    end = offset + count
+    for copy_function in _KERNEL_COPY_FUNCTIONS:
+        new_offset = _copy_range_in_kernel(copy_function, src_fd, dst_fd, offset, end)
+        if new_offset is not None:
+            offset = new_offset
+            break
+    offset = _copy_range_with_buffer(src_fd, dst_fd, offset, end)
+    if offset < end:
+        raise OSError(errno.EIO, "unexpected end of file while copying {count} bytes".format(count=count))
+
+
+def get_file_fingerprint(file_or_path):
+    """
+    Get a fingerprint which changes whenever a file is changed or replaced, as far as `os.stat()`:py:func: can tell.
+
+    :Args:
+        file_or_path
+            A path, or a file descriptor open on the file (e.g. to take the
+            fingerprint just before reading it)
+
+    :Returns:
+        A tuple of the file's device, inode, size and modification time
+    """
+    file_stat = os.stat(file_or_path)
+    return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def _lock_current_file(path):
+    """
+    Open the file now at `path` and hold an exclusive advisory lock on it, where `fcntl` is available.
+
+    Files are replaced by renaming, so a file may be replaced while waiting
+    for its lock; the lock is then taken again on its replacement.
+
+    :Returns:
+        A file descriptor holding the lock (closing it releases the lock),
+        or `None` if there is no file at `path`
+    """
+    while True:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            locked_stat = os.fstat(fd)
+            current_stat = os.stat(path)
+        except FileNotFoundError:
+            os.close(fd)
+            return None
+        except BaseException:
+            os.close(fd)
+            raise
+        if (locked_stat.st_dev, locked_stat.st_ino) == (current_stat.st_dev, current_stat.st_ino):
+            return fd
+        os.close(fd)
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def _fsync_directory(path):
+    """Flush a directory entry change (such as a rename) to stable storage, where supported."""
+    if os.name != "posix":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_paths(paths):
+    """
+    Flush a batch of written files to stable storage.
+
+    Each file is synced, then each distinct directory containing them, once
+    each; nothing else on the system is flushed.
+
+    :Args:
+        paths
+            A list of paths to files that have been written
+    """
+    directories = set()
+    for path in sorted(set(paths)):
+        # Updated files may be read-only; syncing does not need write access
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(os.path.abspath(path)))
+    for directory in sorted(directories):
+        _fsync_directory(directory)
+
+
 class IOFile(object):
     """
     Provide object model for files that should be read, then written in place.
@@ -53,13 +378,39 @@ class IOFile(object):
     :Args:
         path
             The path to the file to open for input or output
+
+        atomic
+            (optional) If true, write output to a temporary file alongside
+            `path`, which atomically replaces `path` (preserving its
+            permissions) when closed
+
+        sync
+            (optional) For atomic output, one of `SYNC_MODES`; `SYNC_FILE`
+            flushes the file and its directory to stable storage as part of
+            replacing `path`, while `SYNC_NONE` and `SYNC_BATCH` leave that
+            to the operating system or to a later call to `sync_paths()`
+
+    :Attributes:
+        fingerprint
+            For atomic output, the fingerprint of `path` when it was opened
+            for input (see `get_file_fingerprint()`:py:func:), or `None`.
+            If set, `path` is only replaced while it still has this
+            fingerprint, holding a lock on it meanwhile so that other
+            processes updating it in the same way take turns; otherwise
+            `IOFileConflictError`:py:exc: is raised when closing.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, atomic=False, sync=SYNC_NONE):
+        if sync not in SYNC_MODES:
+            raise ValueError("{sync}: unrecognized sync mode".format(sync=sync))
         self.path = path
+        self.atomic = atomic
+        self.sync = sync
         self.mode = None
         self.file = None
         self.printable_name = path
+        self.temp_path = None
+        self.fingerprint = None
 
         self._io_properties = {
             "input": {
@@ -106,6 +457,34 @@ class IOFile(object):
         """
         raise IOFileOpenError(path=self.path, mode=self.mode, purpose=purpose)
 
+    def _get_target_path(self):
+        """Get the path that atomic output replaces, following any symbolic links."""
+        return os.path.realpath(self.path)
+
+    def _create_temp_file(self):
+        """
+        Create a temporary file alongside `self.path`:py:attr: for atomic output.
+
+        :Returns:
+            A file descriptor open for writing on the temporary file, whose
+            path is saved in `self.temp_path`:py:attr:
+        """
+        (directory, basename) = os.path.split(self._get_target_path())
+        (fd, self.temp_path) = tempfile.mkstemp(prefix=".{}.".format(basename), suffix=".tmp", dir=directory)
+        return fd
+
+    def _get_open_target(self, purpose):
+        """
+        Get the path or file descriptor to open for the given purpose.
+
+        :Args:
+            purpose
+                A string with a value of either ``input`` or ``output``
+        """
+        if purpose == "output" and self.atomic:
+            return self._create_temp_file()
+        return self.path
+
     def _open_for_purpose(self, purpose):
         """
         Open `self.file`:py:attr: for the given purpose.
@@ -128,25 +507,105 @@ class IOFile(object):
                 self.file = self._get_io_property(purpose, "stdio_stream")
                 self.printable_name = self._get_io_property(purpose, "stdio_printable_name")
             else:
-                self.file = open(self.path, target_mode)
+                self.file = open(self._get_open_target(purpose), target_mode)
             self.mode = target_mode
         return self.file
 
     def open_for_input(self):
-        """Open `self.file`:py:attr: for input."""
-        return self._open_for_purpose("input")
+        """Open `self.file`:py:attr: for input, noting its fingerprint if it is to be replaced atomically."""
+        was_open = self.file is not None
+        self._open_for_purpose("input")
+        if self.atomic and self.path != "-" and not was_open:
+            self.fingerprint = get_file_fingerprint(self.file.fileno())
+        return self.file
 
     def open_for_output(self):
         """Open `self.file`:py:attr: for output."""
         return self._open_for_purpose("output")
 
+    def _copy_permissions(self, target_path):
+        """Give the temporary file the permissions (and, if allowed, ownership) of `target_path`."""
+        try:
+            target_stat = os.stat(target_path)
+        except FileNotFoundError:
+            os.chmod(self.temp_path, 0o666 & ~_get_umask())
+            return
+        os.chmod(self.temp_path, stat.S_IMODE(target_stat.st_mode))
+        if hasattr(os, "chown"):
+            temp_stat = os.stat(self.temp_path)
+            if (temp_stat.st_uid, temp_stat.st_gid) != (target_stat.st_uid, target_stat.st_gid):
+                try:
+                    os.chown(self.temp_path, target_stat.st_uid, target_stat.st_gid)
+                except PermissionError:
+                    pass
+
+    def _replace_with_temp_file(self):
+        """Close the temporary file and atomically move it over `self.path`:py:attr:."""
+        target_path = self._get_target_path()
+        self.file.flush()
+        if self.sync == SYNC_FILE:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self._copy_permissions(target_path)
+        if self.fingerprint is None:
+            os.replace(self.temp_path, target_path)
+        else:
+            self._replace_if_unchanged(target_path)
+        self.temp_path = None
+        if self.sync == SYNC_FILE:
+            _fsync_directory(os.path.dirname(target_path))
+
+    def _replace_if_unchanged(self, target_path):
+        """
+        Move the temporary file over `target_path`, unless it has changed since it was read.
+
+        :Raises:
+            `IOFileConflictError`:py:exc: if `target_path` has changed, or is gone
+        """
+        fd = _lock_current_file(target_path)
+        if fd is None:
+            raise IOFileConflictError(self.path)
+        try:
+            if get_file_fingerprint(fd) != self.fingerprint:
+                raise IOFileConflictError(self.path)
+            os.replace(self.temp_path, target_path)
+        finally:
+            os.close(fd)
+
+    def _remove_temp_file(self):
+        """Remove any temporary file left over from atomic output."""
+        if self.temp_path is not None:
+            try:
+                os.unlink(self.temp_path)
+            except FileNotFoundError:
+                pass
+            self.temp_path = None
+
     def close(self):
-        """Close `self.file`:py:attr:."""
+        """Close `self.file`:py:attr:, replacing `self.path`:py:attr: with any atomic output."""
         if self.file is not None:
-            if self.path != "-":
-                self.file.close()
-            self.file = None
-            self.mode = None
+            try:
+                if self.temp_path is not None:
+                    self._replace_with_temp_file()
+                elif self.path != "-":
+                    self.file.close()
+                else:
+                    self.file.flush()
+            finally:
+                self._remove_temp_file()
+                self.file = None
+                self.mode = None
+
+    def discard(self):
+        """Close `self.file`:py:attr:, discarding any atomic output instead of using it."""
+        if self.file is not None:
+            try:
+                if self.path != "-":
+                    self.file.close()
+            finally:
+                self._remove_temp_file()
+                self.file = None
+                self.mode = None
 
 
 class TextIOFile(IOFile):
@@ -164,15 +623,43 @@ class TextIOFile(IOFile):
         output_newline
             (optional) The newline convention used on output (see
             `io.open()`:py:meth:)
-    """
 
-    def __init__(self, path, input_newline=None, output_newline=None):
-        super(TextIOFile, self).__init__(path)
+        atomic
+            (optional) See `IOFile`:py:class:
+
+        sync
+            (optional) See `IOFile`:py:class:
+
+        encoding
+            (optional) The text encoding (default: see
+            `get_default_encoding()`:py:func:)
+
+        binary
+            (optional) If true, open files in binary mode so the caller can
+            handle raw bytes directly (for instance, in an encoding for which
+            `is_bytes_compatible_encoding()`:py:func: is true); newline
+            conventions are then left to the caller
+    """
 
-        self._io_properties["input"]["target_mode"] = "rt"
-        self._io_properties["input"]["newline"] = input_newline
-        self._io_properties["output"]["target_mode"] = "wt"
-        self._io_properties["output"]["newline"] = output_newline
+    def __init__(
+        self,
+        path,
+        input_newline=None,
+        output_newline=None,
+        atomic=False,
+        sync=SYNC_NONE,
+        encoding=None,
+        binary=False,
+    ):
+        super(TextIOFile, self).__init__(path, atomic=atomic, sync=sync)
+
+        self.encoding = get_default_encoding() if encoding is None else encoding
+        self.binary = binary
+
+        self._io_properties["input"]["target_mode"] = "rb" if binary else "rt"
+        self._io_properties["input"]["newline"] = None if binary else input_newline
+        self._io_properties["output"]["target_mode"] = "wb" if binary else "wt"
+        self._io_properties["output"]["newline"] = None if binary else output_newline
 
     def _open_for_purpose(self, purpose):
         """
@@ -198,8 +685,114 @@ class TextIOFile(IOFile):
                 fileish = self._get_io_property(purpose, "stdio_stream").fileno()
                 closefd = False
             else:
-                fileish = self.path
+                fileish = self._get_open_target(purpose)
                 closefd = True
-            self.file = io.open(fileish, mode=target_mode, newline=newline, closefd=closefd)
+            if self.binary:
+                self.file = io.open(fileish, mode=target_mode, closefd=closefd)
+            else:
+                self.file = io.open(
+                    fileish,
+                    mode=target_mode,
+                    encoding=self.encoding,
+                    newline=newline,
+                    closefd=closefd,
+                )
             self.mode = target_mode
         return self.file
+
+
+def write_file_atomically(path, data, sync=SYNC_NONE, fingerprint=None):
+    """
+    Replace the file at `path` with `data` (as `bytes`) atomically, so that it is never left half written.
+
+    :Args:
+        sync
+            (optional) See `IOFile`:py:class:
+
+        fingerprint
+            (optional) The fingerprint of the file when it was read (see
+            `get_file_fingerprint()`:py:func:); if given, the file is only
+            replaced if it still has this fingerprint
+
+    :Raises:
+        `IOFileConflictError`:py:exc: if the file has changed since it was read
+    """
+    output_iofile = TextIOFile(path, atomic=True, sync=sync, binary=True)
+    output_iofile.fingerprint = fingerprint
+    output_iofile.open_for_output()
+    try:
+        output_iofile.file.write(data)
+    except BaseException:
+        output_iofile.discard()
+        raise
+    output_iofile.close()
+
+
+def _link_atomically(src_path, dst_path):
+    """
+    Replace `dst_path` with a hard link to `src_path`.
+
+    The link is first made under a random temporary name alongside
+    `dst_path`, trying another name if one is taken (as `tempfile`:py:mod:
+    does), and then renamed over `dst_path`.
+
+    :Returns:
+        `False` if a hard link cannot be made between these paths (e.g.
+        they are on different filesystems, or no temporary name is free),
+        else `True`
+    """
+    try:
+        if os.path.samefile(src_path, dst_path):
+            return True
+    except FileNotFoundError:
+        pass
+    (directory, basename) = os.path.split(dst_path)
+    for _ in range(tempfile.TMP_MAX):
+        temp_path = os.path.join(directory, ".{}.{}.tmp".format(basename, secrets.token_hex(8)))
+        try:
+            os.link(src_path, temp_path)
+        except FileExistsError:
+            continue
+        except OSError as e:
+            if e.errno in _UNSUPPORTED_LINK_ERRNOS:
+                return False
+            raise
+        break
+    else:
+        return False
+    try:
+        os.replace(temp_path, dst_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return True
+
+
+def copy_file_atomically(src_path, dst_path, link=False):
+    """
+    Replace the file at `dst_path` with a copy of the file at `src_path`, atomically.
+
+    `dst_path` is always replaced rather than overwritten, so that if it was
+    a hard link to `src_path`, `src_path` is left alone.
+
+    :Args:
+        link
+            (optional) If true, make `dst_path` a hard link to `src_path`
+            instead of a copy, where possible
+
+    :Returns:
+        `True` if `dst_path` was linked, else `False`
+    """
+    if link and _link_atomically(src_path, dst_path):
+        return True
+    output_iofile = TextIOFile(dst_path, atomic=True, binary=True)
+    output_iofile.open_for_output()
+    try:
+        with open(src_path, "rb") as source:
+            output_iofile.file.flush()
+            copy_range(source.fileno(), output_iofile.file.fileno(), 0, os.fstat(source.fileno()).st_size)
+    except BaseException:
+        output_iofile.discard()
+        raise
+    output_iofile.close()
+    return False
@@ -0,0 +1,179 @@
+"""Find in-document links to headings, and check them against an index of anchors."""
+
+import bisect
+import os
+import re
+import urllib.parse
+
+from . import mdfile
+
+####################
+
+RE_GROUP_TEXT = "text"
+RE_GROUP_TARGET = "target"
+
+INLINE_LINK_PATTERN = r"\[(?P<{text}>[^\]\n]*)\]\((?P<{target}>[^()\s]+)(?:\s+\"[^\"\n]*\")?\)".format(
+    text=RE_GROUP_TEXT, target=RE_GROUP_TARGET
+)
+
+INLINE_LINK_REGEXES = {
+    str: re.compile(INLINE_LINK_PATTERN),
+    bytes: re.compile(INLINE_LINK_PATTERN.encode("ascii")),
+}
+
+URL_SCHEME_REGEX = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*:")
+
+FRAGMENT_CHAR = "#"
+
+MARKDOWN_SUFFIXES = {".md", ".markdown"}
+
+####################
+
+
+class Link(object):
+    """
+    Model a link to a heading anchor.
+
+    :Attributes:
+        path
+            The path of the file containing the link
+
+        line_number
+            The line the link is on
+
+        target
+            The link target as written, e.g. ``other.md#some-heading``
+
+        target_path
+            The path of the file the link refers to (the same as `path` for
+            links within a document)
+
+        anchor
+            The anchor name the link refers to
+    """
+
+    def __init__(self, path, line_number, target, target_path, anchor):
+        self.path = path
+        self.line_number = line_number
+        self.target = target
+        self.target_path = target_path
+        self.anchor = anchor
+
+    def __repr__(self):
+        """Print a human-readable representation of this link."""
+        return "Link(path={path}, line_number={line_number}, target={target})".format(
+            path=repr(self.path), line_number=self.line_number, target=repr(self.target)
+        )
+
+
+def normalize_path(path):
+    """Regularize a path for use as a key in an `AnchorIndex`:py:class:."""
+    return os.path.normcase(os.path.normpath(os.path.abspath(path)))
+
+
+def get_anchors(heading_texts):
+    """
+    Get the set of anchors for headings with the given texts.
+
+    Anchors are made with the same rules as tables of contents (see
+    `mdfile.get_anchor_name()`:py:func:).  Repeated anchors also get the
+    numbered variants GitHub generates for them (``name-1``, ``name-2``, ...).
+    """
+    anchors = set()
+    counts = {}
+    for text in heading_texts:
+        anchor = mdfile.get_anchor_name(text)
+        count = counts.get(anchor, 0)
+        anchors.add(anchor if count == 0 else "{anchor}-{count}".format(anchor=anchor, count=count))
+        counts[anchor] = count + 1
+    return anchors
+
+
+def _parse_target(path, target):
+    """Get the target path and anchor for a link target, or `None` if it is not a link to a Markdown anchor."""
+    if FRAGMENT_CHAR not in target or URL_SCHEME_REGEX.match(target):
+        return None
+    (target_file, anchor) = target.split(FRAGMENT_CHAR, 1)
+    target_file = urllib.parse.unquote(target_file)
+    if target_file:
+        if os.path.splitext(target_file)[1].lower() not in MARKDOWN_SUFFIXES:
+            return None
+        target_path = os.path.join(os.path.dirname(path), target_file)
+    else:
+        target_path = path
+    return (target_path, urllib.parse.unquote(anchor))
+
+
+def iter_links(path, text, scan, encoding="utf-8"):
+    """
+    Generate the links to heading anchors in a Markdown document.
+
+    Both links within the document (``#anchor``) and links to other local
+    Markdown files (``file.md#anchor``) are included, including those in
+    tables of contents; links inside code fences, front matter and HTML
+    comment blocks are not.
+
+    :Args:
+        path
+            The path of the document
+
+        text
+            The text of the document, as `str` or `bytes`
+
+        scan
+            The `mdfile.MarkdownScan`:py:class: for `text`
+
+        encoding
+            (optional) The encoding to decode link targets with, if `text`
+            is `bytes`
+    """
+    newline = b"\n" if isinstance(text, bytes) else "\n"
+    skip_spans = sorted(scan.code_fence_spans + scan.opaque_spans)
+    skip_starts = [start for (start, stop) in skip_spans]
+    (line_number, last_offset) = (1, 0)
+    for match in INLINE_LINK_REGEXES[type(text)].finditer(text):
+        offset = match.start()
+        i = bisect.bisect_right(skip_starts, offset) - 1
+        if i >= 0 and offset < skip_spans[i][1]:
+            continue
+        target = match.group(RE_GROUP_TARGET)
+        if isinstance(target, bytes):
+            target = target.decode(encoding, errors="replace")
+        parsed_target = _parse_target(path, target)
+        if parsed_target is None:
+            continue
+        line_number += text.count(newline, last_offset, offset)
+        last_offset = offset
+        (target_path, anchor) = parsed_target
+        yield Link(path, line_number, target, target_path, anchor)
+
+
+class AnchorIndex(object):
+    """Index the heading anchors in a set of Markdown files, for checking links."""
+
+    def __init__(self):
+        self._anchors = {}
+
+    def __contains__(self, path):
+        return normalize_path(path) in self._anchors
+
+    def add(self, path, anchors):
+        """Add the anchors for the file at `path`, or `None` if it could not be read or parsed."""
+        self._anchors[normalize_path(path)] = None if anchors is None else set(anchors)
+
+    def check(self, link):
+        """
+        Check a link against the index.
+
+        :Returns:
+            `None` if the link is valid, else a description of the problem
+        """
+        path = normalize_path(link.target_path)
+        if path not in self._anchors:
+            return "no such Markdown file"
+        anchors = self._anchors[path]
+        if anchors is None:
+            return "Markdown file could not be read"
+        if link.anchor not in anchors:
+            return "no such anchor"
+        return None
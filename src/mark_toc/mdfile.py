@@ -1,13 +1,27 @@
 """Model a Markdown file as an object."""
 
+import bisect
+import concurrent.futures
+import heapq
+import multiprocessing
+import operator
 import pprint
 import re
 
+from . import iofile
+
 INDENT_WIDTH = 4
 
 LABEL_TOC = "toc"
 LABEL_BEGIN_TOC = "begintoc"
 LABEL_END_TOC = "endtoc"
+LABEL_DIR_TOC = "dirtoc"
+LABEL_BEGIN_DIR_TOC = "begindirtoc"
+LABEL_END_DIR_TOC = "enddirtoc"
+LABEL_SECTION_TOC = "sectiontoc"
+LABEL_BEGIN_SECTION_TOC = "beginsectiontoc"
+LABEL_END_SECTION_TOC = "endsectiontoc"
+
 
 HEADING_CHAR = "#"
 
@@ -36,6 +50,142 @@ TOC_ENTRY_REGEX = re.compile(TOC_ENTRY_REGEX_PATTERN)
 BLANK_LINE_REGEX = re.compile(BLANK_LINE_REGEX_PATTERN)
 COMMENT_REGEX = re.compile(COMMENT_REGEX_PATTERN)
 
+RE_GROUP_REST = "rest"
+
+# Patterns for finding candidate marker lines when scanning a whole document
+# at once.  Each match is confined to a single line, and is guaranteed to run
+# in time linear in the length of that line: no part of a pattern can match
+# what the part after it could, so there is nothing to backtrack over.  The
+# rest of each heading or comment line is checked with plain string methods
+# (see `_get_heading_text()` and `_get_comment_parts()`) for the same reason,
+# since the equivalent regexes backtrack quadratically on long runs of '#'
+# characters or spaces.
+#
+# Rather than starting with a '^' anchor, each pattern starts with a literal
+# character followed by a lookbehind which checks that the literal is at the
+# start of a line.  This lets the regex engine skip quickly from one candidate
+# character to the next instead of trying a match at every line start.
+HEADING_LINE_REGEX_TEMPLATE = r"(?P<{level}>#(?<![^\n]#)#*)(?P<{rest}>[^\n]*)"
+CODE_FENCE_LINE_REGEX_TEMPLATE = r"(?P<{fence}>`(?<![^\n]`)``+)"
+TILDE_FENCE_LINE_REGEX_TEMPLATE = r"(?P<{fence}>~(?<![^\n]~)~~+)"
+COMMENT_LINE_REGEX_TEMPLATE = r"\[(?<![^\n]\[)(?P<{label}>[^\]\n]*)\]: #(?P<{rest}>[^\n]*)"
+
+HEADING_LINE_REGEX_PATTERN = HEADING_LINE_REGEX_TEMPLATE.format(level=RE_GROUP_LEVEL, rest=RE_GROUP_REST)
+CODE_FENCE_LINE_REGEX_PATTERN = CODE_FENCE_LINE_REGEX_TEMPLATE.format(fence=RE_GROUP_FENCE)
+TILDE_FENCE_LINE_REGEX_PATTERN = TILDE_FENCE_LINE_REGEX_TEMPLATE.format(fence=RE_GROUP_FENCE)
+COMMENT_LINE_REGEX_PATTERN = COMMENT_LINE_REGEX_TEMPLATE.format(label=RE_GROUP_LABEL, rest=RE_GROUP_REST)
+
+# An HTML comment block starts with a line beginning with "<!--" and ends
+# with the first line containing "-->" (which may be the same line).
+HTML_COMMENT_START_LINE_REGEX_PATTERN = r"<(?<![^\n]<)!--(?P<{rest}>[^\n]*)".format(rest=RE_GROUP_REST)
+HTML_COMMENT_END_REGEX_PATTERN = r"-->"
+
+# YAML front matter is only recognized at the very start of a document, from
+# a "---" line to the next "---" or "..." line.
+FRONT_MATTER_START_REGEX_PATTERN = r"\A---[ \t]*\r?\n"
+FRONT_MATTER_END_REGEX_PATTERN = r"(?m)^(?:---|\.\.\.)[ \t]*\r?$"
+
+
+def _compile_line_regexes(pattern):
+    """Compile a line-matching regex for scanning both `str` and `bytes` text."""
+    return {
+        str: re.compile(pattern),
+        bytes: re.compile(pattern.encode("ascii")),
+    }
+
+
+HEADING_LINE_REGEXES = _compile_line_regexes(HEADING_LINE_REGEX_PATTERN)
+CODE_FENCE_LINE_REGEXES = _compile_line_regexes(CODE_FENCE_LINE_REGEX_PATTERN)
+TILDE_FENCE_LINE_REGEXES = _compile_line_regexes(TILDE_FENCE_LINE_REGEX_PATTERN)
+COMMENT_LINE_REGEXES = _compile_line_regexes(COMMENT_LINE_REGEX_PATTERN)
+HTML_COMMENT_START_LINE_REGEXES = _compile_line_regexes(HTML_COMMENT_START_LINE_REGEX_PATTERN)
+HTML_COMMENT_END_REGEXES = _compile_line_regexes(HTML_COMMENT_END_REGEX_PATTERN)
+FRONT_MATTER_START_REGEXES = _compile_line_regexes(FRONT_MATTER_START_REGEX_PATTERN)
+FRONT_MATTER_END_REGEXES = _compile_line_regexes(FRONT_MATTER_END_REGEX_PATTERN)
+
+REF_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+
+class _LineChars(object):
+    """Provide the characters used in checking marker lines, as either `str` or `bytes`."""
+
+    def __init__(self, convert):
+        self.cr = convert("\r")
+        self.space = convert(" ")
+        self.heading = convert(HEADING_CHAR)
+        self.heading_trailer = convert(" " + HEADING_CHAR)
+        self.open_paren = convert("(")
+        self.close_paren = convert(")")
+        self.ref = convert(REF_CHARS)
+        self.html_comment_end = convert("-->")
+
+
+_LINE_CHARS = {
+    str: _LineChars(str),
+    bytes: _LineChars(lambda text: text.encode("ascii")),
+}
+
+MARKER_HEADING = "heading"
+MARKER_CODE_FENCE = "code-fence"
+MARKER_TILDE_FENCE = "tilde-fence"
+MARKER_HTML_COMMENT_START = "html-comment-start"
+MARKER_HTML_COMMENT_END = "html-comment-end"
+MARKER_COMMENT = "comment"
+
+SCAN_STATE_TEXT = "text"
+SCAN_STATE_CODE_FENCE = "code-fence"
+SCAN_STATE_TILDE_FENCE = "tilde-fence"
+SCAN_STATE_HTML_COMMENT = "html-comment"
+SCAN_STATE_TOC = "toc"
+SCAN_STATE_DIR_TOC = "dir-toc"
+SCAN_STATE_SECTION_TOC = "section-toc"
+
+SCAN_STATES = [
+    SCAN_STATE_TEXT,
+    SCAN_STATE_CODE_FENCE,
+    SCAN_STATE_TILDE_FENCE,
+    SCAN_STATE_HTML_COMMENT,
+    SCAN_STATE_TOC,
+    SCAN_STATE_DIR_TOC,
+    SCAN_STATE_SECTION_TOC,
+]
+
+# The markers opening and closing each kind of region whose contents are
+# not scanned for headings or tables of contents, by scanning state
+OPENING_MARKERS = {
+    MARKER_CODE_FENCE: SCAN_STATE_CODE_FENCE,
+    MARKER_TILDE_FENCE: SCAN_STATE_TILDE_FENCE,
+    MARKER_HTML_COMMENT_START: SCAN_STATE_HTML_COMMENT,
+}
+CLOSING_MARKERS = {
+    SCAN_STATE_CODE_FENCE: MARKER_CODE_FENCE,
+    SCAN_STATE_TILDE_FENCE: MARKER_TILDE_FENCE,
+    SCAN_STATE_HTML_COMMENT: MARKER_HTML_COMMENT_END,
+}
+
+# The labels of each kind of table of contents token and tokenset, by scanning state
+TOKEN_LABELS = {
+    LABEL_TOC: SCAN_STATE_TOC,
+    LABEL_DIR_TOC: SCAN_STATE_DIR_TOC,
+    LABEL_SECTION_TOC: SCAN_STATE_SECTION_TOC,
+}
+BEGIN_LABELS = {
+    LABEL_BEGIN_TOC: SCAN_STATE_TOC,
+    LABEL_BEGIN_DIR_TOC: SCAN_STATE_DIR_TOC,
+    LABEL_BEGIN_SECTION_TOC: SCAN_STATE_SECTION_TOC,
+}
+END_LABELS = {
+    SCAN_STATE_TOC: LABEL_END_TOC,
+    SCAN_STATE_DIR_TOC: LABEL_END_DIR_TOC,
+    SCAN_STATE_SECTION_TOC: LABEL_END_SECTION_TOC,
+}
+
+DEFAULT_DIR_TOC_PATTERN = "*.md"
+
+DEFAULT_PARALLEL_SCAN_SIZE = 16 * 1024 * 1024
+
+DEFAULT_PARSER_NAME = "regex"
+
 
 ####################
 
@@ -53,6 +203,11 @@ def _make_anchor_name(text):
     return "".join(anchor_text)
 
 
+def get_anchor_name(text):
+    """Get the anchor name for a heading with the given text, as used in tables of contents."""
+    return _make_anchor_name(text)
+
+
 def _make_anchor_ref(text):
     return "#{text}".format(text=text)
 
@@ -91,9 +246,10 @@ def _make_comment(text=None, label="comment"):
 class TocItem(object):
     """Model an item in a table of contents."""
 
-    def __init__(self, text, n):
+    def __init__(self, text, n, target_path=None):
         self.text = text
         self.n = n
+        self.target_path = target_path
 
     def __repr__(self):
         """Print a human-readable representation of this item."""
@@ -103,6 +259,8 @@ class TocItem(object):
         """Format this item at a given indent level with the given options."""
         anchor_name = _make_anchor_name(self.text)
         anchor_ref = _make_anchor_ref(anchor_name)
+        if self.target_path is not None:
+            anchor_ref = self.target_path + anchor_ref
         link = _make_inline_link(self.text, anchor_ref)
         if numbered:
             item_text = _make_numbered_list_item(link, self.n)
@@ -132,23 +290,23 @@ class TocLevel(object):
         text = "TocLevel(level={level}, items={items})".format(level=self.level, items=items_text)
         return text
 
-    def add_item(self, text, level):
-        """Add an item to this level."""
+    def add_item(self, text, level, target_path=None):
+        """Add an item to this level, linking to a heading in `target_path` if given."""
         if self.max_level > 0 and level > self.max_level:
             return self
 
         if level == self.level:
             self.item_count += 1
-            self.items.append(TocItem(text=text, n=self.item_count))
+            self.items.append(TocItem(text=text, n=self.item_count, target_path=target_path))
             return self
 
         if level > self.level:
             new_toc_level = TocLevel(level=self.level + 1, max_level=self.max_level, parent=self)
             self.items.append(new_toc_level)
-            return new_toc_level.add_item(text, level)
+            return new_toc_level.add_item(text, level, target_path)
 
         # level < self.level:
-        return self.parent.add_item(text, level)
+        return self.parent.add_item(text, level, target_path)
 
     def get_toc_levels(self, skip_level):
         """Get the levels for this table of contents, skipping if needed."""
@@ -187,6 +345,34 @@ class TocLevel(object):
         return "\n".join(formatted_items)
 
 
+def format_toc_list(headings, skip_level, numbered, alt_list_char):
+    """
+    Format the items of a table of contents as a (possibly nested) Markdown list.
+
+    This is the one place lists of headings are formatted as Markdown, for
+    tables of contents as well as for `renderers.MarkdownRenderer`:py:class:.
+
+    :Args:
+        headings
+            The top `TocLevel`:py:class: of the headings to list
+
+        skip_level
+            Leave out headings at or above this level, and indent the rest
+            accordingly
+
+        numbered, alt_list_char
+            Formatting options, as for `Toc.format()`:py:meth:
+
+    :Returns:
+        A list of formatted lines (some of which may contain embedded
+        newlines), one for each level left after skipping
+    """
+    return [
+        toc_level.format(numbered=numbered, alt_list_char=alt_list_char, adjust_indent=skip_level)
+        for toc_level in headings.get_toc_levels(skip_level)
+    ]
+
+
 class Toc(object):
     """Model an entire table of contents."""
 
@@ -229,14 +415,7 @@ class Toc(object):
 
         formatted_items.append("")
 
-        for toc_level in self.headings.get_toc_levels(self.skip_level):
-            formatted_items.append(
-                toc_level.format(
-                    numbered=numbered,
-                    alt_list_char=alt_list_char,
-                    adjust_indent=self.skip_level,
-                )
-            )
+        formatted_items.extend(format_toc_list(self.headings, self.skip_level, numbered, alt_list_char))
 
         formatted_items.append("")
         formatted_items.append(_make_comment(comment, label=LABEL_END_TOC))
@@ -245,79 +424,743 @@ class Toc(object):
         return "\n".join(formatted_items)
 
 
+class DirToc(object):
+    """
+    Model a table of contents for the Markdown files in a directory.
+
+    Each file's headings are listed in turn, with links of the form
+    ``file.md#anchor``; `skip_level` and `max_level` apply to each file.
+
+    :Args:
+        pattern
+            The glob pattern selecting the files, relative to the directory
+            of the file containing this table of contents
+    """
+
+    def __init__(self, pattern, skip_level, max_level):
+        self.pattern = pattern
+        self.skip_level = skip_level
+        self.max_level = max_level
+        self.files = []
+
+    def __repr__(self):
+        """Print a human-readable representation of this table of contents."""
+        return "DirToc(pattern={pattern}, files={files})".format(
+            pattern=repr(self.pattern), files=pprint.pformat(self.files)
+        )
+
+    def add_file(self, target_path, headings):
+        """Add the headings (a sequence of `Heading`:py:class:) of the file at link target `target_path`."""
+        file_headings = TocLevel(level=1, max_level=self.max_level)
+        toclevel = file_headings
+        for heading in headings:
+            toclevel = toclevel.add_item(heading.text, heading.level, target_path)
+        self.files.append((target_path, file_headings))
+
+    def format(self, numbered, comment, alt_list_char):
+        """Format this table of contents with the given options."""
+        formatted_items = []
+        begin_comment = None if self.pattern == DEFAULT_DIR_TOC_PATTERN else self.pattern
+        formatted_items.append(_make_comment(begin_comment, label=LABEL_BEGIN_DIR_TOC))
+
+        formatted_items.append("")
+
+        for _, file_headings in self.files:
+            formatted_items.extend(format_toc_list(file_headings, self.skip_level, numbered, alt_list_char))
+
+        formatted_items.append("")
+        formatted_items.append(_make_comment(comment, label=LABEL_END_DIR_TOC))
+        formatted_items.append("")
+
+        return "\n".join(formatted_items)
+
+
+class SectionToc(object):
+    """
+    Model a table of contents for the section enclosing it.
+
+    Only headings nested under the section's own heading (and after the
+    table of contents) are included; `skip_level` and `max_level` apply as
+    for `Toc`:py:class:.
+
+    :Args:
+        section_level
+            The level of the heading starting the section, or 0 if there is
+            no heading before the table of contents
+    """
+
+    def __init__(self, section_level, skip_level, max_level):
+        self.section_level = section_level
+        self.skip_level = max(skip_level, section_level)
+        self.max_level = max_level
+        self.headings = TocLevel(level=1, max_level=self.max_level)
+
+    def __repr__(self):
+        """Print a human-readable representation of this table of contents."""
+        return "SectionToc(section_level={section_level}, headings={headings})".format(
+            section_level=self.section_level, headings=repr(self.headings)
+        )
+
+    def add_item(self, text, level):
+        """Add an item to this table of contents at the given level."""
+        return self.headings.add_item(text, level)
+
+    def format(self, numbered, comment, alt_list_char):
+        """Format this table of contents with the given options."""
+        formatted_items = []
+        formatted_items.append(_make_comment(label=LABEL_BEGIN_SECTION_TOC))
+
+        formatted_items.append("")
+
+        formatted_items.extend(format_toc_list(self.headings, self.skip_level, numbered, alt_list_char))
+
+        formatted_items.append("")
+        formatted_items.append(_make_comment(comment, label=LABEL_END_SECTION_TOC))
+        formatted_items.append("")
+
+        return "\n".join(formatted_items)
+
+
 ####################
 
 
-def _is_eof(text):
-    return text == ""
+class Heading(object):
+    """Model a heading found in a Markdown document."""
+
+    def __init__(self, level, text, line_number, offset):
+        self.level = level
+        self.text = text
+        self.line_number = line_number
+        self.offset = offset
+
+    def __repr__(self):
+        """Print a human-readable representation of this heading."""
+        return "Heading(level={level}, text={text}, line_number={line_number}, offset={offset})".format(
+            level=self.level,
+            text=repr(self.text),
+            line_number=self.line_number,
+            offset=self.offset,
+        )
+
+
+class MarkdownScan(object):
+    """
+    Record the structure found by scanning a Markdown document.
+
+    Spans are ``(start, stop)`` tuples of offsets into the scanned text,
+    covering whole lines including their line endings.
+
+    :Attributes:
+        headings
+            A list of `Heading`:py:class: objects, in document order, for
+            headings outside of code fences and tables of contents
+
+        toc_spans
+            A list of spans, one for each table of contents token or tokenset
+
+        code_fence_spans
+            A list of spans, one for each fenced code block (with either
+            backticks or tildes)
+
+        opaque_spans
+            A list of spans, one for each other region whose contents are
+            not scanned: YAML front matter, and HTML comment blocks
+
+        dir_toc_spans
+            A list of spans, one for each directory table of contents token
+            or tokenset (see `DirToc`:py:class:)
+
+        section_toc_spans
+            A list of spans, one for each section table of contents token or
+            tokenset (see `SectionToc`:py:class:)
+    """
+
+    def __init__(self):
+        self.headings = []
+        self.toc_spans = []
+        self.code_fence_spans = []
+        self.opaque_spans = []
+        self.dir_toc_spans = []
+        self.section_toc_spans = []
+
+    def __repr__(self):
+        """Print a human-readable representation of this scan."""
+        return (
+            "MarkdownScan(headings={headings}, toc_spans={toc_spans}, code_fence_spans={code_fence_spans}, "
+            "opaque_spans={opaque_spans}, dir_toc_spans={dir_toc_spans}, section_toc_spans={section_toc_spans})"
+        ).format(
+            headings=repr(self.headings),
+            toc_spans=repr(self.toc_spans),
+            code_fence_spans=repr(self.code_fence_spans),
+            opaque_spans=repr(self.opaque_spans),
+            dir_toc_spans=repr(self.dir_toc_spans),
+            section_toc_spans=repr(self.section_toc_spans),
+        )
+
+    def has_tocs(self):
+        """Check whether any kind of table of contents was found."""
+        return bool(self.toc_spans or self.dir_toc_spans or self.section_toc_spans)
+
+
+def _get_section_stops(headings):
+    """
+    Find where the section started by each heading ends, in one pass.
+
+    :Returns:
+        A list with, for each heading, the index of the next heading at the
+        same or a higher level (or the number of headings, if none)
+    """
+    stops = [len(headings)] * len(headings)
+    open_sections = []
+    for i, heading in enumerate(headings):
+        while open_sections and headings[open_sections[-1]].level >= heading.level:
+            stops[open_sections.pop()] = i
+        open_sections.append(i)
+    return stops
+
+
+def build_section_tocs(scan, skip_level, max_level):
+    """
+    Build the section tables of contents for a scanned document.
+
+    Each table of contents is found in the (sorted) list of headings by
+    bisection, and its section's extent looked up from stops found in a
+    single pass, so the cost is linear in the size of the document and of
+    the tables of contents, however many there are.
+
+    :Returns:
+        A list of `SectionToc`:py:class:, one for each of `scan.section_toc_spans`
+    """
+    headings = scan.headings
+    offsets = [heading.offset for heading in headings]
+    stops = _get_section_stops(headings)
+    section_tocs = []
+    for start, _ in scan.section_toc_spans:
+        i = bisect.bisect_left(offsets, start)
+        if i == 0:
+            (section_level, stop) = (0, len(headings))
+        else:
+            (section_level, stop) = (headings[i - 1].level, stops[i - 1])
+        section_toc = SectionToc(section_level, skip_level=skip_level, max_level=max_level)
+        toclevel = section_toc
+        for heading in headings[i:stop]:
+            toclevel = toclevel.add_item(heading.text, heading.level)
+        section_tocs.append(section_toc)
+    return section_tocs
+
+
+def _iter_headings(text, start=0):
+    for match in HEADING_LINE_REGEXES[type(text)].finditer(text, start):
+        heading_text = _get_heading_text(match.group(RE_GROUP_REST))
+        if heading_text is not None:
+            yield (match.start(), MARKER_HEADING, (len(match.group(RE_GROUP_LEVEL)), heading_text))
+
+
+def _iter_code_fences(text, start=0):
+    for match in CODE_FENCE_LINE_REGEXES[type(text)].finditer(text, start):
+        yield (match.start(), MARKER_CODE_FENCE, None)
+
+
+def _iter_tilde_fences(text, start=0):
+    for match in TILDE_FENCE_LINE_REGEXES[type(text)].finditer(text, start):
+        yield (match.start(), MARKER_TILDE_FENCE, None)
 
 
-def _is_code_fence(text):
-    if text.endswith("\n"):
-        text = text[:-1]
-    match = CODE_FENCE_REGEX.search(text)
-    return match is not None
+def _iter_html_comments(text, start=0):
+    """Generate markers for the start and end of each HTML comment block spanning more than one line."""
+    chars = _LINE_CHARS[type(text)]
+    starts = (
+        (match.start(), MARKER_HTML_COMMENT_START, None)
+        for match in HTML_COMMENT_START_LINE_REGEXES[type(text)].finditer(text, start)
+        if chars.html_comment_end not in match.group(RE_GROUP_REST)
+    )
+    ends = (
+        (match.start(), MARKER_HTML_COMMENT_END, None)
+        for match in HTML_COMMENT_END_REGEXES[type(text)].finditer(text, start)
+    )
+    return heapq.merge(starts, ends, key=operator.itemgetter(0))
 
 
-def _get_comment(text):
-    if text.endswith("\n"):
-        text = text[:-1]
-    match = COMMENT_REGEX.search(text)
-    label = None
-    ref = None
+def _iter_comments(text, start=0):
+    for match in COMMENT_LINE_REGEXES[type(text)].finditer(text, start):
+        parts = _get_comment_parts(match.group(RE_GROUP_LABEL), match.group(RE_GROUP_REST))
+        if parts is not None:
+            yield (match.start(), MARKER_COMMENT, parts)
+
+
+def _get_line_stop(text, offset):
+    """Get the offset just past the end of the line containing `offset`."""
+    stop = text.find(b"\n" if isinstance(text, bytes) else "\n", offset)
+    return len(text) if stop < 0 else stop + 1
+
+
+def _split_last_line(text):
+    """Split `text` into everything before its last line, and its last line."""
+    newline = b"\n" if isinstance(text, bytes) else "\n"
+    start = text.rfind(newline, 0, len(text) - 1) + 1
+    return (text[:start], text[start:])
+
+
+def _strip_cr(rest, chars):
+    """Strip the carriage return from a "\\r\\n" line ending; return `None` for any other."""
+    if rest.endswith(chars.cr):
+        rest = rest[:-1]
+    return None if chars.cr in rest else rest
+
+
+def _get_heading_text(rest):
+    """
+    Get the text of a heading, given the rest of its line after the leading '#'s.
+
+    This is equivalent to matching ``^ *(?P<text>.*[^ #])( *#+)?$``, in
+    linear time.
+
+    :Returns:
+        The heading text, or `None` if this is not a heading
+    """
+    chars = _LINE_CHARS[type(rest)]
+    rest = _strip_cr(rest, chars)
+    if rest is None:
+        return None
+    rest = rest.lstrip(chars.space)
+    text = rest.rstrip(chars.heading_trailer)
+    if not text:
+        return None
+    trailer = rest[len(text) :]
+    closing = trailer.lstrip(chars.space)
+    if trailer and not (closing and not closing.strip(chars.heading)):
+        return None
+    return text
+
+
+def _get_comment_parts(label, rest):
+    """
+    Get the parts of a comment, given its label and the rest of its line after ``: #``.
+
+    This is equivalent to matching ``^(?P<ref>[-0-9A-Za-z]*)( +\\((?P<comment>[^\\)]*)\\))? *$``,
+    in linear time.
+
+    :Returns:
+        A tuple of (`label`, `ref`, `comment`), or `None` if this is not a
+        comment; `comment` is `None` if there is no comment text
+    """
+    chars = _LINE_CHARS[type(rest)]
+    rest = _strip_cr(rest, chars)
+    if rest is None or chars.cr in label:
+        return None
+    remainder = rest.lstrip(chars.ref)
+    ref = rest[: len(rest) - len(remainder)]
     comment = None
-    if match is not None:
-        label = match.group(RE_GROUP_LABEL)
-        ref = match.group(RE_GROUP_REF)
-        comment = match.group(RE_GROUP_COMMENT)
+    stripped = remainder.lstrip(chars.space)
+    if stripped:
+        if stripped is remainder or not stripped.startswith(chars.open_paren):
+            return None
+        close = stripped.find(chars.close_paren)
+        if close < 0 or stripped[close + 1 :].strip(chars.space):
+            return None
+        comment = stripped[1:close]
     return (label, ref, comment)
 
 
-def _is_single_toc_token(line):
-    if _is_eof(line):
-        return False
-    (label, _ref, _comment) = _get_comment(line)
-    return label == LABEL_TOC
+def _get_label(comment_parts):
+    label = comment_parts[0]
+    # Labels we act on are ASCII; latin-1 decodes any bytes losslessly.
+    return label.decode("latin-1") if isinstance(label, bytes) else label
+
+
+def _format_position(filename, line_number):
+    if filename is None:
+        return "line {line_number}".format(line_number=line_number)
+    return "{filename}:{line_number}".format(filename=filename, line_number=line_number)
+
+
+def get_front_matter_stop(text):
+    """
+    Find the end of the YAML front matter at the start of `text`, if any.
+
+    :Returns:
+        The offset just past the closing ``---`` or ``...`` line, or 0 if
+        `text` does not start with front matter
+    """
+    start_match = FRONT_MATTER_START_REGEXES[type(text)].match(text)
+    if start_match is None:
+        return 0
+    end_match = FRONT_MATTER_END_REGEXES[type(text)].search(text, start_match.end())
+    if end_match is None:
+        return 0
+    return _get_line_stop(text, end_match.start())
+
+
+def may_have_tocs(text):
+    """
+    Check quickly whether `text` may have tables of contents, without scanning it.
+
+    This only looks for comments starting a table of contents, wherever they
+    are (even in code blocks), so a false result is certain but a true one
+    is not.
+
+    :Args:
+        text
+            The text to check, as `str`, or as `bytes` in an encoding for
+            which `iofile.is_bytes_compatible_encoding()`:py:func: is true
+    """
+    for _, _, comment_parts in _iter_comments(text):
+        label = _get_label(comment_parts)
+        if label in TOKEN_LABELS or label in BEGIN_LABELS:
+            return True
+    return False
+
+
+def _iter_markers(text, start=0):
+    """
+    Generate the marker lines in `text`, in document order, from offset `start`.
+
+    Each marker is a tuple of (`offset`, `kind`, `value`, `line_index`),
+    where `line_index` is the zero-based line number within `text`.
+    """
+    newline = b"\n" if isinstance(text, bytes) else "\n"
+    markers = heapq.merge(
+        _iter_headings(text, start),
+        _iter_code_fences(text, start),
+        _iter_tilde_fences(text, start),
+        _iter_html_comments(text, start),
+        _iter_comments(text, start),
+        key=operator.itemgetter(0),
+    )
+    line_index = 0
+    last_offset = 0
+    for offset, kind, value in markers:
+        line_index += text.count(newline, last_offset, offset)
+        last_offset = offset
+        yield (offset, kind, value, line_index)
+
+
+class _ChunkScan(object):
+    """
+    Record the result of scanning a chunk of a document from a given starting state.
+
+    Offsets are relative to the whole document; line numbers are zero-based
+    line indexes within the chunk.
+
+    :Attributes:
+        exit_state
+            The scanning state at the end of the chunk
+
+        entry_span_stop
+            If the chunk starts inside a code fence, opaque region or table
+            of contents, the offset where that span ends, if it ends within
+            this chunk
+
+        exit_span_start
+            If the chunk ends inside a code fence, opaque region or table of
+            contents, the offset where that span starts, if it starts within
+            this chunk
+
+        error
+            A tuple of (`message`, `line_index`) describing invalid syntax,
+            or `None`
+    """
+
+    def __init__(self, entry_state):
+        self.exit_state = entry_state
+        self.headings = []
+        self.toc_spans = []
+        self.code_fence_spans = []
+        self.opaque_spans = []
+        self.dir_toc_spans = []
+        self.section_toc_spans = []
+        self.entry_span_stop = None
+        self.exit_span_start = None
+        self.error = None
+
+    def close_span(self, spans, span_start, span_stop):
+        """Record a span ending at `span_stop`; a `span_start` of `None` means it started before this chunk."""
+        if span_start is None:
+            self.entry_span_stop = span_stop
+        else:
+            spans.append((span_start, span_stop))
+
+
+def _scan_markers(text, markers, entry_state, encoding, base_offset):
+    """Run the scanning state machine over the markers in a chunk of text."""
+    chunk_scan = _ChunkScan(entry_state)
+    state = entry_state
+    span_start = None
+    spans = {
+        SCAN_STATE_CODE_FENCE: chunk_scan.code_fence_spans,
+        SCAN_STATE_TILDE_FENCE: chunk_scan.code_fence_spans,
+        SCAN_STATE_HTML_COMMENT: chunk_scan.opaque_spans,
+        SCAN_STATE_TOC: chunk_scan.toc_spans,
+        SCAN_STATE_DIR_TOC: chunk_scan.dir_toc_spans,
+        SCAN_STATE_SECTION_TOC: chunk_scan.section_toc_spans,
+    }
+    for offset, kind, value, line_index in markers:
+        if state in END_LABELS:
+            if kind != MARKER_COMMENT:
+                continue
+            label = _get_label(value)
+            if label in TOKEN_LABELS or label in BEGIN_LABELS:
+                chunk_scan.error = ("invalid syntax: nested [{label}]".format(label=label), line_index)
+                break
+            if label == END_LABELS[state]:
+                span_stop = base_offset + _get_line_stop(text, offset)
+                chunk_scan.close_span(spans[state], span_start, span_stop)
+                state = SCAN_STATE_TEXT
+        elif state in CLOSING_MARKERS:
+            if kind == CLOSING_MARKERS[state]:
+                span_stop = base_offset + _get_line_stop(text, offset)
+                chunk_scan.close_span(spans[state], span_start, span_stop)
+                state = SCAN_STATE_TEXT
+        elif kind in OPENING_MARKERS:
+            state = OPENING_MARKERS[kind]
+            span_start = base_offset + offset
+        elif kind == MARKER_COMMENT:
+            label = _get_label(value)
+            if label in TOKEN_LABELS:
+                spans[TOKEN_LABELS[label]].append((base_offset + offset, base_offset + _get_line_stop(text, offset)))
+            elif label in BEGIN_LABELS:
+                state = BEGIN_LABELS[label]
+                span_start = base_offset + offset
+        elif kind == MARKER_HEADING:
+            (heading_level, heading_text) = value
+            if isinstance(heading_text, bytes):
+                heading_text = heading_text.decode(encoding)
+            chunk_scan.headings.append(Heading(heading_level, heading_text, line_index, base_offset + offset))
+    chunk_scan.exit_state = state
+    if state != SCAN_STATE_TEXT:
+        chunk_scan.exit_span_start = span_start
+    return chunk_scan
+
+
+def _scan_chunk(text, encoding, entry_states, base_offset=0, start=0):
+    """
+    Scan a chunk of text once for each of the given starting states.
+
+    The regex matching is done only once; only the (cheap) state machine
+    over the resulting markers is repeated.  Anything before offset `start`
+    in the chunk (i.e. front matter) is skipped, but still counted in line
+    numbers.
+
+    :Returns:
+        A tuple of (`newline_count`, `chunk_scans`), where `chunk_scans` maps
+        each of `entry_states` to a `_ChunkScan`:py:class:
+    """
+    markers = list(_iter_markers(text, start))
+    chunk_scans = {state: _scan_markers(text, markers, state, encoding, base_offset) for state in entry_states}
+    newline_count = text.count(b"\n" if isinstance(text, bytes) else "\n")
+    return (newline_count, chunk_scans)
+
+
+_forked_text = None
+
 
+def _scan_forked_chunk(start, stop, encoding, entry_states, skip_stop):
+    """Scan a chunk of the text inherited from the parent process (see `_scan_parallel()`:py:func:)."""
+    return _scan_chunk(_forked_text[start:stop], encoding, entry_states, base_offset=start, start=skip_stop)
 
-def _is_begin_toc_token(line):
-    if _is_eof(line):
-        return False
-    (label, _ref, _comment) = _get_comment(line)
-    return label == LABEL_BEGIN_TOC
 
+def _scan_pickled_chunk(chunk_text, encoding, entry_states, base_offset, skip_stop):
+    """Scan a chunk of text sent to the worker process."""
+    return _scan_chunk(chunk_text, encoding, entry_states, base_offset=base_offset, start=skip_stop)
 
-def _is_end_toc_token(line):
-    if _is_eof(line):
-        return False
-    (label, _ref, _comment) = _get_comment(line)
-    return label == LABEL_END_TOC
 
+def _scan_parallel(text, chunks, encoding, jobs, front_matter_stop=0):
+    """
+    Scan chunks of text in parallel worker processes.
+
+    Where processes can be forked, the workers inherit the text rather than
+    having each chunk copied to them.
+    """
+    global _forked_text  # noqa: PLW0603
+    entry_states = [[SCAN_STATE_TEXT] if start == 0 else SCAN_STATES for (start, stop) in chunks]
+    encodings = [encoding] * len(chunks)
+    skip_stops = [min(max(0, front_matter_stop - start), stop - start) for (start, stop) in chunks]
+    if "fork" in multiprocessing.get_all_start_methods():
+        _forked_text = text
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                starts, stops = zip(*chunks)
+                return list(executor.map(_scan_forked_chunk, starts, stops, encodings, entry_states, skip_stops))
+        finally:
+            _forked_text = None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        chunk_texts = [text[start:stop] for (start, stop) in chunks]
+        base_offsets = [start for (start, stop) in chunks]
+        return list(executor.map(_scan_pickled_chunk, chunk_texts, encodings, entry_states, base_offsets, skip_stops))
+
+
+def _split_chunks(text, count):
+    """Split `text` into about `count` chunks of about the same size, at line boundaries."""
+    newline = b"\n" if isinstance(text, bytes) else "\n"
+    chunk_size = max(1, len(text) // count)
+    boundaries = [0]
+    while boundaries[-1] < len(text):
+        boundary = text.find(newline, boundaries[-1] + chunk_size - 1)
+        boundaries.append(len(text) if boundary < 0 else boundary + 1)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _merge_chunk_scans(chunk_results, text_length, filename):
+    """
+    Combine the scans of consecutive chunks into a scan of the whole document.
+
+    This resolves the state each chunk starts in with a prefix scan over the
+    per-chunk results, picking each chunk's scan for the state that the
+    previous chunk ended in.
+    """
+    scan = MarkdownScan()
+    spans = {
+        SCAN_STATE_CODE_FENCE: scan.code_fence_spans,
+        SCAN_STATE_TILDE_FENCE: scan.code_fence_spans,
+        SCAN_STATE_HTML_COMMENT: scan.opaque_spans,
+        SCAN_STATE_TOC: scan.toc_spans,
+        SCAN_STATE_DIR_TOC: scan.dir_toc_spans,
+        SCAN_STATE_SECTION_TOC: scan.section_toc_spans,
+    }
+    state = SCAN_STATE_TEXT
+    open_span_start = None
+    line_base = 1
+    for newline_count, chunk_scans in chunk_results:
+        chunk_scan = chunk_scans[state]
+        if chunk_scan.error is not None:
+            (message, line_index) = chunk_scan.error
+            raise ValueError(message, _format_position(filename, line_base + line_index))
+        if chunk_scan.entry_span_stop is not None:
+            spans[state].append((open_span_start, chunk_scan.entry_span_stop))
+        for heading in chunk_scan.headings:
+            heading.line_number += line_base
+        scan.headings.extend(chunk_scan.headings)
+        scan.toc_spans.extend(chunk_scan.toc_spans)
+        scan.code_fence_spans.extend(chunk_scan.code_fence_spans)
+        scan.opaque_spans.extend(chunk_scan.opaque_spans)
+        scan.dir_toc_spans.extend(chunk_scan.dir_toc_spans)
+        scan.section_toc_spans.extend(chunk_scan.section_toc_spans)
+        if chunk_scan.exit_span_start is not None:
+            open_span_start = chunk_scan.exit_span_start
+        state = chunk_scan.exit_state
+        line_base += newline_count
+    if state != SCAN_STATE_TEXT:
+        spans[state].append((open_span_start, text_length))
+    return scan
+
+
+def scan_markdown(text, encoding="utf-8", filename=None, jobs=1):
+    """
+    Scan Markdown text for headings, code fences and tables of contents.
+
+    The text is scanned as a whole, with one regex per kind of marker line;
+    the resulting matches are merged in document order, so ordinary lines
+    cost no Python-level work.
 
-def _is_toc_token(line):
-    if _is_eof(line):
-        return False
-    (label, _ref, _comment) = _get_comment(line)
-    return label in {LABEL_TOC, LABEL_BEGIN_TOC}
+    Regions whose contents are not Markdown (YAML front matter, HTML comment
+    blocks, and code fences with either backticks or tildes) are recorded as
+    spans; nothing inside them is taken for a heading or a table of
+    contents.  Front matter is skipped without being matched at all.
 
+    With more than one job, the text is split into line-aligned chunks which
+    are scanned in parallel worker processes, each from every possible
+    starting state; the results are then stitched together in order.  The
+    result is identical to scanning sequentially.
 
-def _get_heading(text):
-    # NOTE: This only handles the "atx"-style headings beginning with '#',
-    # not the "setext"-style using "underlines" of '=' or '-'.
-    #
-    # TODO: We really should be using a full Markdown parser to detect text elements
-    # instead of limited and potentially fragile regexes....
-    if text.endswith("\n"):
-        text = text[:-1]
-    match = HEADING_REGEX.search(text)
-    if match is None:
-        heading_text = None
-        heading_level = 0
+    A table of contents is defined as either:
+
+        `toc-comment`
+
+    or:
+
+        `begin-toc-comment`
+        `zero-or-more-non-end-toc-comment-lines`
+        `end-toc-comment`
+
+    Directory and section tables of contents (see `DirToc`:py:class: and
+    `SectionToc`:py:class:) are defined the same way, with their own
+    comment labels.
+
+    NOTE: This only handles the "atx"-style headings beginning with '#',
+    not the "setext"-style using "underlines" of '=' or '-'.
+
+    :Args:
+        text
+            The text to scan, as either `str` or `bytes`
+
+        encoding
+            (optional) The encoding to decode heading text with, if `text`
+            is `bytes`
+
+        filename
+            (optional) A printable filename to use in error messages
+
+        jobs
+            (optional) The number of worker processes to scan with
+
+    :Returns:
+        A `MarkdownScan`:py:class:
+
+    :Raises:
+        `ValueError`:py:exc: if the table of contents syntax is invalid
+    """
+    front_matter_stop = get_front_matter_stop(text)
+    chunks = _split_chunks(text, jobs) if jobs > 1 else [(0, len(text))]
+    if len(chunks) > 1:
+        chunk_results = _scan_parallel(text, chunks, encoding, jobs, front_matter_stop)
     else:
-        heading_text = match.group(RE_GROUP_TEXT)
-        heading_level_text = match.group(RE_GROUP_LEVEL)
-        heading_level = len(heading_level_text)
-    return (heading_text, heading_level)
+        chunk_results = [_scan_chunk(text, encoding, [SCAN_STATE_TEXT], start=front_matter_stop)]
+    scan = _merge_chunk_scans(chunk_results, len(text), filename)
+    if front_matter_stop > 0:
+        scan.opaque_spans.insert(0, (0, front_matter_stop))
+    return scan
+
+
+def scan_parsed_markdown(text, headings, code_fence_spans, opaque_spans=(), encoding="utf-8", filename=None):
+    """
+    Scan Markdown text for tables of contents, given headings and code blocks found by another parser.
+
+    Tables of contents are found just as by `scan_markdown()`:py:func:,
+    except that table of contents comments inside `code_fence_spans` or
+    `opaque_spans` are ignored, and headings inside tables of contents are
+    left out.
+
+    :Args:
+        headings
+            A list of ``(offset, level, text, line_index)`` tuples, in
+            document order, where `line_index` is the zero-based line number
+
+        code_fence_spans
+            A sorted list of ``(start, stop)`` spans of code blocks
+
+        opaque_spans
+            (optional) A sorted list of ``(start, stop)`` spans of other
+            regions to ignore (e.g. HTML blocks)
+
+    :Returns:
+        A `MarkdownScan`:py:class:
+
+    :Raises:
+        `ValueError`:py:exc: if the table of contents syntax is invalid
+    """
+    skip_spans = sorted(list(code_fence_spans) + list(opaque_spans))
+    skip_starts = [start for (start, stop) in skip_spans]
+    newline = b"\n" if isinstance(text, bytes) else "\n"
+    markers = []
+    (line_index, last_offset) = (0, 0)
+    for offset, kind, value in _iter_comments(text):
+        i = bisect.bisect_right(skip_starts, offset) - 1
+        if i >= 0 and offset < skip_spans[i][1]:
+            continue
+        line_index += text.count(newline, last_offset, offset)
+        last_offset = offset
+        markers.append((offset, kind, value, line_index))
+    markers.extend(
+        (offset, MARKER_HEADING, (level, heading_text), heading_line_index)
+        for (offset, level, heading_text, heading_line_index) in headings
+    )
+    markers.sort(key=operator.itemgetter(0))
+    chunk_scan = _scan_markers(text, markers, SCAN_STATE_TEXT, encoding, 0)
+    chunk_scan.code_fence_spans = list(code_fence_spans)
+    chunk_scan.opaque_spans = list(opaque_spans)
+    return _merge_chunk_scans([(text.count(newline), {SCAN_STATE_TEXT: chunk_scan})], len(text), filename)
 
 
 ####################
@@ -340,114 +1183,218 @@ class MarkdownFile(object):
         outfile
             (optional) The output file to write to; if not supplied, must be
             supplied when writing.
+
+        encoding
+            (optional) The encoding of `infile` and `outfile` when they are
+            binary files; headings and the table of contents are the only
+            text decoded or encoded (default: UTF-8).
+
+        newline
+            (optional) The newline convention for output: ``"\\n"``,
+            ``"\\r\\n"``, or `iofile.NEWLINE_PRESERVE` to keep the input's
+            own convention; if not supplied, input is passed through as is
+            and the table of contents uses ``"\\n"``.  Input without any
+            table of contents is always passed through as is.
+
+        jobs
+            (optional) The number of worker processes to scan large input
+            with (see `scan_markdown()`:py:func:; default: 1).
+
+        parallel_scan_size
+            (optional) The minimum input size, in bytes or characters, to
+            scan in parallel when `jobs` is more than 1.
+
+        parser
+            (optional) The parser backend to scan with, as an object with a
+            ``scan(text, encoding, filename, jobs)`` method returning a
+            `MarkdownScan`:py:class: (see `parsers.Parser`:py:class:); if not
+            supplied, `scan_markdown()`:py:func: is used.
     """
 
-    def __init__(self, infile, infilename=None, outfile=None):
+    def __init__(
+        self,
+        infile,
+        infilename=None,
+        outfile=None,
+        encoding=None,
+        newline=None,
+        jobs=1,
+        parallel_scan_size=DEFAULT_PARALLEL_SCAN_SIZE,
+        parser=None,
+    ):
         self.infile = infile
         self.infilename = infilename
         self.outfile = outfile
-        self.line_index = None
-        self.lines = None
+        self.encoding = "utf-8" if encoding is None else encoding
+        self.newline = newline
+        self.jobs = jobs
+        self.parallel_scan_size = parallel_scan_size
+        self.parser = parser
+        self.output_newline = "\n"
+        self.newlines_converted = False
+        self.input_text = None
+        self.text = None
         self.toc = None
+        self.dir_tocs = None
+        self.section_tocs = []
+        self._scan = None
+        self._formatted_toc = None
+        self._formatted_tocs = {}
+
+    @property
+    def is_bytes(self):
+        """Whether the input was read as raw bytes rather than text."""
+        return isinstance(self.input_text, bytes)
 
     @property
     def filename(self):
         """Printable input filename."""
         return self.infile.name if self.infilename is None else self.infilename
 
-    def get_file_position(self):
+    def get_file_position(self, line_number=None):
         """Get a printable filename and line number."""
-        if self.line_index is None:
+        if line_number is None:
             return self.filename
-        return "{filename}:{line_number}".format(filename=self.filename, line_number=self.line_index + 1)
-
-    def get_next_line(self, reset=False):
-        """Get the "next" line from the set of lines."""
-        if reset or self.line_index is None:
-            self.line_index = 0
-        else:
-            self.line_index += 1
-        if self.line_index + 1 > len(self.lines):
-            return ""
-        return self.lines[self.line_index]
+        return _format_position(self.filename, line_number)
 
-    def consume_toc(self, line):
+    def read(self, force=False):
         """
-        Consume a table of contents token or tokenset.
+        Read the Markdown file and return the raw input text.
 
-        A table of contents is defined as either:
-
-            `toc-comment`
+        If `newline`:py:attr: calls for it, newlines are converted in bulk
+        into `text`:py:attr:; the returned text is always the input as read.
+        """
+        if force or self.text is None:
+            self.input_text = self.infile.read()
+            if self.newline is None:
+                self.text = self.input_text
+            else:
+                (self.text, self.output_newline) = iofile.normalize_newlines(self.input_text, self.newline)
+            self.newlines_converted = self.text is not self.input_text
+            self._scan = None
+            self._formatted_toc = None
+            self.dir_tocs = None
+            self.section_tocs = []
+            self._formatted_tocs = {}
+        return self.input_text
 
-        or:
+    @property
+    def parser_name(self):
+        """The name of the parser backend used for scanning."""
+        return DEFAULT_PARSER_NAME if self.parser is None else self.parser.name
+
+    def scan_text(self, text):
+        """Scan `text` (e.g. `text`:py:attr: or `input_text`:py:attr:) with this file's parser backend and options."""
+        jobs = self.jobs if len(text) >= self.parallel_scan_size else 1
+        if self.parser is None:
+            return scan_markdown(text, encoding=self.encoding, filename=self.filename, jobs=jobs)
+        return self.parser.scan(text, encoding=self.encoding, filename=self.filename, jobs=jobs)
+
+    def scan(self):
+        """Scan the Markdown file (see `scan_markdown()`:py:func:) and return the result."""
+        if self._scan is None:
+            self.read()
+            self._scan = self.scan_text(self.text)
+            if self.newlines_converted and not self._scan.has_tocs():
+                # Leave a file without tables of contents exactly as it is
+                self.text = self.input_text
+                self.newlines_converted = False
+                self._scan = self.scan_text(self.text)
+        return self._scan
+
+    def set_scan(self, scan):
+        """Use a scan from elsewhere (e.g. a `headingindex.HeadingIndex`:py:class:) instead of scanning."""
+        self.read()
+        self._scan = scan
+
+    def can_splice(self):
+        """Check whether output can be spliced from the input file (see `splice()`:py:meth:)."""
+        return self.is_bytes and not self.newlines_converted
+
+    def get_dir_toc_pattern(self, span):
+        """Get the glob pattern for the directory table of contents at `span` (one of `scan().dir_toc_spans`)."""
+        match = COMMENT_LINE_REGEXES[type(self.text)].match(self.text, span[0])
+        (_, _, pattern) = _get_comment_parts(match.group(RE_GROUP_LABEL), match.group(RE_GROUP_REST))
+        if isinstance(pattern, bytes):
+            pattern = pattern.decode(self.encoding)
+        if pattern is None or not pattern.strip():
+            return DEFAULT_DIR_TOC_PATTERN
+        return pattern.strip()
+
+    def set_dir_tocs(self, dir_tocs):
+        """
+        Supply the directory tables of contents, as a list of `DirToc`:py:class: matching `scan().dir_toc_spans`.
 
-            `begin-toc-comment`
-            `zero-or-more-non-end-toc-comment-lines`
-            `end-toc-comment`
+        Until this is called, directory tables of contents are left as they are.
         """
-        lines = [line]
-        seen_toc = False
-        in_toc = False
-        while not _is_eof(line):
-            if _is_single_toc_token(line):
-                if seen_toc:
-                    raise ValueError(
-                        "invalid syntax: nested [{toc}]".format(toc=LABEL_TOC),
-                        self.get_file_position(),
-                    )
-            elif _is_begin_toc_token(line):
-                if seen_toc:
-                    raise ValueError(
-                        "invalid syntax: nested [{begintoc}]".format(begintoc=LABEL_BEGIN_TOC),
-                        self.get_file_position(),
-                    )
-                seen_toc = True
-                in_toc = True
-            elif _is_end_toc_token(line):
-                if not seen_toc:
-                    raise ValueError(
-                        "invalid syntax: dangling [{endtoc}]".format(endtoc=LABEL_END_TOC),
-                        self.get_file_position(),
-                    )
-                in_toc = False
-            if not in_toc:
-                break
-            line = self.get_next_line()
-            lines.append(line)
-        return "".join(lines)
-
-    def skip_toc(self, line):
-        """Skip over a table of contents starting on `line`."""
-        if _is_toc_token(line):
-            self.consume_toc(line)
-            line = self.get_next_line()
-        return line
-
-    def consume_code_fence(self, line):
-        """Consume a code fence."""
-        lines = [line]
-        in_code_fence = False
-        while not _is_eof(line):
-            if _is_code_fence(line):
-                in_code_fence = not in_code_fence
-            if not in_code_fence:
-                break
-            line = self.get_next_line()
-            lines.append(line)
-        return "".join(lines)
+        self.dir_tocs = dir_tocs
+        self._formatted_tocs = {}
+
+    def _encode_toc(self, toc_text):
+        """Convert a formatted table of contents to the output newline and encoding."""
+        if self.output_newline != "\n":
+            toc_text = toc_text.replace("\n", self.output_newline)
+        if self.is_bytes:
+            toc_text = toc_text.encode(self.encoding)
+        return toc_text
+
+    def format_toc(self, numbered, toc_comment, alt_list_char, add_trailing_heading_chars):
+        """
+        Format the table of contents for output, with the output newline and encoding.
 
-    def skip_code_fence(self, line):
-        """Skip over any code fence starting on `line`."""
-        if _is_code_fence(line):
-            self.consume_code_fence(line)
-            line = self.get_next_line()
-        return line
+        The result is kept, so that formatting again with the same options
+        costs nothing.
+        """
+        options = (numbered, toc_comment, alt_list_char, add_trailing_heading_chars)
+        if self._formatted_toc is not None and self._formatted_toc[0] == options:
+            return self._formatted_toc[1]
+        toc_text = self.toc.format(
+            numbered=numbered,
+            comment=toc_comment,
+            alt_list_char=alt_list_char,
+            add_trailing_heading_chars=add_trailing_heading_chars,
+        )
+        toc_text = self._encode_toc(toc_text)
+        self._formatted_toc = (options, toc_text)
+        return toc_text
+
+    def _format_other_toc(self, toc, numbered, toc_comment, alt_list_char):
+        """Format a `DirToc`:py:class: or `SectionToc`:py:class: (see `format_toc()`:py:meth:)."""
+        key = (id(toc), numbered, toc_comment, alt_list_char)
+        if key not in self._formatted_tocs:
+            toc_text = toc.format(numbered=numbered, comment=toc_comment, alt_list_char=alt_list_char)
+            self._formatted_tocs[key] = self._encode_toc(toc_text)
+        return self._formatted_tocs[key]
+
+    def iter_tocs(self, numbered, toc_comment, alt_list_char, add_trailing_heading_chars):
+        """
+        Generate the new tables of contents, in document order.
 
-    def read(self, force=False):
-        """Read the Markdown file and return the raw input text."""
-        if force or self.lines is None:
-            self.lines = self.infile.readlines()
-        return "".join(self.lines)
+        Each is a tuple of (`start`, `stop`, `toc_text`, `end_label`), where
+        `start` and `stop` are the offsets of the existing table of contents.
+        Directory tables of contents are left out until supplied (see
+        `set_dir_tocs()`:py:meth:).
+        """
+        scan = self.scan()
+        tocs = [(start, stop, None, LABEL_END_TOC) for (start, stop) in scan.toc_spans]
+        other_tocs = [(scan.section_toc_spans, self.section_tocs, LABEL_END_SECTION_TOC)]
+        if self.dir_tocs is not None:
+            other_tocs.append((scan.dir_toc_spans, self.dir_tocs, LABEL_END_DIR_TOC))
+        for spans, other_toc_list, end_label in other_tocs:
+            if spans:
+                tocs.extend((start, stop, toc, end_label) for ((start, stop), toc) in zip(spans, other_toc_list))
+                tocs.sort(key=operator.itemgetter(0))
+        for start, stop, toc, end_label in tocs:
+            if toc is None:
+                toc_text = self.format_toc(
+                    numbered=numbered,
+                    toc_comment=toc_comment,
+                    alt_list_char=alt_list_char,
+                    add_trailing_heading_chars=add_trailing_heading_chars,
+                )
+            else:
+                toc_text = self._format_other_toc(toc, numbered, toc_comment, alt_list_char)
+            yield (start, stop, toc_text, end_label)
 
     def parse(self, heading_text, heading_level, skip_level, max_level):
         """Parse headings out of the Markdown file and build the table of contents."""
@@ -458,18 +1405,97 @@ class MarkdownFile(object):
             skip_level=skip_level,
             max_level=max_level,
         )
+        self._formatted_toc = None
         toclevel = self.toc
-        while True:
-            line = self.get_next_line()
-            if _is_eof(line):
-                break
-            line = self.skip_toc(line)
-            line = self.skip_code_fence(line)
-            (heading_text, heading_level) = _get_heading(line)
-            if heading_text is not None:
-                toclevel = toclevel.add_item(heading_text, heading_level)
+        for heading in self.scan().headings:
+            toclevel = toclevel.add_item(heading.text, heading.level)
+        self.section_tocs = build_section_tocs(self.scan(), skip_level=skip_level, max_level=max_level)
+        self._formatted_tocs = {}
         return input_text
 
+    def check(self, numbered, toc_comment, alt_list_char, add_trailing_heading_chars, ignore_comment=False):
+        """
+        Check whether every table of contents in the Markdown file is up to date.
+
+        Only the existing tables of contents are compared with the newly
+        formatted one; nothing is written, and checking stops at the first
+        mismatch.
+
+        :Args:
+            ignore_comment
+                (optional) Whether to ignore the text of the end-of-toc
+                comment (e.g. because it contains a datestamp)
+
+        :Returns:
+            `True` if every table of contents is up to date, else `False`
+        """
+        for toc_start, toc_stop, toc_text, end_label in self.iter_tocs(
+            numbered=numbered,
+            toc_comment=toc_comment,
+            alt_list_char=alt_list_char,
+            add_trailing_heading_chars=add_trailing_heading_chars,
+        ):
+            if not self._toc_matches(toc_start, toc_stop, toc_text, ignore_comment, end_label):
+                return False
+        return True
+
+    def _toc_matches(self, toc_start, toc_stop, toc_text, ignore_comment, end_label=LABEL_END_TOC):
+        """Check whether an existing table of contents matches newly formatted `toc_text`."""
+        existing_text = self.text[toc_start:toc_stop]
+        if not ignore_comment:
+            return existing_text == toc_text
+        (existing_text, end_toc_line) = _split_last_line(existing_text)
+        end_toc_prefix = _make_detached_link(end_label, "#")
+        if self.is_bytes:
+            end_toc_prefix = end_toc_prefix.encode(self.encoding)
+        return end_toc_line.startswith(end_toc_prefix) and existing_text == _split_last_line(toc_text)[0]
+
+    def iter_segments(self, numbered, toc_comment, alt_list_char, add_trailing_heading_chars, keep_comment=False):
+        """
+        Generate the segments of the Markdown file with the new table of contents.
+
+        Each segment is either a ``(start, stop)`` tuple of offsets into
+        `self.text`:py:attr: for a run of unchanged input, or the newly
+        formatted table of contents, ready for output.
+
+        If `keep_comment` is true, an existing table of contents which
+        differs from the new one only in its end-of-toc comment is left as
+        is, so that a datestamp in the comment changes only when the
+        headings do.
+        """
+        start = 0
+        for toc_start, toc_stop, toc_text, end_label in self.iter_tocs(
+            numbered=numbered,
+            toc_comment=toc_comment,
+            alt_list_char=alt_list_char,
+            add_trailing_heading_chars=add_trailing_heading_chars,
+        ):
+            if keep_comment and self._toc_matches(toc_start, toc_stop, toc_text, True, end_label):
+                continue
+            if start < toc_start:
+                yield (start, toc_start)
+            yield toc_text
+            start = toc_stop
+        if start < len(self.text):
+            yield (start, len(self.text))
+
+    def render(self, numbered, toc_comment, alt_list_char, add_trailing_heading_chars, keep_comment=False):
+        """Return the text of the Markdown file with the new table of contents (see `iter_segments()`:py:meth:)."""
+        parts = []
+        for segment in self.iter_segments(
+            numbered=numbered,
+            toc_comment=toc_comment,
+            alt_list_char=alt_list_char,
+            add_trailing_heading_chars=add_trailing_heading_chars,
+            keep_comment=keep_comment,
+        ):
+            if isinstance(segment, tuple):
+                (start, stop) = segment
+                parts.append(self.text[start:stop])
+            else:
+                parts.append(segment)
+        return (b"" if self.is_bytes else "").join(parts)
+
     def write(
         self,
         numbered,
@@ -477,29 +1503,77 @@ class MarkdownFile(object):
         alt_list_char,
         add_trailing_heading_chars,
         outfile=None,
+        keep_comment=False,
     ):
-        """Write the Markdown file with the new table of contents."""
+        """
+        Write the Markdown file with the new table of contents (see `iter_segments()`:py:meth:).
+
+        :Returns:
+            The size of the output written, in bytes or characters
+        """
         if outfile is not None:
             self.outfile = outfile
-        reset = True
-        while True:
-            line = self.get_next_line(reset=reset)
-            reset = False
-            if _is_eof(line):
-                break
-            if _is_code_fence(line):
-                lines = self.consume_code_fence(line)
-                self.outfile.write(lines)
-            elif _is_toc_token(line):
-                line = self.skip_toc(line)
-                self.outfile.write(
-                    self.toc.format(
-                        numbered=numbered,
-                        comment=toc_comment,
-                        alt_list_char=alt_list_char,
-                        add_trailing_heading_chars=add_trailing_heading_chars,
-                    )
-                )
-                self.outfile.write(line)
+        text = memoryview(self.text) if self.is_bytes else self.text
+        size = 0
+        for segment in self.iter_segments(
+            numbered=numbered,
+            toc_comment=toc_comment,
+            alt_list_char=alt_list_char,
+            add_trailing_heading_chars=add_trailing_heading_chars,
+            keep_comment=keep_comment,
+        ):
+            if isinstance(segment, tuple):
+                (start, stop) = segment
+                self.outfile.write(text[start:stop])
+                size += stop - start
+            else:
+                self.outfile.write(segment)
+                size += len(segment)
+        return size
+
+    def splice(
+        self,
+        src_fd,
+        dst_fd,
+        numbered,
+        toc_comment,
+        alt_list_char,
+        add_trailing_heading_chars,
+        keep_comment=False,
+    ):
+        """
+        Write the Markdown file with the new table of contents, copying unchanged bytes.
+
+        Runs of unchanged input are copied from the original input file by
+        byte offset (see `iofile.copy_range()`:py:func:), so only the new
+        table of contents passes through Python.  This is only valid when
+        `can_splice()`:py:meth: is true.
+
+        :Args:
+            src_fd
+                A file descriptor open for reading on the original input file
+
+            dst_fd
+                A file descriptor open for writing on the output file
+
+        :Returns:
+            The number of bytes written
+        """
+        if not self.can_splice():
+            raise TypeError("cannot splice output from converted or decoded input")
+        size = 0
+        for segment in self.iter_segments(
+            numbered=numbered,
+            toc_comment=toc_comment,
+            alt_list_char=alt_list_char,
+            add_trailing_heading_chars=add_trailing_heading_chars,
+            keep_comment=keep_comment,
+        ):
+            if isinstance(segment, tuple):
+                (start, stop) = segment
+                iofile.copy_range(src_fd, dst_fd, start, stop - start)
+                size += stop - start
             else:
-                self.outfile.write(line)
+                iofile.write_all(dst_fd, segment)
+                size += len(segment)
+        return size
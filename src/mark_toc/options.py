@@ -0,0 +1,70 @@
+"""Define the default options for updating tables of contents, shared by the command line and the APIs."""
+
+import datetime
+import os
+
+from . import iofile, parsers
+
+####################
+
+NEWLINE_FORMAT_LINUX = "linux"
+NEWLINE_FORMAT_MICROSOFT = "microsoft"
+NEWLINE_FORMAT_NATIVE = "native"
+NEWLINE_FORMAT_PRESERVE = "preserve"
+
+NEWLINE_FORMATS = [
+    NEWLINE_FORMAT_LINUX,
+    NEWLINE_FORMAT_MICROSOFT,
+    NEWLINE_FORMAT_NATIVE,
+    NEWLINE_FORMAT_PRESERVE,
+]
+
+NEWLINE_VALUES = {
+    NEWLINE_FORMAT_LINUX: "\n",
+    NEWLINE_FORMAT_MICROSOFT: "\r\n",
+    NEWLINE_FORMAT_NATIVE: os.linesep,
+    NEWLINE_FORMAT_PRESERVE: iofile.NEWLINE_PRESERVE,
+}
+
+DEFAULT_COMMAND = "mark-toc"
+DEFAULT_NEWLINES = NEWLINE_FORMAT_PRESERVE
+DEFAULT_HEADING_TEXT = "Contents"
+DEFAULT_HEADING_LEVEL = 1
+DEFAULT_SKIP_LEVEL = 0
+DEFAULT_MAX_LEVEL = 0
+DEFAULT_NUMBERED = False
+DEFAULT_ALT_LIST_CHAR = False
+DEFAULT_ADD_TRAILING_HEADING_CHARS = False
+DEFAULT_PARSER = parsers.DEFAULT_PARSER
+DEFAULT_SYNC = iofile.SYNC_NONE
+DEFAULT_CONFLICT_RETRIES = 2
+
+####################
+
+
+def generate_comment(command=DEFAULT_COMMAND, suffix="", with_datestamp=False):
+    """
+    Generate the default comment for the "end table of contents" token.
+
+    :Args:
+        command
+            (optional) The command to name as having generated the table
+            of contents
+
+        suffix
+            (optional) Text to add to the end of the comment
+
+        with_datestamp
+            (optional) Whether to say when the table of contents was
+            generated (i.e. now)
+
+    :Returns:
+        The comment text
+    """
+    datestamp = "".join([datetime.datetime.utcnow().isoformat(), "Z"])
+    if with_datestamp:
+        template = "Generated by {command} on {datestamp}{suffix}"
+    else:
+        template = "Generated by {command}{suffix}"
+    comment_text = template.format(command=command, datestamp=datestamp, suffix=suffix)
+    return comment_text
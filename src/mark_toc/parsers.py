@@ -0,0 +1,167 @@
+"""Provide parser backends for scanning Markdown documents."""
+
+import abc
+import re
+
+from . import mdfile
+
+try:
+    import markdown_it
+except ImportError:
+    markdown_it = None
+
+####################
+
+PARSER_REGEX = mdfile.DEFAULT_PARSER_NAME
+PARSER_COMMONMARK = "commonmark"
+
+DEFAULT_PARSER = PARSER_REGEX
+
+COMMONMARK_PACKAGE = "markdown-it-py"
+
+# CommonMark treats a lone carriage return as a line ending, too
+LINE_ENDING_REGEXES = {
+    str: re.compile(r"\r\n?|\n"),
+    bytes: re.compile(rb"\r\n?|\n"),
+}
+
+COMMONMARK_CODE_TOKENS = {"fence", "code_block"}
+COMMONMARK_OPAQUE_TOKENS = {"html_block"}
+
+####################
+
+
+class Parser(abc.ABC):
+    """
+    Scan Markdown documents for headings, code blocks and tables of contents.
+
+    Subclasses implement `scan()`:py:meth:.
+
+    :Attributes:
+        name
+            The name the parser is known by (see `get_parser()`:py:func:)
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def scan(self, text, encoding="utf-8", filename=None, jobs=1):
+        """
+        Scan Markdown text (see `mdfile.scan_markdown()`:py:func:).
+
+        :Returns:
+            A `mdfile.MarkdownScan`:py:class:
+
+        :Raises:
+            `ValueError`:py:exc: if the table of contents syntax is invalid
+        """
+
+
+class RegexParser(Parser):
+    """
+    Scan with line-matching regexes (see `mdfile.scan_markdown()`:py:func:).
+
+    This is fast, and can scan large documents in parallel, but only knows
+    about "atx"-style headings, code fences, front matter and HTML comment
+    blocks.
+    """
+
+    name = PARSER_REGEX
+
+    def scan(self, text, encoding="utf-8", filename=None, jobs=1):
+        """See `Parser.scan()`:py:meth:."""
+        return mdfile.scan_markdown(text, encoding=encoding, filename=filename, jobs=jobs)
+
+
+def _get_line_starts(text):
+    """Get the offset of the start of each line in `text`, as CommonMark counts lines."""
+    return [0] + [match.end() for match in LINE_ENDING_REGEXES[type(text)].finditer(text)]
+
+
+class CommonMarkParser(Parser):
+    """
+    Scan with a CommonMark-compliant parser (requires the ``markdown-it-py`` package).
+
+    This also finds "setext"-style headings, and ignores headings and table
+    of contents comments in indented code blocks and all kinds of HTML
+    blocks, at the cost of speed.  YAML front matter is skipped, as by
+    `mdfile.scan_markdown()`:py:func:.  Documents are always scanned in one
+    piece.
+    """
+
+    name = PARSER_COMMONMARK
+
+    def __init__(self):
+        if markdown_it is None:
+            raise RuntimeError(
+                "the '{name}' parser needs the '{package}' package".format(name=self.name, package=COMMONMARK_PACKAGE)
+            )
+        self._markdown = markdown_it.MarkdownIt("commonmark")
+
+    def scan(self, text, encoding="utf-8", filename=None, jobs=1):
+        """See `Parser.scan()`:py:meth:."""
+        source = text.decode(encoding, errors="surrogateescape") if isinstance(text, bytes) else text
+        line_starts = _get_line_starts(text)
+        line_starts.append(len(text))
+
+        # Parse only what follows the front matter, then count lines from the start.
+        front_matter_stop = mdfile.get_front_matter_stop(source)
+        front_matter_lines = len(_get_line_starts(source[:front_matter_stop])) - 1
+
+        def get_span(line_map):
+            (start_line, stop_line) = (line + front_matter_lines for line in line_map)
+            return (line_starts[start_line], line_starts[min(stop_line, len(line_starts) - 1)])
+
+        headings = []
+        code_fence_spans = []
+        opaque_spans = [(0, line_starts[front_matter_lines])] if front_matter_stop > 0 else []
+        tokens = self._markdown.parse(source[front_matter_stop:])
+        for i, token in enumerate(tokens):
+            if token.type == "heading_open":
+                line_index = token.map[0] + front_matter_lines
+                level = int(token.tag[1:])
+                headings.append((line_starts[line_index], level, tokens[i + 1].content, line_index))
+            elif token.type in COMMONMARK_CODE_TOKENS and token.map is not None:
+                code_fence_spans.append(get_span(token.map))
+            elif token.type in COMMONMARK_OPAQUE_TOKENS and token.map is not None:
+                opaque_spans.append(get_span(token.map))
+        return mdfile.scan_parsed_markdown(
+            text,
+            headings,
+            sorted(code_fence_spans),
+            opaque_spans=sorted(opaque_spans),
+            encoding=encoding,
+            filename=filename,
+        )
+
+
+PARSERS = {
+    PARSER_REGEX: RegexParser,
+    PARSER_COMMONMARK: CommonMarkParser,
+}
+
+
+def is_available(name):
+    """Check whether the parser called `name` can be used (i.e. what it needs is installed)."""
+    if name == PARSER_COMMONMARK:
+        return markdown_it is not None
+    return name in PARSERS
+
+
+_parsers = {}
+
+
+def get_parser(name=DEFAULT_PARSER):
+    """
+    Get a parser backend by name; parsers are shared, since they keep no state between scans.
+
+    :Raises:
+        `ValueError`:py:exc: if there is no such parser
+
+        `RuntimeError`:py:exc: if the parser needs a package that is not installed
+    """
+    if name not in PARSERS:
+        raise ValueError("{}: unrecognized parser".format(name))
+    if name not in _parsers:
+        _parsers[name] = PARSERS[name]()
+    return _parsers[name]
@@ -0,0 +1,68 @@
+"""Make unified patches suitable for ``git apply``."""
+
+import difflib
+import os
+
+####################
+
+DEFAULT_CONTEXT_LINES = 3
+
+NO_NEWLINE_MARKER = "\\ No newline at end of file\n"
+
+####################
+
+
+def _split_lines(text):
+    """Split `text` into lines, keeping only ``"\\n"`` as a line ending (``"\\r"`` is content)."""
+    lines = [line + "\n" for line in text.split("\n")]
+    if lines[-1] == "\n":
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+
+def get_patch_path(path):
+    """Get the path to use for `path` in a patch: relative to the current directory, with '/' separators."""
+    path = os.path.relpath(path)
+    if os.sep != "/":
+        path = path.replace(os.sep, "/")
+    return path
+
+
+def make_patch(path, input_text, output_text, context_lines=DEFAULT_CONTEXT_LINES):
+    """
+    Make a unified patch for changing one file, in the format ``git apply`` expects.
+
+    :Args:
+        path
+            The path of the file being changed (see `get_patch_path()`:py:func:)
+
+        input_text
+            The original text of the file
+
+        output_text
+            The changed text of the file
+
+        context_lines
+            (optional) The number of lines of context around each change
+
+    :Returns:
+        The patch text, or an empty string if there are no changes
+    """
+    if input_text == output_text:
+        return ""
+    patch_path = get_patch_path(path)
+    patch_lines = ["diff --git a/{path} b/{path}\n".format(path=patch_path)]
+    for line in difflib.unified_diff(
+        _split_lines(input_text),
+        _split_lines(output_text),
+        fromfile="a/" + patch_path,
+        tofile="b/" + patch_path,
+        n=context_lines,
+    ):
+        patch_lines.append(line)
+        if not line.endswith("\n"):
+            patch_lines.append("\n")
+            patch_lines.append(NO_NEWLINE_MARKER)
+    return "".join(patch_lines)
@@ -0,0 +1,132 @@
+"""Provide a live progress display for runs over many files."""
+
+import shutil
+import sys
+import time
+
+from . import hooks, report
+
+####################
+
+DEFAULT_REDRAW_INTERVAL = 0.2  # seconds
+
+BYTES_PER_MB = 1000 * 1000
+
+####################
+
+
+def _format_eta(seconds):
+    (minutes, seconds) = divmod(int(seconds + 0.5), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+class _ClearingStream(object):
+    """Wrap an output stream so that the progress line is cleared before anything else is written."""
+
+    def __init__(self, display, stream):
+        self._display = display
+        self._stream = stream
+
+    def write(self, text):
+        """Clear the progress line, then write `text`."""
+        self._display.clear()
+        return self._stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class ProgressDisplay(hooks.Hooks):
+    """
+    Show a single, continually updated line of progress on a terminal.
+
+    This counts files as notified through `hooks.Hooks`:py:class:, so it
+    works the same whether files are processed sequentially or in parallel.
+    The line is redrawn at most once every `interval` seconds, so the
+    display costs next to nothing however many files there are.
+
+    Other output to the same terminal should go through `wrap()`:py:meth:,
+    so that it does not get mixed up with the progress line.
+
+    :Args:
+        total
+            The total number of files to process, or `None` if not known
+
+        stream
+            (optional) The terminal to write to (default: `sys.stderr`)
+
+        interval
+            (optional) The minimum time between redraws, in seconds
+    """
+
+    def __init__(self, total, stream=None, interval=DEFAULT_REDRAW_INTERVAL):
+        self.total = total
+        self.stream = sys.stderr if stream is None else stream
+        self.interval = interval
+        self.done = 0
+        self.changed = 0
+        self.failed = 0
+        self.bytes_read = 0
+        self._start_time = time.perf_counter()
+        self._last_draw_time = self._start_time
+        self._shown = False
+
+    def read_done(self, path, size, duration):
+        """See `hooks.Hooks.read_done()`:py:meth:."""
+        self.bytes_read += size
+
+    def file_end(self, path, outcome, duration):
+        """See `hooks.Hooks.file_end()`:py:meth:."""
+        self.done += 1
+        if outcome == report.OUTCOME_CHANGED:
+            self.changed += 1
+        elif outcome == report.OUTCOME_FAILED:
+            self.failed += 1
+        now = time.perf_counter()
+        if now - self._last_draw_time >= self.interval:
+            self.draw(now)
+
+    def format(self, now=None):
+        """Format the progress line."""
+        if now is None:
+            now = time.perf_counter()
+        elapsed = max(now - self._start_time, 1e-9)
+        files_per_second = self.done / elapsed
+        parts = [
+            "{done}/{total} files".format(done=self.done, total="?" if self.total is None else self.total),
+            "{:.1f} files/s".format(files_per_second),
+            "{:.1f} MB/s".format(self.bytes_read / BYTES_PER_MB / elapsed),
+            "{} changed".format(self.changed),
+            "{} failed".format(self.failed),
+        ]
+        if self.total is not None and 0 < self.done < self.total:
+            parts.append("ETA {}".format(_format_eta((self.total - self.done) / files_per_second)))
+        return "  ".join(parts)
+
+    def draw(self, now=None):
+        """Redraw the progress line now."""
+        if now is None:
+            now = time.perf_counter()
+        width = shutil.get_terminal_size().columns - 1
+        self.stream.write("\r" + self.format(now)[:width] + "\x1b[K")
+        self.stream.flush()
+        self._shown = True
+        self._last_draw_time = now
+
+    def clear(self):
+        """Remove the progress line, if shown; it is drawn again with the next update."""
+        if self._shown:
+            self.stream.write("\r\x1b[K")
+            self._shown = False
+
+    def finish(self):
+        """Draw the final state of the progress line, and leave it in place."""
+        self.draw()
+        self.stream.write("\n")
+        self.stream.flush()
+        self._shown = False
+
+    def wrap(self, stream):
+        """Wrap another stream to the same terminal, so writing to it clears the progress line first."""
+        return _ClearingStream(self, stream)
@@ -0,0 +1,250 @@
+"""Render heading trees in various formats, for use by other tools."""
+
+import html
+import json
+
+from . import mdfile
+
+####################
+
+RENDERER_MARKDOWN = "markdown"
+RENDERER_HTML = "html"
+RENDERER_JSON = "json"
+RENDERER_TSV = "tsv"
+
+TSV_COLUMNS = ["path", "level", "line_number", "anchor", "text"]
+
+####################
+
+
+class HeadingNode(object):
+    """
+    Model a heading and the headings nested under it.
+
+    :Attributes:
+        children
+            A list of `HeadingNode`:py:class:, in document order
+    """
+
+    def __init__(self, level, text, line_number):
+        self.level = level
+        self.text = text
+        self.anchor = mdfile.get_anchor_name(text)
+        self.line_number = line_number
+        self.children = []
+
+    def __repr__(self):
+        """Print a human-readable representation of this node."""
+        return "HeadingNode(level={level}, text={text}, children={children})".format(
+            level=self.level, text=repr(self.text), children=repr(self.children)
+        )
+
+    def to_dict(self):
+        """Get this node and its children as a dictionary suitable for JSON."""
+        return {
+            "level": self.level,
+            "text": self.text,
+            "anchor": self.anchor,
+            "line_number": self.line_number,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+
+def build_heading_tree(headings, skip_level=0, max_level=0):
+    """
+    Build a tree of headings, as included in a table of contents.
+
+    :Args:
+        headings
+            A sequence of `mdfile.Heading`:py:class:, in document order
+
+        skip_level, max_level
+            (optional) Leave out headings at or above `skip_level`, or below
+            `max_level` (if not 0), as for `mdfile.Toc`:py:class:
+
+    :Returns:
+        A list of the top-level `HeadingNode`:py:class:
+    """
+    roots = []
+    open_nodes = []
+    for heading in headings:
+        if heading.level <= skip_level or (max_level > 0 and heading.level > max_level):
+            continue
+        node = HeadingNode(heading.level, heading.text, heading.line_number)
+        while open_nodes and open_nodes[-1].level >= node.level:
+            open_nodes.pop()
+        (open_nodes[-1].children if open_nodes else roots).append(node)
+        open_nodes.append(node)
+    return roots
+
+
+def _iter_nodes(nodes):
+    """Generate all nodes in a tree, in document order."""
+    for node in nodes:
+        yield node
+        yield from _iter_nodes(node.children)
+
+
+class Renderer(object):
+    """
+    Render the heading trees of one or more files.
+
+    Call `start()`:py:meth:, then `render_file()`:py:meth: for each file,
+    then `finish()`:py:meth:; output is written as it goes.  Subclasses
+    override whichever they need.
+
+    :Args:
+        outfile
+            The text file to write to
+
+        skip_level
+            The `skip_level` the trees were built with, for indenting
+
+        link_paths
+            Whether to make links of the form ``file.md#anchor`` rather than
+            ``#anchor`` (e.g. when rendering more than one file)
+
+        numbered, alt_list_char
+            Formatting options, as for `mdfile.Toc`:py:class:
+    """
+
+    def __init__(self, outfile, skip_level=0, link_paths=False, numbered=False, alt_list_char=False):
+        self.outfile = outfile
+        self.skip_level = skip_level
+        self.link_paths = link_paths
+        self.numbered = numbered
+        self.alt_list_char = alt_list_char
+        self.file_count = 0
+
+    def get_link(self, path, node):
+        """Get the link target for a heading in the file at `path`."""
+        anchor_ref = "#" + node.anchor
+        return path + anchor_ref if self.link_paths else anchor_ref
+
+    def start(self):
+        """Write anything needed before the first file."""
+
+    def render_file(self, path, nodes):
+        """Write the heading tree (a list of `HeadingNode`:py:class:) for the file at `path`."""
+        self.file_count += 1
+
+    def finish(self):
+        """Write anything needed after the last file."""
+
+
+class MarkdownRenderer(Renderer):
+    """
+    Render headings as a Markdown list, formatted as in a table of contents.
+
+    The list is formatted by `mdfile.format_toc_list()`:py:func:, so items
+    are numbered and indented the same way as in tables of contents.
+    """
+
+    def render_file(self, path, nodes):
+        """See `Renderer.render_file()`:py:meth:."""
+        if self.file_count > 0:
+            self.outfile.write("\n")
+        super().render_file(path, nodes)
+        target_path = path if self.link_paths else None
+        headings = mdfile.TocLevel(level=1, max_level=0)
+        toc_level = headings
+        for node in _iter_nodes(nodes):
+            toc_level = toc_level.add_item(node.text, node.level, target_path)
+        for text in mdfile.format_toc_list(headings, self.skip_level, self.numbered, self.alt_list_char):
+            self.outfile.write(text + "\n")
+
+
+class HtmlRenderer(Renderer):
+    """Render headings as nested lists in an HTML ``<nav>`` element, one per file."""
+
+    def render_file(self, path, nodes):
+        """See `Renderer.render_file()`:py:meth:."""
+        super().render_file(path, nodes)
+        self.outfile.write('<nav class="toc" data-path="{path}">\n'.format(path=html.escape(path)))
+        self._render_nodes(path, nodes, 1)
+        self.outfile.write("</nav>\n")
+
+    def _render_nodes(self, path, nodes, depth):
+        if not nodes:
+            return
+        list_tag = "ol" if self.numbered else "ul"
+        indent_text = "  " * depth
+        self.outfile.write("{indent}<{tag}>\n".format(indent=indent_text, tag=list_tag))
+        for node in nodes:
+            link = '<a href="{target}">{text}</a>'.format(
+                target=html.escape(self.get_link(path, node)), text=html.escape(node.text)
+            )
+            if node.children:
+                self.outfile.write("{indent}  <li>{link}\n".format(indent=indent_text, link=link))
+                self._render_nodes(path, node.children, depth + 2)
+                self.outfile.write("{indent}  </li>\n".format(indent=indent_text))
+            else:
+                self.outfile.write("{indent}  <li>{link}</li>\n".format(indent=indent_text, link=link))
+        self.outfile.write("{indent}</{tag}>\n".format(indent=indent_text, tag=list_tag))
+
+
+class JsonRenderer(Renderer):
+    """Render headings as a single JSON document, with a tree of headings for each file."""
+
+    def start(self):
+        """See `Renderer.start()`:py:meth:."""
+        self.outfile.write('{"files": [')
+
+    def render_file(self, path, nodes):
+        """See `Renderer.render_file()`:py:meth:."""
+        if self.file_count > 0:
+            self.outfile.write(",")
+        super().render_file(path, nodes)
+        self.outfile.write("\n  ")
+        json.dump({"path": path, "headings": [node.to_dict() for node in nodes]}, self.outfile)
+
+    def finish(self):
+        """See `Renderer.finish()`:py:meth:."""
+        self.outfile.write("\n]}\n")
+
+
+class TsvRenderer(Renderer):
+    """Render headings as tab-separated values, one line per heading, with a header line."""
+
+    def start(self):
+        """See `Renderer.start()`:py:meth:."""
+        self.outfile.write("\t".join(TSV_COLUMNS) + "\n")
+
+    def render_file(self, path, nodes):
+        """See `Renderer.render_file()`:py:meth:."""
+        super().render_file(path, nodes)
+        for node in _iter_nodes(nodes):
+            fields = [path, str(node.level), str(node.line_number), node.anchor, node.text]
+            self.outfile.write("\t".join(field.replace("\t", " ") for field in fields) + "\n")
+
+
+RENDERERS = {
+    RENDERER_MARKDOWN: MarkdownRenderer,
+    RENDERER_HTML: HtmlRenderer,
+    RENDERER_JSON: JsonRenderer,
+    RENDERER_TSV: TsvRenderer,
+}
+
+
+def register_renderer(name, renderer_class):
+    """Make a subclass of `Renderer`:py:class: available by `name` (see `get_renderer()`:py:func:)."""
+    RENDERERS[name] = renderer_class
+
+
+def get_renderer(name, outfile, **kwargs):
+    """
+    Get a renderer by name.
+
+    :Args:
+        name
+            One of `RENDERERS`
+
+        kwargs
+            Options for the renderer (see `Renderer`:py:class:)
+
+    :Raises:
+        `ValueError`:py:exc: if there is no such renderer
+    """
+    if name not in RENDERERS:
+        raise ValueError("{}: unrecognized renderer".format(name))
+    return RENDERERS[name](outfile, **kwargs)
@@ -0,0 +1,235 @@
+"""Provide run reports and metrics for monitoring."""
+
+import datetime
+import json
+import time
+
+from . import hooks
+
+####################
+
+OUTCOME_CHANGED = "changed"
+OUTCOME_UNCHANGED = "unchanged"
+OUTCOME_SKIPPED = "skipped"
+OUTCOME_FAILED = "failed"
+
+OUTCOMES = [
+    OUTCOME_CHANGED,
+    OUTCOME_UNCHANGED,
+    OUTCOME_SKIPPED,
+    OUTCOME_FAILED,
+]
+
+REPORT_FORMAT_JSON = "json"
+REPORT_FORMAT_JSON_LINES = "jsonl"
+
+REPORT_FORMATS = [
+    REPORT_FORMAT_JSON,
+    REPORT_FORMAT_JSON_LINES,
+]
+
+METRIC_PREFIX = "mark_toc"
+
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+####################
+
+
+def _format_timestamp(timestamp):
+    return "".join([datetime.datetime.utcfromtimestamp(timestamp).isoformat(), "Z"])
+
+
+def _format_metric_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class FileReport(object):
+    """
+    Record statistics for processing one file.
+
+    :Attributes:
+        outcome
+            One of `OUTCOMES`: the table of contents was changed, was already
+            up to date, the file had no table of contents, or processing failed
+
+        headings
+            The number of headings found
+
+        bytes_read, bytes_written
+            The size of the input and output (in characters, for encodings
+            that are not handled as raw bytes)
+
+        duration
+            The time taken to process the file, in seconds
+
+        error
+            A description of the error, if processing failed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.outcome = OUTCOME_UNCHANGED
+        self.headings = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.duration = 0.0
+        self.error = None
+
+    def to_dict(self):
+        """Get this report as a dictionary suitable for JSON."""
+        return {
+            "path": self.path,
+            "outcome": self.outcome,
+            "headings": self.headings,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "duration": self.duration,
+            "error": self.error,
+        }
+
+
+class RunReport(hooks.Hooks):
+    """Collect statistics for a run over one or more files, as notified through `hooks.Hooks`:py:class:."""
+
+    def __init__(self):
+        self.files = []
+        self.start_timestamp = time.time()
+        self.duration = 0.0
+        self._start_time = time.perf_counter()
+        self._current = {}
+
+    def file_start(self, path):
+        """See `hooks.Hooks.file_start()`:py:meth:."""
+        self._current[path] = FileReport(path)
+
+    def read_done(self, path, size, duration):
+        """See `hooks.Hooks.read_done()`:py:meth:."""
+        self._current[path].bytes_read = size
+
+    def parse_done(self, path, headings, duration):
+        """See `hooks.Hooks.parse_done()`:py:meth:."""
+        self._current[path].headings = headings
+
+    def write_done(self, path, size, duration):
+        """See `hooks.Hooks.write_done()`:py:meth:."""
+        self._current[path].bytes_written = size
+
+    def error(self, path, error):
+        """See `hooks.Hooks.error()`:py:meth:."""
+        self._current[path].error = str(error)
+
+    def file_end(self, path, outcome, duration):
+        """See `hooks.Hooks.file_end()`:py:meth:."""
+        file_report = self._current.pop(path)
+        file_report.outcome = outcome
+        file_report.duration = duration
+        self.files.append(file_report)
+
+    def finish(self):
+        """Record the time taken for the whole run."""
+        self.duration = time.perf_counter() - self._start_time
+
+    def get_totals(self):
+        """Get totals across all files, as a dictionary."""
+        totals = {"files": len(self.files)}
+        for outcome in OUTCOMES:
+            totals[outcome] = 0
+        totals.update({"headings": 0, "bytes_read": 0, "bytes_written": 0})
+        for file_report in self.files:
+            totals[file_report.outcome] += 1
+            totals["headings"] += file_report.headings
+            totals["bytes_read"] += file_report.bytes_read
+            totals["bytes_written"] += file_report.bytes_written
+        return totals
+
+    def _get_summary(self):
+        return {
+            "started": _format_timestamp(self.start_timestamp),
+            "duration": self.duration,
+            "totals": self.get_totals(),
+        }
+
+    def write_json(self, outfile):
+        """Write this report as a single JSON document."""
+        document = self._get_summary()
+        document["files"] = [file_report.to_dict() for file_report in self.files]
+        json.dump(document, outfile, indent=2)
+        outfile.write("\n")
+
+    def write_json_lines(self, outfile):
+        """Write this report as JSON Lines: one line per file, followed by a summary line."""
+        for file_report in self.files:
+            record = {"type": "file"}
+            record.update(file_report.to_dict())
+            outfile.write(json.dumps(record))
+            outfile.write("\n")
+        record = {"type": "summary"}
+        record.update(self._get_summary())
+        outfile.write(json.dumps(record))
+        outfile.write("\n")
+
+    def write(self, outfile, report_format=REPORT_FORMAT_JSON):
+        """Write this report in the given format (one of `REPORT_FORMATS`)."""
+        if report_format == REPORT_FORMAT_JSON_LINES:
+            self.write_json_lines(outfile)
+        elif report_format == REPORT_FORMAT_JSON:
+            self.write_json(outfile)
+        else:
+            raise ValueError("{}: unrecognized report format".format(report_format))
+
+    def write_prometheus(self, outfile):
+        """
+        Write this report as metrics in the Prometheus text exposition format.
+
+        This is suitable for the textfile collector of the Prometheus node
+        exporter; write it atomically so the collector never sees a partial
+        file.
+        """
+        totals = self.get_totals()
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            full_name = "_".join([METRIC_PREFIX, name])
+            lines.append("# HELP {name} {help}".format(name=full_name, help=help_text))
+            lines.append("# TYPE {name} {type}".format(name=full_name, type=metric_type))
+            for suffix, labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(key, label_value) for key, label_value in labels)
+                lines.append(
+                    "{name}{suffix}{labels} {value}".format(
+                        name=full_name,
+                        suffix=suffix,
+                        labels="{" + label_text + "}" if label_text else "",
+                        value=_format_metric_value(value),
+                    )
+                )
+
+        add_metric(
+            "files_total",
+            "counter",
+            "Files processed, by outcome.",
+            [("", [("outcome", outcome)], totals[outcome]) for outcome in OUTCOMES],
+        )
+        add_metric("headings_total", "counter", "Headings found.", [("", [], totals["headings"])])
+        add_metric("read_bytes_total", "counter", "Bytes read.", [("", [], totals["bytes_read"])])
+        add_metric("written_bytes_total", "counter", "Bytes written.", [("", [], totals["bytes_written"])])
+
+        durations = [file_report.duration for file_report in self.files]
+        bucket_samples = [
+            ("_bucket", [("le", repr(bound))], sum(1 for duration in durations if duration <= bound))
+            for bound in DURATION_BUCKETS
+        ]
+        bucket_samples.append(("_bucket", [("le", "+Inf")], len(durations)))
+        bucket_samples.append(("_sum", [], float(sum(durations))))
+        bucket_samples.append(("_count", [], len(durations)))
+        add_metric("file_duration_seconds", "histogram", "Time taken to process each file.", bucket_samples)
+
+        add_metric("run_duration_seconds", "gauge", "Time taken for the whole run.", [("", [], self.duration)])
+        add_metric(
+            "last_run_timestamp_seconds",
+            "gauge",
+            "When the last run started, in seconds since the epoch.",
+            [("", [], self.start_timestamp)],
+        )
+
+        outfile.write("\n".join(lines))
+        outfile.write("\n")
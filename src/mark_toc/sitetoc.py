@@ -0,0 +1,191 @@
+"""Build tables of contents covering the Markdown files in a directory."""
+
+import concurrent.futures
+import glob
+import os
+import urllib.parse
+
+from . import headingindex, iofile, mdfile, parsers
+
+####################
+
+
+def _is_same_path(path, other_path):
+    return os.path.normcase(os.path.realpath(path)) == os.path.normcase(os.path.realpath(other_path))
+
+
+def resolve_dir_toc_paths(path, pattern):
+    """
+    Find the files for a directory table of contents in the file at `path`.
+
+    :Args:
+        path
+            The path of the file containing the directory table of contents
+
+        pattern
+            The glob pattern selecting the files, relative to the directory
+            containing `path` (see `mdfile.MarkdownFile.get_dir_toc_pattern()`:py:meth:)
+
+    :Returns:
+        A sorted list of paths to regular files, not including `path` itself
+    """
+    base_dir = os.path.dirname(path)
+    paths = glob.glob(os.path.join(glob.escape(base_dir), pattern))
+    return sorted(
+        found_path for found_path in paths if os.path.isfile(found_path) and not _is_same_path(found_path, path)
+    )
+
+
+def get_link_path(path, target_path):
+    """Get the link target for `target_path` as seen from the file at `path`."""
+    relative_path = os.path.relpath(target_path, os.path.dirname(path) or os.curdir)
+    return urllib.parse.quote(relative_path.replace(os.sep, "/"))
+
+
+def _read_file_headings(path, encoding, binary, cache_dir=None, parser_name=parsers.DEFAULT_PARSER, build_index=False):
+    """
+    Read a Markdown file and get its headings (see `read_headings()`:py:func:).
+
+    :Args:
+        build_index
+            (optional) Whether to return a heading index even without a
+            `cache_dir` (e.g. for a `headingindex.HeadingIndexCache`:py:class:)
+
+    :Returns:
+        A tuple of (`fingerprint`, `heading_index`, `headings`), where
+        `fingerprint` is that of the file just before it was read (see
+        `iofile.get_file_fingerprint()`:py:func:), and
+        `heading_index` is `None` unless one was loaded or built
+    """
+    input_iofile = iofile.TextIOFile(path, input_newline="", encoding=encoding, binary=binary)
+    input_iofile.open_for_input()
+    try:
+        fingerprint = iofile.get_file_fingerprint(input_iofile.file.fileno())
+        md = mdfile.MarkdownFile(
+            infile=input_iofile.file,
+            infilename=input_iofile.printable_name,
+            encoding=encoding,
+            parser=parsers.get_parser(parser_name),
+        )
+        md.read()
+    finally:
+        input_iofile.close()
+    if cache_dir is None:
+        heading_index = headingindex.build_heading_index(md) if build_index else None
+        return (fingerprint, heading_index, md.scan().headings)
+    content_hash = headingindex.get_content_hash(md.input_text, md.encoding)
+    heading_index = headingindex.load_heading_index(
+        cache_dir, content_hash, encoding=md.encoding, parser=md.parser_name
+    )
+    if heading_index is None:
+        heading_index = headingindex.build_heading_index(md, content_hash)
+        headingindex.save_heading_index(cache_dir, heading_index)
+    return (fingerprint, heading_index, heading_index.to_scan().headings)
+
+
+def read_headings(path, encoding, binary, cache_dir=None, parser_name=parsers.DEFAULT_PARSER, heading_cache=None):
+    """
+    Read a Markdown file and get its headings.
+
+    :Args:
+        cache_dir
+            (optional) A heading index cache to reuse (see
+            `headingindex.load_heading_index()`:py:func:), and to save new
+            indexes in
+
+        parser_name
+            (optional) The parser backend to scan with (see
+            `parsers.get_parser()`:py:func:)
+
+        heading_cache
+            (optional) A `headingindex.HeadingIndexCache`:py:class: to reuse,
+            without even reading the file if it has not changed, and to add
+            new indexes to
+
+    :Returns:
+        A list of `mdfile.Heading`:py:class:
+
+    :Raises:
+        `ValueError`:py:exc: if the table of contents syntax is invalid
+    """
+    return read_all_headings(
+        [path], encoding, binary, cache_dir=cache_dir, parser_name=parser_name, heading_cache=heading_cache
+    )[path]
+
+
+def read_all_headings(
+    paths, encoding, binary, cache_dir=None, jobs=1, parser_name=parsers.DEFAULT_PARSER, heading_cache=None
+):
+    """
+    Read the headings of several Markdown files (see `read_headings()`:py:func:), in parallel with `jobs`.
+
+    Files found in `heading_cache` are not read at all; the rest are read
+    in worker processes, and their indexes added to `heading_cache` here.
+
+    :Returns:
+        A dictionary mapping each of `paths` to its list of headings
+    """
+    all_headings = {}
+    if heading_cache is not None:
+        for path in paths:
+            heading_index = heading_cache.get(path, encoding=encoding, parser=parser_name)
+            if heading_index is not None:
+                all_headings[path] = heading_index.to_scan().headings
+    paths = [path for path in paths if path not in all_headings]
+    count = len(paths)
+    args = (paths, [encoding] * count, [binary] * count, [cache_dir] * count, [parser_name] * count)
+    build_indexes = [heading_cache is not None] * count
+    if jobs <= 1 or count <= 1:
+        results = map(_read_file_headings, *args, build_indexes)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_read_file_headings, *args, build_indexes))
+    for path, (fingerprint, heading_index, headings) in zip(paths, results):
+        if heading_cache is not None:
+            heading_cache.put(path, fingerprint, heading_index)
+        all_headings[path] = headings
+    return all_headings
+
+
+def build_dir_tocs(md, path, skip_level, max_level, binary, cache_dir=None, jobs=1, heading_cache=None):
+    """
+    Build the directory tables of contents for a `mdfile.MarkdownFile`:py:class:.
+
+    The headings of all the files needed are read once, in parallel with
+    `jobs`, however many directory tables of contents refer to them.
+
+    :Args:
+        md
+            The `mdfile.MarkdownFile`:py:class:, which has been read
+
+        path
+            The path of the file `md` was read from
+
+        cache_dir, jobs, heading_cache
+            (optional) See `read_all_headings()`:py:func:
+
+    :Returns:
+        A list of `mdfile.DirToc`:py:class:, one for each of
+        `md.scan().dir_toc_spans`, suitable for
+        `mdfile.MarkdownFile.set_dir_tocs()`:py:meth:
+    """
+    patterns = [md.get_dir_toc_pattern(span) for span in md.scan().dir_toc_spans]
+    all_paths = [resolve_dir_toc_paths(path, pattern) for pattern in patterns]
+    unique_paths = sorted(set(target_path for paths in all_paths for target_path in paths))
+    all_headings = read_all_headings(
+        unique_paths,
+        md.encoding,
+        binary,
+        cache_dir=cache_dir,
+        jobs=jobs,
+        parser_name=md.parser_name,
+        heading_cache=heading_cache,
+    )
+
+    dir_tocs = []
+    for pattern, paths in zip(patterns, all_paths):
+        dir_toc = mdfile.DirToc(pattern, skip_level=skip_level, max_level=max_level)
+        for target_path in paths:
+            dir_toc.add_file(get_link_path(path, target_path), all_headings[target_path])
+        dir_tocs.append(dir_toc)
+    return dir_tocs
@@ -0,0 +1,250 @@
+"""Read and update Markdown files as staged in the git index."""
+
+import io
+import os
+import subprocess
+import tempfile
+
+from . import iofile
+
+####################
+
+GIT = "git"
+
+MARKDOWN_PATHSPECS = ["*.md", "*.markdown"]
+
+REGULAR_FILE_MODES = {"100644", "100755"}
+
+####################
+
+
+def _run_git(args, input_data=None):
+    """Run a git command and return its standard output, as bytes."""
+    result = subprocess.run(  # noqa: S603
+        [GIT] + args,
+        input=input_data,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return result.stdout
+
+
+class StagedEntry(object):
+    """Model a file staged in the git index."""
+
+    def __init__(self, path, mode, blob_id):
+        self.path = path
+        self.mode = mode
+        self.blob_id = blob_id
+
+    def __repr__(self):
+        """Print a human-readable representation of this entry."""
+        return "StagedEntry(path={path}, mode={mode}, blob_id={blob_id})".format(
+            path=repr(self.path), mode=self.mode, blob_id=self.blob_id
+        )
+
+
+def list_staged_entries(paths=None):
+    """
+    List Markdown files added or modified in the git index.
+
+    :Args:
+        paths
+            (optional) Paths (or git pathspecs) to limit the list to (default:
+            all Markdown files under the current directory)
+
+    :Returns:
+        A list of `StagedEntry`:py:class:, with paths relative to the
+        current directory; symbolic links and submodules are left out
+    """
+    pathspecs = list(paths) if paths else MARKDOWN_PATHSPECS
+    output = _run_git(
+        ["diff", "--cached", "--raw", "-z", "--no-abbrev", "--no-renames", "--relative", "--diff-filter=AM", "--"]
+        + pathspecs
+    )
+    fields = output.split(b"\0")
+    entries = []
+    for i in range(0, len(fields) - 1, 2):
+        (_, mode, _, blob_id, _) = fields[i].decode("ascii").split(" ")
+        if mode in REGULAR_FILE_MODES:
+            entries.append(StagedEntry(os.fsdecode(fields[i + 1]), mode, blob_id))
+    return entries
+
+
+class CatFileBatch(object):
+    """
+    Read git objects through one long-lived ``git cat-file --batch`` process.
+
+    Use as a context manager, or call `close()`:py:meth: when done.
+    """
+
+    def __init__(self):
+        self._process = subprocess.Popen(  # noqa: S603
+            [GIT, "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, object_id):
+        """
+        Read the contents of an object.
+
+        :Raises:
+            `KeyError`:py:exc: if the object does not exist
+        """
+        self._process.stdin.write(object_id.encode("ascii") + b"\n")
+        self._process.stdin.flush()
+        header = self._process.stdout.readline().split()
+        if len(header) != 3:  # noqa: PLR2004
+            raise KeyError(object_id)
+        size = int(header[2])
+        data = self._process.stdout.read(size)
+        self._process.stdout.read(1)  # newline after contents
+        return data
+
+    def close(self):
+        """Stop the ``git cat-file`` process."""
+        if self._process.stdin:
+            self._process.stdin.close()
+        self._process.stdout.close()
+        self._process.wait()
+
+
+class StagedFile(object):
+    """
+    Provide the input side of `iofile.TextIOFile`:py:class: for a file's staged contents.
+
+    :Args:
+        entry
+            The `StagedEntry`:py:class: for the file
+
+        data
+            The staged contents, as bytes
+
+        encoding
+            The text encoding
+
+        binary
+            Whether to provide the contents as bytes rather than text
+    """
+
+    def __init__(self, entry, data, encoding, binary):
+        self.entry = entry
+        self.data = data
+        self.encoding = encoding
+        self.binary = binary
+        self.path = entry.path
+        self.printable_name = entry.path
+        self.file = None
+
+    def open_for_input(self):
+        """Open `self.file`:py:attr: on the staged contents."""
+        if self.binary:
+            self.file = io.BytesIO(self.data)
+        else:
+            self.file = io.StringIO(self.data.decode(self.encoding), newline="")
+        return self.file
+
+    def close(self):
+        """Close `self.file`:py:attr:."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class StagedIndex(object):
+    """
+    Read Markdown files from the git index, and stage updated contents.
+
+    All staged contents are read through a single ``git cat-file --batch``
+    process.  Updated contents are kept in a temporary directory until
+    `commit()`:py:meth: is called, which writes them all to the object
+    database with a single ``git hash-object``, and applies them to the
+    index with a single ``git update-index``.
+
+    Use as a context manager, or call `close()`:py:meth: when done.
+    """
+
+    def __init__(self):
+        self._cat_file = CatFileBatch()
+        self._prefix = os.fsdecode(_run_git(["rev-parse", "--show-prefix"]).rstrip(b"\n"))
+        self._temp_dir = None
+        self.updates = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def iter_files(self, paths, encoding, binary):
+        """Generate a `StagedFile`:py:class: for each staged Markdown file (see `list_staged_entries()`:py:func:)."""
+        for entry in list_staged_entries(paths):
+            yield StagedFile(entry, self._cat_file.read(entry.blob_id), encoding, binary)
+
+    def stage(self, staged_file, data):
+        """
+        Stage new contents for a file.
+
+        The working tree copy is updated as well, but only if it matches the
+        previously staged contents, so that unstaged changes are never lost.
+
+        :Returns:
+            `True` if the working tree copy was updated, else `False`
+        """
+        if self._temp_dir is None:
+            self._temp_dir = tempfile.TemporaryDirectory(prefix="mark-toc-staged.")
+        temp_path = os.path.join(self._temp_dir.name, str(len(self.updates)))
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        entry = staged_file.entry
+        # The blob ID is filled in by `commit()`
+        self.updates.append((StagedEntry(self._prefix + entry.path.replace(os.sep, "/"), entry.mode, None), temp_path))
+        try:
+            with open(entry.path, "rb") as f:
+                if f.read() != staged_file.data:
+                    return False
+        except FileNotFoundError:
+            return False
+        worktree_iofile = iofile.TextIOFile(entry.path, atomic=True, binary=True)
+        worktree_iofile.open_for_output()
+        try:
+            worktree_iofile.file.write(data)
+        except BaseException:
+            worktree_iofile.discard()
+            raise
+        worktree_iofile.close()
+        return True
+
+    def commit(self):
+        """Write the contents of all staged updates to the object database, and apply the updates to the index."""
+        if not self.updates:
+            return
+        # Store the contents exactly as given; any filters would go by the temporary paths
+        blob_ids = _run_git(
+            ["hash-object", "-w", "--no-filters", "--stdin-paths"],
+            input_data=b"".join(os.fsencode(temp_path) + b"\n" for (_, temp_path) in self.updates),
+        ).split()
+        for (update, _), blob_id in zip(self.updates, blob_ids):
+            update.blob_id = blob_id.decode("ascii")
+        index_info = b"".join(
+            "{mode} {blob_id}\t".format(mode=update.mode, blob_id=update.blob_id).encode("ascii")
+            + os.fsencode(update.path)
+            + b"\0"
+            for (update, _) in self.updates
+        )
+        _run_git(["update-index", "-z", "--index-info"], input_data=index_info)
+        self.updates = []
+
+    def close(self):
+        """Stop the ``git cat-file`` process, and remove any temporary files."""
+        self._cat_file.close()
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+            self._temp_dir = None
@@ -1,5 +1,7 @@
 # https://www.pyinvoke.org/
 
+from pathlib import Path
+
 from invoke import Collection, call, task
 
 from taskutil import (
@@ -149,6 +151,14 @@ def tests(context, test_name_pattern, quiet=False, failfast=False, catch=False,
     context.run("uv run python3 -m unittest discover -s tests -t . {}".format(" ".join(args)))
 
 
+@task
+def benchmarks(context):
+    """Run benchmarks"""
+    progress(benchmarks)
+    for benchmark in sorted(Path("benchmarks").glob("*.py")):
+        context.run("uv run python3 {}".format(benchmark))
+
+
 @task
 @echo_on
 def version(
@@ -238,4 +248,5 @@ ns.add_task(clean_docs)
 ns.add_task(clean)
 ns.add_task(build)
 ns.add_task(tests)
+ns.add_task(benchmarks)
 ns.add_task(version)